@@ -4,7 +4,6 @@ import pandas as pd
 import numpy as np
 import pickle as pkl
 import matplotlib.pyplot as plt
-from sklearn.manifold import TSNE
 from copy import deepcopy
 from braindecode.datautil import load_concat_dataset
 from torch.utils.data import DataLoader
@@ -12,7 +11,9 @@ from braindecode.datasets import BaseConcatDataset
 
 from models.Embedder import ShallowFBCSPEncoder
 from models.Supportnet import Supportnet
-from utils import freeze_all_param_but, train_one_epoch, test_model, load_from_pickle
+from utils import freeze_all_param_but, train_one_epoch, test_model, load_from_pickle, hash_model_weights
+from embedding_store import extract_embeddings
+from projection import NeighborGraphProjection, project_embedding_store
 from loss import contrastive_loss_btw_subject
 
 subject_ids_lst = list(range(1, 14))
@@ -38,6 +39,8 @@ print(experiment_folder_name)
 os.makedirs(os.path.join(dir_results, experiment_folder_name), exist_ok=True)
 training_record_path = os.path.join(dir_results, f'{experiment_folder_name}/', 'training.pkl')
 embeddings_path = os.path.join(dir_results, f'{experiment_folder_name}/', 'embeddings.pkl')
+# full embeddings, one store per supportnet weights
+embeddings_cache_dir = os.path.join(dir_results, f'{experiment_folder_name}/', 'embeddings')
 results_path = os.path.join(dir_results, f'{experiment_folder_name}/', 'results.pkl')
 
 # Load dataset
@@ -338,43 +341,32 @@ for i, target_subject in enumerate(subject_ids_lst):
     else:
         # Calculate and visualize embeddings
         print('Calculate and reduce embeddings to 2D')
-        embedding_lst = []
-        subject_id_lst = []
-        label_lst = []
-        for subject_id, subject_dataset in windows_dataset.split('subject').items():
-
-            subject_dataloader = DataLoader(subject_dataset, batch_size=batch_size)
-            for _, (src_x, src_y, _) in enumerate(subject_dataloader):
-                # support_encoder.eval()
-                # src_x = src_x.to(device)
-                # _ = support_encoder(src_x)
-                # batch_embeddings = support_encoder.get_embeddings()
-                supportnet.eval()
-                src_x = src_x.to(device)
-                _ = supportnet(src_x)
-                integrated_embeddings = supportnet.integrated_embeddings
-                # print(integrated_embeddings.shape)
-
-                for embedding, label in zip(
-                    # batch_embeddings.detach().cpu().numpy(), 
-                    integrated_embeddings.detach().cpu().numpy(),
-                    src_y.cpu().numpy()
-                ):
-                    embedding_lst.append(embedding.flatten())
-                    label_lst.append(label)
-                    subject_id_lst.append(subject_id)
+        supportnet.eval()
+
+        def supportnet_embeddings(src_x):
+            _ = supportnet(src_x)
+            return supportnet.integrated_embeddings
+
+        # Cached per supportnet weights; resumes if interrupted
+        embedding_store = extract_embeddings(
+            supportnet_embeddings, 
+            windows_dataset, 
+            embeddings_cache_dir, 
+            hash_model_weights(supportnet.state_dict()), 
+            batch_size=batch_size, 
+            device=device
+        )
 
         df_embeddings = pd.DataFrame({
-            'embedding': embedding_lst, 
-            'subject_id': subject_id_lst, 
-            'label': label_lst
+            # the string keys of split('subject'), as before the store
+            'subject_id': embedding_store.subject_ids.astype(str), 
+            'label': embedding_store.labels
         })
 
         # Dimensionality reduction
-        tsne_model = TSNE(n_components=2, random_state=0, perplexity=10)
-        reduced_embeddings = tsne_model.fit_transform(
-            np.vstack(df_embeddings['embedding'].values)
-        )
+        # PCA + cached kNN graph + t-SNE; subjects added later are projected, not refitted
+        projection = NeighborGraphProjection(perplexity=10, random_state=0)
+        reduced_embeddings = project_embedding_store(embedding_store, projection)
         df_embeddings['reduced_embedding'] = reduced_embeddings.tolist()
 
         print('Save embeddings')
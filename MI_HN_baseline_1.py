@@ -29,7 +29,8 @@ from models.Embedder import ShallowFBCSPEmbedder, EEGConformerEmbedder
 from models.Hypernet import LinearHypernet
 
 from utils import (
-    get_subset, import_model, train_one_epoch, test_model, parse_training_config
+    get_subset, split_stats, import_model, train_one_epoch, test_model, parse_training_config,
+    make_grad_scaler
 )
 
 ### ----------------------------- Experiment parameters -----------------------------
@@ -149,7 +150,7 @@ for subj_id, subj_dataset in windows_dataset.split('subject').items():
     # subj_valid_set = BaseConcatDataset(splitted_lst_by_run[-valid_set_size:])
     # subj_valid_set = splitted_by_run.get('1')
     
-    train_trials_num = len(subj_train_set.get_metadata())
+    train_trials_num = split_stats(subj_train_set).n_trials
 
     for training_data_amount in np.arange(1, train_trials_num // args.data_amount_step) * args.data_amount_step:
     
@@ -213,6 +214,7 @@ for subj_id, subj_dataset in windows_dataset.split('subject').items():
                 T_max=args.n_epochs - 1
             )
             loss_fn = torch.nn.NLLLoss()
+            scaler = make_grad_scaler(args.precision, device)
 
             # Get current training set
             cur_train_set = get_subset(subj_train_set, int(training_data_amount), random_sample=True)
@@ -233,6 +235,9 @@ for subj_id, subj_dataset in windows_dataset.split('subject').items():
                     epoch, 
                     device,
                     print_batch_stats=False,
+                    precision=args.precision,
+                    scaler=scaler,
+                    accumulation_steps=args.accumulation_steps,
                     **(args.forward_pass_kwargs)
                 )
 
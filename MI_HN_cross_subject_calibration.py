@@ -27,13 +27,12 @@ from scipy import stats
 import os
 import pickle
 import numpy as np
-from copy import deepcopy
 from itertools import chain
 from pytorch_warmup import UntunedLinearWarmup
 
 from utils import (
-    get_subset, import_model, parse_training_config, 
-    train_one_epoch, test_model
+    get_subset, split_stats, import_model, parse_training_config, 
+    train_one_epoch, test_model, WeightCache
 )
 from models.HypernetBCI import HyperBCINet
 from models.Embedder import Conv1dEmbedder, ShallowFBCSPEmbedder, EEGConformerEmbedder
@@ -174,6 +173,9 @@ else:
     print('No CUDA available, use CPU for training')
     device = 'cpu'
 
+# Pretrained weights of the current holdout subject, restored before every calibration
+pretrained_weights = WeightCache(device=device)
+
 seed = 20200220
 set_random_seeds(seed=seed, cuda=cuda)
 
@@ -361,10 +363,10 @@ for holdout_subj_id in subject_ids_lst:
                 loss_fn, 
                 optimizer, 
                 scheduler, 
-                warmup_scheduler,
                 epoch, 
                 device,
                 print_batch_stats=False,
+                warmup_scheduler=warmup_scheduler,
                 optimize_for_acc=args.optimize_for_acc,
                 regularize_tensor_distance=args.regularize_tensor_distance,
                 regularization_coef=args.regularization_coef,
@@ -489,9 +491,8 @@ for holdout_subj_id in subject_ids_lst:
         sample_shape,
         calibrate_hypernet
     )
-    pretrained_params = torch.load(model_param_path)
-    calibrate_HNBCI.load_state_dict(pretrained_params['HN_params_dict'])
-    calibrate_HNBCI.primary_params = deepcopy(pretrained_params['primary_params'])
+    pretrained_weights.restore(model_param_path, calibrate_HNBCI, 'HN_params_dict')
+    calibrate_HNBCI.primary_params = pretrained_weights.restore_dict(model_param_path, 'primary_params')
     # Send to GPU
     if cuda:
         set_random_seeds(seed=seed, cuda=cuda)
@@ -518,7 +519,7 @@ for holdout_subj_id in subject_ids_lst:
         # }
     }
 
-    calibrate_trials_num = len(subj_calibrate_set.get_metadata())
+    calibrate_trials_num = split_stats(subj_calibrate_set).n_trials
     for calibrate_data_amount in np.arange(1, (calibrate_trials_num // args.data_amount_step) + 1) * args.data_amount_step:
 
         test_accuracy_lst = []
@@ -536,8 +537,8 @@ for holdout_subj_id in subject_ids_lst:
             )
 
             # Restore to the pre-trained state
-            calibrate_HNBCI.load_state_dict(pretrained_params['HN_params_dict'])
-            calibrate_HNBCI.primary_params = deepcopy(pretrained_params['primary_params'])
+            pretrained_weights.restore(model_param_path, calibrate_HNBCI, 'HN_params_dict')
+            calibrate_HNBCI.primary_params = pretrained_weights.restore_dict(model_param_path, 'primary_params')
             # Send to GPU
             if cuda:
                 # calibrate_model.cuda()
@@ -22,14 +22,13 @@ from scipy import stats
 import os
 import pickle
 import numpy as np
-from copy import deepcopy
 from itertools import chain
 
 from torch.utils.data import DataLoader
 
 from utils import (
-    get_subset, import_model, parse_training_config, 
-    train_one_epoch, test_model
+    get_subset, split_stats, import_model, parse_training_config, 
+    train_one_epoch, test_model, WeightCache
 )
 from models.HypernetBCI import HyperBCINet
 from models.Embedder import Conv1dEmbedder, ShallowFBCSPEmbedder, EEGConformerEmbedder
@@ -150,6 +149,9 @@ else:
     print('No CUDA available, use CPU for training')
     device = 'cpu'
 
+# Pretrained weights of the current holdout subject, restored before every calibration
+pretrained_weights = WeightCache(device=device)
+
 seed = 20200220
 set_random_seeds(seed=seed, cuda=cuda)
 
@@ -438,9 +440,8 @@ for holdout_subj_id in subject_ids_lst:
         sample_shape,
         calibrate_hypernet
     )
-    pretrained_params = torch.load(model_param_path)
-    calibrate_HNBCI.load_state_dict(pretrained_params['HN_params_dict'])
-    calibrate_HNBCI.primary_params = deepcopy(pretrained_params['primary_params'])
+    pretrained_weights.restore(model_param_path, calibrate_HNBCI, 'HN_params_dict')
+    calibrate_HNBCI.primary_params = pretrained_weights.restore_dict(model_param_path, 'primary_params')
     # Send to GPU
     if cuda:
         if device_count > 1:
@@ -463,7 +464,7 @@ for holdout_subj_id in subject_ids_lst:
     ### Calibrate with varying amount of new data
     dict_subj_results = {0: [calibrate_baseline_acc,]}
     dict_subj_intermediate_outputs = {}
-    calibrate_trials_num = len(subj_calibrate_set.get_metadata())
+    calibrate_trials_num = split_stats(subj_calibrate_set).n_trials
     for calibrate_data_amount in np.arange(1, (calibrate_trials_num // args.data_amount_step) + 1) * args.data_amount_step:
 
         test_accuracy_lst = []
@@ -482,8 +483,8 @@ for holdout_subj_id in subject_ids_lst:
             )
 
             # Restore to the pre-trained state
-            calibrate_HNBCI.module.load_state_dict(pretrained_params['HN_params_dict'])
-            calibrate_HNBCI.module.primary_params = deepcopy(pretrained_params['primary_params'])
+            pretrained_weights.restore(model_param_path, calibrate_HNBCI.module, 'HN_params_dict')
+            calibrate_HNBCI.module.primary_params = pretrained_weights.restore_dict(model_param_path, 'primary_params')
             # Send to GPU
             if cuda:
                 # calibrate_model.cuda()
@@ -22,7 +22,10 @@ from baseline_MAPU.models import (
     ShallowFBCSPFeatureExtractor
 )
 from baseline_MAPU.loss import CrossEntropyLabelSmooth, EntropyLoss
-from utils import parse_training_config, get_subset
+from baseline_MAPU.utils import ModelCheckpointer
+from baseline_MAPU.pretrain import pretrain_source_model, PRETRAIN_CODE_PATHS
+from utils import parse_training_config, get_subset, hash_pretrain_config
+from embedding_store import dataset_fingerprint
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -116,6 +119,10 @@ results_file_path = os.path.join(
 )
 print(f'Saving pretrain accuracy at {pretrain_file_path}')
 print(f'Saving results at {results_file_path}')
+# Pretrained source models are cached by content, shared by all scenarios
+# and experiment versions that pretrain on the same sources with the same settings
+pretrain_cache_dir = os.path.join(dir_results, 'MAPU_pretrained_source_models')
+os.makedirs(pretrain_cache_dir, exist_ok=True)
 
 ### ----------------------------- Create model -----------------------------
 # Specify which GPU to run on to avoid collisions
@@ -189,7 +196,11 @@ for i, (source_subject, target_subject) in enumerate(args.scenarios):
     if args.add_tov_loss:
         # Prepare the temporal imputer / verifier
         feature_dimension = 40
-        temporal_verifier = myTemporal_Imputer(feature_dimension, feature_dimension)
+        temporal_verifier = myTemporal_Imputer(
+            feature_dimension, 
+            feature_dimension, 
+            imputer_type=args.imputer_type
+        )
 
     # Send to GPU
     if cuda:
@@ -216,18 +227,35 @@ for i, (source_subject, target_subject) in enumerate(args.scenarios):
     mse_loss = torch.nn.MSELoss()
     cross_entropy = CrossEntropyLabelSmooth(args.n_classes, device, epsilon=0.1)
 
-    # check if a source-trained model exists
+    # check if a source-trained model exists in the pretrain cache
+    pretrain_cache_key = hash_pretrain_config(
+        source_subjects=[source_subject],
+        hparams={
+            key: getattr(args, key) for key in [
+                'dataset_name', 'n_classes', 'batch_size', 'pretrain_n_epochs', 'pretrain_lr',
+                'imputer_lr', 'imputer_type', 'weight_decay', 'add_tov_loss', 'single_pass_masking'
+            ]
+        },
+        seed=seed,
+        code_paths=PRETRAIN_CODE_PATHS,
+        data_fingerprint=dataset_fingerprint([
+            (ds.description['subject'], ds) 
+            for ds in src_pretrain_dataset.datasets + src_valid_dataset.datasets
+        ])
+    )
     model_param_path = os.path.join(
-        dir_results, 
-        f'{experiment_folder_name}/',
-        f'{temp_exp_name}_{dict_key}_pretrained_model_params.pth'
+        pretrain_cache_dir,
+        f'{pretrain_cache_key}_pretrained_model_params.pth'
     )
     if args.add_tov_loss:
         temporal_verifier_path = os.path.join(
-            dir_results, 
-            f'{experiment_folder_name}/',
-            f'{temp_exp_name}_{dict_key}_pretrained_temporal_verifier_params.pth'
+            pretrain_cache_dir,
+            f'{pretrain_cache_key}_pretrained_temporal_verifier_params.pth'
         )
+    pretrain_record_path = os.path.join(
+        pretrain_cache_dir,
+        f'{pretrain_cache_key}_pretrain_acc.pkl'
+    )
     figure_title = f'{temp_exp_name}_{dict_key}_pretrain_acc_curve'
     pretrain_acc_curve_path = os.path.join(
         dir_results, 
@@ -240,83 +268,27 @@ for i, (source_subject, target_subject) in enumerate(args.scenarios):
     else:
         temporal_verifier_exist = True
     # Also check if the pretrain accuracy has been saved
-    pretraining_done = model_exist and temporal_verifier_exist and (dict_pretrain.get(dict_key) is not None)
+    pretraining_done = model_exist and temporal_verifier_exist and os.path.exists(pretrain_record_path)
 
     if not pretraining_done:
         # Begin pretraining on source subject
-        pretrain_train_acc_lst = []
-        pretrain_test_acc_lst = []
-        pretrain_tov_loss_lst = []
-        pretrain_cls_loss_lst = []
         print(f'Pretraining on source subject {source_subject}')
-        for epoch in range(1, args.pretrain_n_epochs + 1):
-
-            network.train()
-            pretrain_correct = 0
-            batch_avg_tov_loss = 0
-            batch_avg_cls_loss = 0
-            # Train for one epoch: Iterate through pretraining batches
-            for batch_idx, (src_x, src_y, _) in enumerate(src_pretrain_loader):
-
-                pretrain_optimizer.zero_grad()
-                if args.add_tov_loss:
-                    tov_optimizer.zero_grad()
-                src_x, src_y = src_x.to(device), src_y.to(device)
-
-                src_features, src_prediction = network(src_x)
-                pretrain_correct += (src_prediction.argmax(1) == src_y).sum().item()
-                src_features = src_features.squeeze(-1)
-                src_classification_loss = cross_entropy(src_prediction, src_y)
-                batch_avg_cls_loss = (batch_avg_cls_loss * batch_idx + src_classification_loss) / (batch_idx + 1)
-
-                if args.add_tov_loss:
-                    masked_x, mask = masking(src_x, num_splits=10, num_masked=2)
-                    # mask the signal
-                    masked_features, masked_prediction = network(masked_x)
-                    # extract features from masked signal
-                    masked_features = masked_features.squeeze(-1)
-                    # predict full features from masked features
-                    tov_predictions = temporal_verifier(masked_features.detach())
-                    # calculate difference btw the full features and predicted features
-                    tov_loss = mse_loss(tov_predictions, src_features)
-                    batch_avg_tov_loss = (batch_avg_tov_loss * batch_idx + tov_loss) / (batch_idx + 1)
-                else:
-                    tov_loss = 0
-                    batch_avg_tov_loss = 0
-
-                total_loss = src_classification_loss + tov_loss
-                total_loss.backward()
-                pretrain_optimizer.step()
-                if args.add_tov_loss:
-                    tov_optimizer.step()
-
-            pretrain_accuracy = pretrain_correct / len(src_pretrain_loader.dataset)
-            # Save pretrain accuracy
-            pretrain_train_acc_lst.append(pretrain_accuracy)
-            # Save batch-averaged tov loss
-            pretrain_tov_loss_lst.append(batch_avg_tov_loss)
-            # Save batch-averaged classification loss
-            pretrain_cls_loss_lst.append(batch_avg_cls_loss)
-
-            # Test model on validation set
-            network.eval()
-            valid_correct = 0
-            with torch.no_grad():
-                for _, (valid_x, valid_y, _) in enumerate(src_valid_loader):
-                    valid_x, valid_y = valid_x.to(device), valid_y.to(device)
-                    _, valid_prediction = network(valid_x)
-                    valid_correct += (valid_prediction.argmax(1) == valid_y).sum().item()
-
-            # Save validation accuracy
-            valid_accuracy = valid_correct / len(src_valid_loader.dataset)
-            pretrain_test_acc_lst.append(valid_accuracy)
-            print(
-                f'[Epoch : {epoch}/{args.pretrain_n_epochs}] ' 
-                f'training accuracy = {100 * pretrain_accuracy:.1f}% ' 
-                f'validation accuracy = {100 * valid_accuracy:.1f}% '
-                f'tov_loss = {batch_avg_tov_loss: .3e} '
-                f'classification_loss = {batch_avg_cls_loss: .3e} '
-            )
+        pretrain_record = pretrain_source_model(
+            network,
+            temporal_verifier if args.add_tov_loss else None,
+            src_pretrain_loader,
+            src_valid_loader,
+            pretrain_optimizer,
+            tov_optimizer if args.add_tov_loss else None,
+            cross_entropy,
+            mse_loss,
+            args.pretrain_n_epochs,
+            device,
+            add_tov_loss=args.add_tov_loss,
+            single_pass_masking=args.single_pass_masking
+        )
+        pretrain_train_acc_lst = pretrain_record['pretrain_train_acc']
+        pretrain_test_acc_lst = pretrain_record['pretrain_test_acc']
 
         # Plot and save the pretraining accuracy curves
         plt.figure()
@@ -331,14 +303,9 @@ for i, (source_subject, target_subject) in enumerate(args.scenarios):
         plt.close()
 
         # Save pretraining accuracies
-        dict_pretrain.update({
-            dict_key: {
-                'pretrain_test_acc': pretrain_test_acc_lst,
-                'pretrain_train_acc': pretrain_train_acc_lst,
-                'pretrain_tov_loss': pretrain_tov_loss_lst,
-                'pretrain_cls_loss': pretrain_cls_loss_lst
-            }
-        })
+        with open(pretrain_record_path, 'wb') as f:
+            pkl.dump(pretrain_record, f)
+        dict_pretrain.update({dict_key: pretrain_record})
         if os.path.exists(pretrain_file_path):
             os.remove(pretrain_file_path)
         with open(pretrain_file_path, 'wb') as f:
@@ -351,7 +318,13 @@ for i, (source_subject, target_subject) in enumerate(args.scenarios):
             torch.save(temporal_verifier.state_dict(), temporal_verifier_path)
 
     else:
-        print('Pretraining done, load pretrained model and temporal verifier')
+        print(f'Pretraining done ({pretrain_cache_key}), load pretrained model and temporal verifier')
+        if dict_pretrain.get(dict_key) is None:
+            # Pretrained in another scenario, record its pretrain accuracies under this one too
+            with open(pretrain_record_path, 'rb') as f:
+                dict_pretrain.update({dict_key: pkl.load(f)})
+            with open(pretrain_file_path, 'wb') as f:
+                pkl.dump(dict_pretrain, f)
         # Load trained model
         network.load_state_dict(torch.load(model_param_path))
         if args.add_tov_loss:
@@ -393,8 +366,7 @@ for i, (source_subject, target_subject) in enumerate(args.scenarios):
     recording best model; overall best accuracy is the best accuracy ever 
     achieved on a target subject across all data amount and runs
     '''
-    overall_best_test_accuracy = 0
-    overall_best_model = deepcopy(network.state_dict())
+    overall_best_checkpointer = ModelCheckpointer(network, mode='max')
 
     adaptation_trials_num = len(target_adaptation_dataset)
     for adaptation_data_amount in np.arange(
@@ -459,7 +431,13 @@ for i, (source_subject, target_subject) in enumerate(args.scenarios):
                     adaptation_optimizer.zero_grad()
                     trg_x = trg_x.to(device)
 
-                    trg_features, trg_prediction = network(trg_x)
+                    if args.single_pass_masking:
+                        # clean and masked signals go through the network in one forward pass
+                        masked_x, mask = masking(trg_x, num_splits=10, num_masked=2)
+                        (trg_features, trg_prediction), (masked_features, masked_prediction) = \
+                            network.forward_clean_and_masked(trg_x, masked_x)
+                    else:
+                        trg_features, trg_prediction = network(trg_x)
                     trg_features = trg_features.squeeze(-1)
                     # select evidential vs softmax probabilities
                     trg_prob = torch.nn.Softmax(dim=1)(network.logits)
@@ -470,9 +448,10 @@ for i, (source_subject, target_subject) in enumerate(args.scenarios):
                     trg_ent -= args.im * torch.sum(-trg_prob.mean(dim=0) * torch.log(trg_prob.mean(dim=0) + 1e-5))
 
                     # Calculate temporal consistency loss
-                    masked_x, mask = masking(trg_x, num_splits=10, num_masked=2)
-                    # mask the signal
-                    masked_features, masked_prediction = network(masked_x)
+                    if not args.single_pass_masking:
+                        masked_x, mask = masking(trg_x, num_splits=10, num_masked=2)
+                        # mask the signal
+                        masked_features, masked_prediction = network(masked_x)
                     # extract features from masked signal
                     masked_features = masked_features.squeeze(-1)
                     # predict full features from masked features
@@ -505,10 +484,8 @@ for i, (source_subject, target_subject) in enumerate(args.scenarios):
                 if test_accuracy > cur_run_best_accuracy:
                     cur_run_best_accuracy = test_accuracy
 
-                if test_accuracy > overall_best_test_accuracy:
-                    best_model = deepcopy(network.state_dict())
-                    overall_best_test_accuracy = test_accuracy
-                    print(f'New overall best accuracy achieved: {overall_best_test_accuracy*100:.1f}')
+                if overall_best_checkpointer.step(test_accuracy):
+                    print(f'New overall best accuracy achieved: {test_accuracy*100:.1f}')
 
             print(f'Best accuracy achieved in this run is {cur_run_best_accuracy*100:.1f}')
             adaptation_test_acc_lst.append(cur_run_best_accuracy)
@@ -523,7 +500,7 @@ for i, (source_subject, target_subject) in enumerate(args.scenarios):
         f'{experiment_folder_name}/',
         f'{temp_exp_name}_{dict_key}_best_adapted_model_params.pth'
     )
-    torch.save(best_model, best_model_path)
+    torch.save(overall_best_checkpointer.best, best_model_path)
 
     # Save results
     dict_results.update({
@@ -22,7 +22,7 @@ import os
 import pickle
 import numpy as np
 
-from utils import get_subset, import_model
+from utils import get_subset, split_stats, import_model
 
 ### ----------------------------- Experiment parameters -----------------------------
 model_name = 'ShallowFBCSPNet'
@@ -151,7 +151,7 @@ for subj_id, subj_dataset in windows_dataset.split('subject').items():
     # subj_valid_set = BaseConcatDataset(splitted_lst_by_run[-valid_set_size:])
     # subj_valid_set = splitted_by_run.get('1')
     
-    train_trials_num = len(subj_train_set.get_metadata())
+    train_trials_num = split_stats(subj_train_set).n_trials
 
     for training_data_amount in np.arange(1, train_trials_num // data_amount_step) * data_amount_step:
     
@@ -21,7 +21,7 @@ import numpy as np
 from torch.utils.data import DataLoader
 
 from utils import (
-    get_subset, import_model, train_one_epoch, test_model, parse_training_config
+    get_subset, split_stats, import_model, train_one_epoch, test_model, parse_training_config
 )
 
 ### ----------------------------- Experiment parameters -----------------------------
@@ -135,7 +135,7 @@ for subj_id, subj_dataset in windows_dataset.split('subject').items():
     # subj_valid_set = BaseConcatDataset(splitted_lst_by_run[-valid_set_size:])
     # subj_valid_set = splitted_by_run.get('1')
     
-    train_trials_num = len(subj_train_set.get_metadata())
+    train_trials_num = split_stats(subj_train_set).n_trials
 
     for training_data_amount in np.arange(1, train_trials_num // args.data_amount_step) * args.data_amount_step:
     
@@ -28,7 +28,10 @@ import os
 import pickle
 import numpy as np
 
-from utils import get_subset, import_model, clf_predict_on_set, parse_training_config, freeze_param
+from utils import (
+    get_subset, split_stats, import_model, clf_predict_on_set, parse_training_config, freeze_param, 
+    EarlyStoppingCallback, early_stopping_enabled, split_early_stopping_valid
+)
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -36,6 +39,7 @@ warnings.filterwarnings('ignore')
 ### ----------------------------- Experiment parameters -----------------------------
 args = parse_training_config()
 model_object = import_model(args.model_name)
+use_early_stopping = early_stopping_enabled(args)
 subject_ids_lst = list(range(1, 14))
 # subject_ids_lst = [1, 2,]
 dataset = MOABBDataset(dataset_name=args.dataset_name, subject_ids=subject_ids_lst)
@@ -229,6 +233,11 @@ for holdout_subj_id in subject_ids_lst:
         finetune_subj_train_set = finetune_splitted_by_run.get('0train')
         finetune_subj_valid_set = finetune_splitted_by_run.get('1test')
     ### ------------------------------
+    # Early stopping monitors trials held out of the training runs; they are not sampled for fine tuning
+    if use_early_stopping:
+        finetune_subj_train_set, finetune_subj_es_valid_set = split_early_stopping_valid(
+            finetune_subj_train_set, args.early_stopping_valid_fraction
+        )
 
     ### Baseline accuracy on the finetune_valid set
     finetune_baseline_acc = clf_predict_on_set(cur_clf, finetune_subj_valid_set)
@@ -238,7 +247,7 @@ for holdout_subj_id in subject_ids_lst:
     dict_subj_results = {0: [finetune_baseline_acc,]}
 
     ### Finetune with different amount of new data
-    finetune_trials_num = len(finetune_subj_train_set.get_metadata())
+    finetune_trials_num = split_stats(finetune_subj_train_set).n_trials
     for finetune_training_data_amount in np.arange(1, (finetune_trials_num // args.data_amount_step) + 1) * args.data_amount_step:
 
         final_accuracy = []
@@ -261,18 +270,30 @@ for holdout_subj_id in subject_ids_lst:
                 finetune_model.cuda()
 
             cur_finetune_batch_size = int(min(finetune_training_data_amount // 2, args.batch_size))
+
+            finetune_callbacks = [
+                "accuracy", ("lr_scheduler", LRScheduler('CosineAnnealingLR', T_max=args.fine_tune_n_epochs - 1)),
+            ]
+            early_stopping = None
+            if use_early_stopping:
+                early_stopping = EarlyStoppingCallback(
+                    monitor='valid_accuracy',
+                    patience=args.early_stopping_patience,
+                    min_delta=args.early_stopping_min_delta,
+                    slope_window=args.early_stopping_slope_window,
+                    slope_tol=args.early_stopping_slope_tol
+                )
+                finetune_callbacks.append(('early_stopping', early_stopping))
             
             new_clf = EEGClassifier(
                 finetune_model,
                 criterion=torch.nn.NLLLoss,
                 optimizer=torch.optim.AdamW,
-                train_split=predefined_split(finetune_subj_valid_set), 
+                train_split=predefined_split(finetune_subj_es_valid_set if use_early_stopping else finetune_subj_valid_set), 
                 optimizer__lr=args.fine_tune_lr,
                 optimizer__weight_decay=args.fine_tune_weight_decay,
                 batch_size=cur_finetune_batch_size,
-                callbacks=[
-                    "accuracy", ("lr_scheduler", LRScheduler('CosineAnnealingLR', T_max=args.fine_tune_n_epochs - 1)),
-                ],
+                callbacks=finetune_callbacks,
                 device=device,
                 classes=classes,
             )
@@ -300,7 +321,12 @@ for holdout_subj_id in subject_ids_lst:
             ## Get results after fine tuning
             df = pd.DataFrame(new_clf.history[:, results_columns], columns=results_columns,)
     
-            cur_final_acc = np.mean(df.tail(5).valid_accuracy)
+            if early_stopping is None:
+                cur_final_acc = np.mean(df.tail(5).valid_accuracy)
+            else:
+                # test accuracy of the restored best weights
+                cur_final_acc = clf_predict_on_set(new_clf, finetune_subj_valid_set)
+                print(f'Stopped at epoch {early_stopping.stopped_epoch}, best epoch {early_stopping.early_stopping.best_epoch}')
             final_accuracy.append(cur_final_acc)
         
         dict_subj_results.update({finetune_training_data_amount: final_accuracy})
@@ -31,9 +31,12 @@ import numpy as np
 from torch.utils.data import DataLoader
 
 from utils import (
-    get_subset, import_model, parse_training_config, 
-    freeze_param, train_one_epoch, test_model
+    get_subset, split_stats, import_model, parse_training_config, 
+    freeze_param, train_one_epoch, test_model, make_grad_scaler, make_lr_scheduler,
+    make_early_stopping, early_stopping_enabled, split_early_stopping_valid, WeightCache, freeze_all_param_but, trainable_parameters, 
+    split_frozen_prefix, cache_prefix_outputs
 )
+from replica_training import StackedReplicas, train_one_epoch_replicas, test_replicas
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -41,6 +44,7 @@ warnings.filterwarnings('ignore')
 ### ----------------------------- Experiment parameters -----------------------------
 args = parse_training_config()
 model_object = import_model(args.model_name)
+use_early_stopping = early_stopping_enabled(args)
 subject_ids_lst = list(range(1, 14))
 
 preprocessed_dir = 'data/Schirrmeister2017_preprocessed'
@@ -166,6 +170,9 @@ else:
     print('No CUDA available, use CPU for training')
     device = 'cpu'
 
+# Pretrained weights of the current holdout subject, restored before every fine tuning
+pretrained_weights = WeightCache(device=device)
+
 seed = args.random_seed
 set_random_seeds(seed=seed, cuda=cuda)
 
@@ -263,6 +270,14 @@ for holdout_subj_id in subject_ids_lst:
         
         pre_train_train_set = BaseConcatDataset(pre_train_train_set_lst)
         pre_train_test_set = BaseConcatDataset(pre_train_test_set_lst)
+        # Early stopping monitors trials held out of every subject's training runs, not the test runs
+        if use_early_stopping:
+            pre_train_splits = [
+                split_early_stopping_valid(subj_set, args.early_stopping_valid_fraction)
+                for subj_set in pre_train_train_set.split('subject').values()
+            ]
+            pre_train_train_set = BaseConcatDataset([train_set for train_set, _ in pre_train_splits])
+            pre_train_valid_set = BaseConcatDataset([valid_set for _, valid_set in pre_train_splits])
         ### ------------------------------
         set_random_seeds(seed=seed, cuda=cuda)
         cur_model = model_object(
@@ -280,17 +295,25 @@ for holdout_subj_id in subject_ids_lst:
             cur_model.parameters(),
             lr=args.lr, 
             weight_decay=args.weight_decay)
-        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
-            optimizer,
-            T_max=args.n_epochs - 1
-        )
         loss_fn = torch.nn.NLLLoss()
+        scaler = make_grad_scaler(args.precision, device)
 
         pre_train_train_loader = DataLoader(pre_train_train_set, batch_size=args.batch_size, shuffle=True)
         pre_train_test_loader = DataLoader(pre_train_test_set, batch_size=args.batch_size)
+        if use_early_stopping:
+            pre_train_valid_loader = DataLoader(pre_train_valid_set, batch_size=args.batch_size)
+        scheduler = make_lr_scheduler(
+            optimizer,
+            args.lr_schedule,
+            args.n_epochs,
+            pre_train_train_loader,
+            args.accumulation_steps,
+            args.warmup_fraction
+        )
 
         pretrain_train_acc_lst = []
         pretrain_test_acc_lst = []
+        early_stopping = make_early_stopping(cur_model, args)
         for epoch in range(1, args.n_epochs + 1):
             print(f"Epoch {epoch}/{args.n_epochs}: ", end="")
 
@@ -302,7 +325,10 @@ for holdout_subj_id in subject_ids_lst:
                 scheduler, 
                 epoch, 
                 device,
-                print_batch_stats=False
+                print_batch_stats=False,
+                precision=args.precision,
+                scaler=scaler,
+                accumulation_steps=args.accumulation_steps
             )
 
             test_loss, test_accuracy = test_model(
@@ -321,6 +347,19 @@ for holdout_subj_id in subject_ids_lst:
             pretrain_train_acc_lst.append(train_accuracy)
             pretrain_test_acc_lst.append(test_accuracy)
 
+            if early_stopping is not None:
+                _, valid_accuracy = test_model(
+                    pre_train_valid_loader, 
+                    cur_model, 
+                    loss_fn,
+                    print_batch_stats=False
+                )
+                if early_stopping.step(valid_accuracy, epoch, train_loss):
+                    print(f'Early stopping at epoch {epoch}, best epoch {early_stopping.best_epoch}')
+                    break
+        if early_stopping is not None:
+            early_stopping.restore()
+
         # Plot and save the pretraining curve
         plt.figure()
         plt.plot(pretrain_train_acc_lst, label='Training accuracy')
@@ -371,6 +410,12 @@ for holdout_subj_id in subject_ids_lst:
         finetune_subj_train_set = finetune_splitted_by_run.get('0train')
         finetune_subj_valid_set = finetune_splitted_by_run.get('1test')
     ### ------------------------------
+    # Early stopping monitors trials held out of the training runs; they are not sampled for fine tuning
+    if use_early_stopping:
+        finetune_subj_train_set, finetune_subj_es_valid_set = split_early_stopping_valid(
+            finetune_subj_train_set, args.early_stopping_valid_fraction
+        )
+        finetune_subj_es_valid_loader = DataLoader(finetune_subj_es_valid_set, batch_size=args.batch_size)
 
     ### Baseline accuracy on the finetune_valid set
     finetune_subj_valid_loader = DataLoader(finetune_subj_valid_set, batch_size=args.batch_size)
@@ -381,7 +426,7 @@ for holdout_subj_id in subject_ids_lst:
         input_window_samples=input_window_samples,
         **(args.model_kwargs)
     )
-    finetune_model.load_state_dict(torch.load(model_param_path))
+    pretrained_weights.restore(model_param_path, finetune_model)
     # Send model to GPU
     if cuda:
         finetune_model.cuda()
@@ -397,87 +442,222 @@ for holdout_subj_id in subject_ids_lst:
     ### Finetune with different amount of new data
     dict_subj_results = {0: [finetune_baseline_acc,]}
     dict_subj_intermediate_outputs = {}
-    finetune_trials_num = len(finetune_subj_train_set.get_metadata())
+    # outputs of the frozen prefix on the valid (and early stopping) set, the same for every fine tuning run
+    cached_valid_loader = None
+    cached_es_valid_loader = None
+    finetune_trials_num = split_stats(finetune_subj_train_set).n_trials
     for finetune_training_data_amount in np.arange(1, (finetune_trials_num // args.data_amount_step) + 1) * args.data_amount_step:
 
         final_accuracy_lst = []
         final_tensor_lst = []
-
-        ### Since we're sampling randomly, repeat for 'repetition' times
-        for i in range(args.repetition):
-
-            ## Get current finetune samples
-            cur_finetune_subj_train_subset = get_subset(
-                finetune_subj_train_set, 
-                int(finetune_training_data_amount), 
-                random_sample=True
-            )
+        stopped_epoch_lst = []
+
+        if args.vectorize_repetitions:
+            ### Fine tune all repetitions at once, as one stacked model
+            assert not use_early_stopping, \
+                'Early stopping is not supported with vectorize_repetitions'
+            assert not args.cache_frozen_prefix, \
+                'cache_frozen_prefix is not supported with vectorize_repetitions'
             cur_finetune_batch_size = int(min(finetune_training_data_amount // 2, args.batch_size))
-            cur_finetune_subj_train_subset_loader = DataLoader(
-                cur_finetune_subj_train_subset, 
-                batch_size=cur_finetune_batch_size, 
-                shuffle=True
-            )
+            # one random subset per repetition
+            cur_finetune_subj_train_subset_loaders = [
+                DataLoader(
+                    get_subset(finetune_subj_train_set, int(finetune_training_data_amount), random_sample=True), 
+                    batch_size=cur_finetune_batch_size, 
+                    shuffle=True
+                ) for _ in range(args.repetition)
+            ]
 
             # Restore to the pre-trained state
-            finetune_model.load_state_dict(torch.load(model_param_path))
-            # Send model to GPU
-            if cuda:
-                finetune_model.cuda()
-    
+            pretrained_weights.restore(model_param_path, finetune_model)
             # Freeze specified layers
             if args.fine_tune_freeze_layer is not None:
                 for param_name in args.fine_tune_freeze_layer:
-                    print(f'Freezing parameter: {param_name}')
                     freeze_param(finetune_model, param_name)
+            if args.freeze_most_layers and args.fine_tune_freeze_layers_but is not None:
+                freeze_all_param_but(finetune_model, args.fine_tune_freeze_layers_but)
+            finetune_replicas = StackedReplicas(finetune_model, args.repetition)
 
-            # Continue training / fine tuning
             print(
-                f'Fine tuning model for subject {holdout_subj_id} ' +
-                f'with {len(cur_finetune_subj_train_subset)} trials (repetition {i})' +
+                f'Fine tuning {args.repetition} replicas for subject {holdout_subj_id} ' +
+                f'with {int(finetune_training_data_amount)} trials each ' +
                 f'with lr = {args.fine_tune_lr:.5f}'
             )
 
             finetune_optimizer = torch.optim.AdamW(
-                finetune_model.parameters(),
+                finetune_replicas.parameters(),
                 lr=args.fine_tune_lr, 
                 weight_decay=args.fine_tune_weight_decay
             )
-            finetune_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
+            finetune_scheduler = make_lr_scheduler(
                 finetune_optimizer,
-                T_max=args.fine_tune_n_epochs - 1
+                args.lr_schedule,
+                args.fine_tune_n_epochs,
+                cur_finetune_subj_train_subset_loaders[0],
+                args.accumulation_steps,
+                args.warmup_fraction
             )
+            finetune_scaler = make_grad_scaler(args.precision, device)
 
             test_accuracy_lst = []
             for epoch in range(1, args.fine_tune_n_epochs + 1):
                 print(f"Epoch {epoch}/{args.fine_tune_n_epochs}: ", end="")
 
-                train_loss, train_accuracy = train_one_epoch(
-                    cur_finetune_subj_train_subset_loader, 
-                    finetune_model, 
+                train_loss, train_accuracy = train_one_epoch_replicas(
+                    cur_finetune_subj_train_subset_loaders, 
+                    finetune_replicas, 
                     loss_fn, 
                     finetune_optimizer, 
                     finetune_scheduler, 
-                    epoch, 
-                    device
+                    device,
+                    precision=args.precision,
+                    scaler=finetune_scaler,
+                    accumulation_steps=args.accumulation_steps
                 )
-                test_loss, test_accuracy = test_model(
+                test_loss, test_accuracy = test_replicas(
                     finetune_subj_valid_loader, 
-                    finetune_model, 
-                    loss_fn
+                    finetune_replicas, 
+                    loss_fn,
+                    device
                 )
+                # has shape: (n_epochs, repetition)
                 test_accuracy_lst.append(test_accuracy)
 
+            final_accuracy_lst = list(np.mean(test_accuracy_lst[-5:], axis=0))
+            stopped_epoch_lst = [args.fine_tune_n_epochs] * args.repetition
+            # Save weights of the classifier of every replica after fine tuning
+            final_tensor_lst = list(finetune_replicas.params['final_layer.conv_classifier.weight'].detach().clone())
+
+        else:
+            ### Since we're sampling randomly, repeat for 'repetition' times
+            for i in range(args.repetition):
+
+                ## Get current finetune samples
+                cur_finetune_subj_train_subset = get_subset(
+                    finetune_subj_train_set, 
+                    int(finetune_training_data_amount), 
+                    random_sample=True
+                )
+                cur_finetune_batch_size = int(min(finetune_training_data_amount // 2, args.batch_size))
+                cur_finetune_subj_train_subset_loader = DataLoader(
+                    cur_finetune_subj_train_subset, 
+                    batch_size=cur_finetune_batch_size, 
+                    shuffle=True
+                )
+
+                # Restore to the pre-trained state
+                pretrained_weights.restore(model_param_path, finetune_model)
+                # Send model to GPU
+                if cuda:
+                    finetune_model.cuda()
+    
+                # Freeze specified layers
+                if args.fine_tune_freeze_layer is not None:
+                    for param_name in args.fine_tune_freeze_layer:
+                        print(f'Freezing parameter: {param_name}')
+                        freeze_param(finetune_model, param_name)
+                if args.freeze_most_layers and args.fine_tune_freeze_layers_but is not None:
+                    freeze_all_param_but(finetune_model, args.fine_tune_freeze_layers_but)
+
+                # Train only the layers after the frozen ones, on cached outputs of the frozen ones
+                finetune_net = finetune_model
+                finetune_train_loader = cur_finetune_subj_train_subset_loader
+                finetune_valid_loader = finetune_subj_valid_loader
+                if use_early_stopping:
+                    finetune_es_valid_loader = finetune_subj_es_valid_loader
+                if args.cache_frozen_prefix:
+                    frozen_prefix, finetune_net = split_frozen_prefix(finetune_model)
+                    finetune_train_loader = cache_prefix_outputs(
+                        frozen_prefix, cur_finetune_subj_train_subset_loader, device, shuffle=True
+                    )
+                    if cached_valid_loader is None:
+                        cached_valid_loader = cache_prefix_outputs(frozen_prefix, finetune_subj_valid_loader, device)
+                    finetune_valid_loader = cached_valid_loader
+                    if use_early_stopping:
+                        if cached_es_valid_loader is None:
+                            cached_es_valid_loader = cache_prefix_outputs(
+                                frozen_prefix, finetune_subj_es_valid_loader, device
+                            )
+                        finetune_es_valid_loader = cached_es_valid_loader
+
+                # Continue training / fine tuning
                 print(
-                    f"Train Accuracy: {100 * train_accuracy:.2f}%, "
-                    f"Average Train Loss: {train_loss:.6f}, "
-                    f"Test Accuracy: {100 * test_accuracy:.1f}%, "
-                    f"Average Test Loss: {test_loss:.6f}\n"
+                    f'Fine tuning model for subject {holdout_subj_id} ' +
+                    f'with {len(cur_finetune_subj_train_subset)} trials (repetition {i})' +
+                    f'with lr = {args.fine_tune_lr:.5f}'
+                )
+
+                finetune_optimizer = torch.optim.AdamW(
+                    trainable_parameters(finetune_model),
+                    lr=args.fine_tune_lr, 
+                    weight_decay=args.fine_tune_weight_decay
+                )
+                finetune_scheduler = make_lr_scheduler(
+                    finetune_optimizer,
+                    args.lr_schedule,
+                    args.fine_tune_n_epochs,
+                    cur_finetune_subj_train_subset_loader,
+                    args.accumulation_steps,
+                    args.warmup_fraction
                 )
+                finetune_scaler = make_grad_scaler(args.precision, device)
+
+                test_accuracy_lst = []
+                early_stopping = make_early_stopping(finetune_model, args)
+                for epoch in range(1, args.fine_tune_n_epochs + 1):
+                    print(f"Epoch {epoch}/{args.fine_tune_n_epochs}: ", end="")
+
+                    train_loss, train_accuracy = train_one_epoch(
+                        finetune_train_loader, 
+                        finetune_net, 
+                        loss_fn, 
+                        finetune_optimizer, 
+                        finetune_scheduler, 
+                        epoch, 
+                        device,
+                        precision=args.precision,
+                        scaler=finetune_scaler,
+                        accumulation_steps=args.accumulation_steps
+                    )
+                    test_loss, test_accuracy = test_model(
+                        finetune_valid_loader, 
+                        finetune_net, 
+                        loss_fn
+                    )
+                    test_accuracy_lst.append(test_accuracy)
+
+                    if early_stopping is not None:
+                        _, valid_accuracy = test_model(
+                            finetune_es_valid_loader, 
+                            finetune_net, 
+                            loss_fn,
+                            print_batch_stats=False
+                        )
+                        if early_stopping.step(valid_accuracy, epoch, train_loss):
+                            break
+
+                    print(
+                        f"Train Accuracy: {100 * train_accuracy:.2f}%, "
+                        f"Average Train Loss: {train_loss:.6f}, "
+                        f"Test Accuracy: {100 * test_accuracy:.1f}%, "
+                        f"Average Test Loss: {test_loss:.6f}\n"
+                    )
         
-            final_accuracy_lst.append(np.mean(test_accuracy_lst[-5:]))
-            # Save weights of the classifier after fine tuning
-            final_tensor_lst.append(finetune_model.final_layer.conv_classifier.weight.clone().detach())
+                if early_stopping is None:
+                    final_accuracy_lst.append(np.mean(test_accuracy_lst[-5:]))
+                    stopped_epoch_lst.append(args.fine_tune_n_epochs)
+                else:
+                    # test accuracy of the restored best weights
+                    early_stopping.restore()
+                    _, restored_test_accuracy = test_model(
+                        finetune_valid_loader, 
+                        finetune_net, 
+                        loss_fn
+                    )
+                    final_accuracy_lst.append(restored_test_accuracy)
+                    stopped_epoch_lst.append(epoch)
+                # Save weights of the classifier after fine tuning
+                final_tensor_lst.append(finetune_model.final_layer.conv_classifier.weight.clone().detach())
 
         dict_subj_results.update(
             {
@@ -488,7 +668,8 @@ for holdout_subj_id in subject_ids_lst:
         dict_subj_intermediate_outputs.update(
             {
                 finetune_training_data_amount: {
-                    'final_tensor': final_tensor_lst
+                    'final_tensor': final_tensor_lst,
+                    'stopped_epoch': stopped_epoch_lst
                 }
             }
         )
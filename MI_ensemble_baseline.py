@@ -19,6 +19,8 @@ from utils import (
     import_model, parse_training_config, 
     train_one_epoch, test_model
 )
+from replica_training import StackedReplicas, evaluate_replicas
+from models.EnsembleBCI import EnsembleBCI, log_variance_embedding
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -99,6 +101,10 @@ experiment_folder_name = f'Ensemble_baseline_{args.experiment_version}'
 os.makedirs(os.path.join(dir_results, experiment_folder_name), exist_ok=True)
 training_record_path = os.path.join(dir_results, f'{experiment_folder_name}/', 'training.pkl')
 results_file_path = os.path.join(dir_results, f'{experiment_folder_name}/', 'results.pkl')
+ensemble_results_file_path = os.path.join(dir_results, f'{experiment_folder_name}/', 'ensemble_results.pkl')
+ensemble_bci_results_file_path = os.path.join(
+    dir_results, f'{experiment_folder_name}/', f'ensemble_bci_{args.ensemble_weighting}_results.pkl'
+)
 
 ### ----------------------------- Create model -----------------------------
 # Specify which GPU to run on to avoid collisions
@@ -221,9 +227,29 @@ for subject_id in subject_ids_lst:
 
 ### ----------------------------- Testing -----------------------------
 '''
-For each subject, try everyone else's model
+For each subject, try everyone else's model, and the ensemble of everyone else's models.
+All source models are loaded once and stacked, so each target subject's test set goes
+through all of them in a single pass
 '''
+source_model_lst = []
+for other_subject_id in subject_ids_lst:
+    other_subject_model = ShallowFBCSPNet(
+        n_chans,
+        args.n_classes,
+        input_window_samples=input_window_samples,
+        final_conv_length="auto"
+    )
+    other_subject_model_param_path = os.path.join(
+        dir_results, 
+        f'{experiment_folder_name}/', 
+        f'subject_{other_subject_id}_model_params.pth'
+    )
+    other_subject_model.load_state_dict(torch.load(other_subject_model_param_path, map_location=device))
+    source_model_lst.append(other_subject_model.to(device).eval())
+source_models = StackedReplicas.from_models(source_model_lst)
+
 dict_results = {}
+dict_ensemble_results = {}
 for subject_id in subject_ids_lst:
 
     print(f'Testing with data from target subject {subject_id}')
@@ -235,46 +261,104 @@ for subject_id in subject_ids_lst:
         batch_size = args.batch_size
     )
 
-    test_accuracy_by_other_subject = []
-    for other_subject_id in subject_ids_lst:
-
-        # if other_subject_id == subject_id:
-        #     test_accuracy_by_other_subject.append(1)
-        #     continue
-
-        print(f'Using model from source subject {other_subject_id}')
-
-        other_subject_model = ShallowFBCSPNet(
-            n_chans,
-            args.n_classes,
-            input_window_samples=input_window_samples,
-            final_conv_length="auto"
-        )
-        other_subject_model_param_path = os.path.join(
-            dir_results, 
-            f'{experiment_folder_name}/', 
-            f'subject_{other_subject_id}_model_params.pth'
-        )
-        other_subject_model.load_state_dict(torch.load(other_subject_model_param_path))
-        if cuda:
-            other_subject_model.cuda()
-
-        loss_fn = torch.nn.NLLLoss()
-        _, test_accuracy = test_model(
-            subject_test_loader, 
-            other_subject_model, 
-            loss_fn,
-            print_batch_stats=False
-        )
-        test_accuracy_by_other_subject.append(test_accuracy)
+    # The ensemble averages the outputs of all source models but the target subject's own
+    test_accuracy_by_other_subject, ensemble_test_accuracy = evaluate_replicas(
+        subject_test_loader, 
+        source_models, 
+        device, 
+        ensemble_mask=[other_subject_id != subject_id for other_subject_id in subject_ids_lst]
+    )
+    print(
+        f"Test Accuracy: {', '.join(f'{100 * acc:.1f}%' for acc in test_accuracy_by_other_subject)}, "
+        f"Ensemble Test Accuracy: {100 * ensemble_test_accuracy:.1f}%\n"
+    )
 
     dict_results.update({
         subject_id: test_accuracy_by_other_subject
     })
+    dict_ensemble_results.update({
+        subject_id: ensemble_test_accuracy
+    })
 
     if os.path.exists(results_file_path):
         os.remove(results_file_path)
     with open(results_file_path, 'wb') as f:
         pkl.dump(dict_results, f)
+    if os.path.exists(ensemble_results_file_path):
+        os.remove(ensemble_results_file_path)
+    with open(ensemble_results_file_path, 'wb') as f:
+        pkl.dump(dict_ensemble_results, f)
+
+### ----------------------------- Ensemble inference -----------------------------
+'''
+For each target subject, an EnsembleBCI of everyone else's model, weighted without any
+labeled target data, with at most ensemble_top_k members at inference
+'''
+# Source subject prototypes for similarity weighting, from each subject's training run
+source_prototypes = []
+for other_subject_id in subject_ids_lst:
+    other_subject_train_loader = DataLoader(
+        dataset_splitted_by_subject.get(f'{other_subject_id}').split('run').get('0train'),
+        batch_size = args.batch_size
+    )
+    source_prototypes.append(torch.cat([
+        log_variance_embedding(X.to(device)) for X, _, _ in other_subject_train_loader
+    ]).mean(0))
+source_prototypes = torch.stack(source_prototypes)
+
+dict_ensemble_bci_results = {}
+for target_idx, subject_id in enumerate(subject_ids_lst):
+
+    member_indices = [i for i in range(len(subject_ids_lst)) if i != target_idx]
+    # Accuracy of each member on the other source subjects (target and itself excluded)
+    member_accuracies = [
+        np.mean([
+            dict_results[other_subject_id][member_idx] for i, other_subject_id in enumerate(subject_ids_lst)
+            if i not in (target_idx, member_idx)
+        ]) for member_idx in member_indices
+    ]
+    ensemble = EnsembleBCI(
+        [source_model_lst[i] for i in member_indices],
+        weighting=args.ensemble_weighting,
+        member_accuracies=member_accuracies,
+        source_prototypes=source_prototypes[member_indices],
+        top_k=args.ensemble_top_k,
+        temperature=args.ensemble_temperature
+    ).to(device)
+
+    subject_dataset_splitted_by_run = dataset_splitted_by_subject.get(f'{subject_id}').split('run')
+    if args.ensemble_weighting == 'similarity':
+        # A few unlabeled trials of the target subject
+        X_unlabeled, _, _ = next(iter(DataLoader(
+            subject_dataset_splitted_by_run.get('0train'), 
+            batch_size=args.ensemble_n_unlabeled_trials
+        )))
+        ensemble.fit_weights(X_unlabeled.to(device))
+
+    subject_test_loader = DataLoader(
+        subject_dataset_splitted_by_run.get('1test'),
+        batch_size = args.batch_size
+    )
+    print(f'Ensemble of {len(ensemble.active_members)} source models for target subject {subject_id}')
+    loss_fn = torch.nn.NLLLoss()
+    _, ensemble_test_accuracy = test_model(
+        subject_test_loader, 
+        ensemble, 
+        loss_fn,
+        print_batch_stats=False
+    )
+
+    dict_ensemble_bci_results.update({
+        subject_id: {
+            'test_accuracy': ensemble_test_accuracy,
+            'member_subject_ids': [subject_ids_lst[i] for i in member_indices],
+            'member_weights': ensemble.all_member_weights().tolist()
+        }
+    })
+
+    if os.path.exists(ensemble_bci_results_file_path):
+        os.remove(ensemble_bci_results_file_path)
+    with open(ensemble_bci_results_file_path, 'wb') as f:
+        pkl.dump(dict_ensemble_bci_results, f)
 
-print('Experiment done')
\ No newline at end of file
+print('Experiment done')
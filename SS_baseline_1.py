@@ -15,13 +15,12 @@ from braindecode.preprocessing import create_windows_from_events
 from sklearn.preprocessing import scale as standard_scale
 from braindecode.util import set_random_seeds
 from braindecode.models import TimeDistributed
-from braindecode.samplers import SequenceSampler
 
-from sklearn.utils import compute_class_weight
 from skorch.helper import predefined_split
 from skorch.callbacks import EpochScoring
 
-from utils import get_subset, import_model, get_center_label, balanced_accuracy_multi, parse_training_config
+from utils import get_subset, import_model, balanced_accuracy_multi, parse_training_config, split_stats
+from sequence_dataset import WindowSequenceDataset
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -138,13 +137,11 @@ for subject_id, subject_dataset in windows_dataset.split('subject').items():
     test_set_size = int(len(subject_dataset) * test_percentage)
     train_set = get_subset(subject_dataset, target_trial_num=len(subject_dataset)-test_set_size)
     test_set = get_subset(subject_dataset, target_trial_num=test_set_size, from_back=True)
-    # Extract test sequences
-    test_sampler = SequenceSampler(
-        test_set.get_metadata(), n_windows, n_windows_stride, randomize=True
-    )
-    test_set.target_transform = get_center_label if model_name != 'USleep' else None
-    y_test = [test_set[idx][1] for idx in test_sampler] if model_name != 'USleep' else [test_set[idx][1][1] for idx in test_sampler]
-    new_class_weights = compute_class_weight('balanced', classes=np.unique(y_test), y=y_test)
+    # Extract test sequences, labels come from the metadata
+    test_seq_set = WindowSequenceDataset(test_set, n_windows, n_windows_stride, center_label=model_name != 'USleep')
+    # class weights from the label histogram of the test windows
+    test_stats = split_stats(test_set)
+    new_class_weights = test_stats.class_weights
 
     # Only update class_weights if generated weights for all classes
     if len(new_class_weights) == n_classes:
@@ -161,10 +158,7 @@ for subject_id, subject_dataset in windows_dataset.split('subject').items():
             # print(f'training_data_amount={training_data_amount}, train_set_size={train_set_size}')
             train_subset = get_subset(train_set, target_trial_num=int(training_data_amount), random_sample=False)
             # Extract train sequences
-            train_sampler = SequenceSampler(
-                train_subset.get_metadata(), n_windows, n_windows_stride, randomize=True
-            )
-            train_subset.target_transform = get_center_label if model_name != 'USleep' else None
+            train_seq_set = WindowSequenceDataset(train_subset, n_windows, n_windows_stride, center_label=model_name != 'USleep')
 
             # Create model
             model_kwargs = args.model_kwargs
@@ -191,7 +185,7 @@ for subject_id, subject_dataset in windows_dataset.split('subject').items():
             if cuda:
                 model.cuda()
 
-            print(f'Currently training for subject {subject_id} with {len(train_sampler)} sequences = {training_data_amount} trials (repetition {i})')
+            print(f'Currently training for subject {subject_id} with {len(train_seq_set)} sequences = {training_data_amount} trials (repetition {i})')
             
             batch_size = int(min(args.batch_size, training_data_amount // 2))
             
@@ -210,21 +204,19 @@ for subject_id, subject_dataset in windows_dataset.split('subject').items():
                 criterion=torch.nn.CrossEntropyLoss,
                 criterion__weight=torch.Tensor(class_weights).to(device),
                 optimizer=torch.optim.Adam,
-                iterator_train__shuffle=False,
-                iterator_train__sampler=train_sampler,
-                iterator_valid__sampler=test_sampler,
+                iterator_train__shuffle=True,
                 # using valid_set for validation
-                train_split=predefined_split(test_set),  
+                train_split=predefined_split(test_seq_set),  
                 optimizer__lr=lr,
                 batch_size=batch_size,
                 callbacks=callbacks,
                 device=device,
-                classes=np.unique(y_test),
+                classes=test_stats.classes,
             )
             # Deactivate the default valid_acc callback. USleep wouldn't work without this line
             clf.set_params(callbacks__valid_acc=None)
             # Train model
-            clf.fit(train_subset, y=None, epochs=n_epochs)
+            clf.fit(train_seq_set, y=None, epochs=n_epochs)
 
             # Get final accuracy
             results_columns = ['valid_bal_acc',]
@@ -9,23 +9,21 @@ import torch
 from torch import nn
 
 from braindecode import EEGClassifier
-from braindecode.datasets import SleepPhysionet, BaseConcatDataset
-from braindecode.preprocessing import preprocess, Preprocessor
-from braindecode.preprocessing import create_windows_from_events
-from sklearn.preprocessing import scale as standard_scale
+from braindecode.datasets import BaseConcatDataset
 from braindecode.util import set_random_seeds
 from braindecode.models import TimeDistributed
-from braindecode.samplers import SequenceSampler
 
-from sklearn.utils import compute_class_weight
 from skorch.helper import predefined_split
 from skorch.callbacks import EpochScoring
 
 from utils import (
-    get_subset, import_model, get_center_label, 
+    get_subset, import_model, 
     balanced_accuracy_multi, parse_training_config, 
-    freeze_all_param_but, clf_predict_on_set, freeze_param
+    freeze_all_param_but, clf_predict_on_set, freeze_param,
+    split_stats
 )
+from sequence_dataset import WindowSequenceDataset
+from window_store import ingest_sleep_physionet
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -35,12 +33,6 @@ args = parse_training_config()
 model_name = args.model_name
 model_object = import_model(model_name)
 dataset_name = args.dataset_name
-dataset = SleepPhysionet(subject_ids=range(79), recording_ids=[1, 2,], crop_wake_mins=30)
-# Test with a few subjects first
-# dataset = SleepPhysionet(subject_ids=[0, 1, 2], recording_ids=[2,], crop_wake_mins=30)
-
-print('Data loaded')
-
 experiment_version = args.experiment_version
 results_file_name = f'{model_name}_{dataset_name}_fine_tune_{experiment_version}'
 # used to store pre-trained model parameters
@@ -69,47 +61,24 @@ elif data_amount_unit == 'min':
 
 significance_level = args.significance_level
 
-### ----------------------------- Preprocessing -----------------------------
-high_cut_hz = 30
-factor = 1e6
-
-preprocessors = [
-    # Convert from V to uV
-    Preprocessor(lambda data: np.multiply(data, factor), apply_on_array=True), 
-    # filtering 
-    Preprocessor('filter', l_freq=None, h_freq=high_cut_hz)
-]
-
-# Transform the data
-preprocess(dataset, preprocessors)
-
-### ----------------------------- Extract trial windows -----------------------------
-# We merge stages 3 and 4 following AASM standards.
-mapping = {  
-    'Sleep stage W': 0,
-    'Sleep stage 1': 1,
-    'Sleep stage 2': 2,
-    'Sleep stage 3': 3,
-    'Sleep stage 4': 3,
-    'Sleep stage R': 4
-}
-
-window_size_s = trial_len_sec
-sfreq = 100
-window_size_samples = window_size_s * sfreq
-
-windows_dataset = create_windows_from_events(
-    dataset,
-    trial_start_offset_samples=0,
-    trial_stop_offset_samples=0,
-    window_size_samples=window_size_samples,
-    window_stride_samples=window_size_samples,
-    picks="Fpz-Cz" if model_name == 'SleepStagerEldele2021' else None,
-    preload=True,
-    mapping=mapping
+### ----------------------------- Preprocess and extract trial windows -----------------------------
+# Each night is filtered, windowed and scaled on its own and saved to the window store;
+# nights already in the store are not processed again. Stages 3 and 4 are merged (AASM).
+# Test with a few subjects first: subject_ids=[0, 1, 2]
+windows_dataset = ingest_sleep_physionet(
+    args.window_store_dir,
+    subject_ids=range(79),
+    recording_ids=[1, 2,],
+    crop_wake_mins=30,
+    high_cut_hz=30,
+    factor=1e6,
+    window_size_s=trial_len_sec,
+    n_jobs=args.n_jobs,
+    picks="Fpz-Cz" if model_name == 'SleepStagerEldele2021' else None
 )
-# window preprocessing
-preprocess(windows_dataset, [Preprocessor(standard_scale, channel_wise=True)])
+sfreq = windows_dataset.datasets[0].raw.info['sfreq']
+
+print('Data loaded')
 
 ### ----------------------------- Create model -----------------------------
 # Specify which GPU to run on to avoid collisions
@@ -155,22 +124,17 @@ for holdout_subj_id in subject_ids_lst:
     pre_train_train_set = get_subset(pre_train_set, target_trial_num=len(pre_train_set)-pre_train_test_set_size)
     pre_train_test_set = get_subset(pre_train_set, target_trial_num=pre_train_test_set_size, from_back=True)
 
-    # Extract sequences
-    pre_train_train_sampler = SequenceSampler(
-        pre_train_train_set.get_metadata(), n_windows, n_windows_stride, randomize=True
+    # Extract sequences, labels come from the metadata
+    pre_train_train_seq_set = WindowSequenceDataset(
+        pre_train_train_set, n_windows, n_windows_stride, center_label=model_name != 'USleep'
     )
-    pre_train_train_set.target_transform = get_center_label if model_name != 'USleep' else None
-    pre_train_test_sampler = SequenceSampler(
-        pre_train_test_set.get_metadata(), n_windows, n_windows_stride, randomize=True
+    pre_train_test_seq_set = WindowSequenceDataset(
+        pre_train_test_set, n_windows, n_windows_stride, center_label=model_name != 'USleep'
     )
-    pre_train_test_set.target_transform = get_center_label if model_name != 'USleep' else None
 
-    if model_name != 'USleep':
-        y_pre_train_test = [pre_train_test_set[idx][1] for idx in pre_train_test_sampler] 
-    else:
-        y_pre_train_test = [pre_train_test_set[idx][1][1] for idx in pre_train_test_sampler]
-
-    new_class_weights = compute_class_weight('balanced', classes=np.unique(y_pre_train_test), y=y_pre_train_test)
+    # class weights from the label histogram of the test windows
+    pre_train_test_stats = split_stats(pre_train_test_set)
+    new_class_weights = pre_train_test_stats.class_weights
     # Only update class_weights if generated weights for all classes
     if len(new_class_weights) == n_classes:
         class_weights = new_class_weights
@@ -215,16 +179,14 @@ for holdout_subj_id in subject_ids_lst:
         criterion=torch.nn.CrossEntropyLoss,
         criterion__weight=torch.Tensor(class_weights).to(device),
         optimizer=torch.optim.Adam,
-        iterator_train__shuffle=False,
-        iterator_train__sampler=pre_train_train_sampler,
-        iterator_valid__sampler=pre_train_test_sampler,
+        iterator_train__shuffle=True,
         # using valid_set for validation
-        train_split=predefined_split(pre_train_test_set),  
+        train_split=predefined_split(pre_train_test_seq_set),  
         optimizer__lr=lr,
         batch_size=batch_size,
         callbacks=callbacks,
         device=device,
-        classes=np.unique(y_pre_train_test),
+        classes=pre_train_test_stats.classes,
     )
     pre_train_clf.initialize()
 
@@ -246,12 +208,12 @@ for holdout_subj_id in subject_ids_lst:
         )
     else:
         ### ---------- Pre-training ----------
-        print(f'Currently pre-training model with data from all subjects {len(pre_train_train_sampler)} ' + 
+        print(f'Currently pre-training model with data from all subjects {len(pre_train_train_seq_set)} ' + 
               f'sequences = {len(pre_train_train_set)} ' +
               f'trials but holding out {holdout_subj_id}')
         # Deactivate the default valid_acc callback. USleep wouldn't work without this line
         pre_train_clf.set_params(callbacks__valid_acc=None)
-        _ = pre_train_clf.fit(pre_train_train_set, y=None, epochs=n_epochs)
+        _ = pre_train_clf.fit(pre_train_train_seq_set, y=None, epochs=n_epochs)
         pre_train_clf.save_params(
             f_params=os.path.join(dir_results, f'{temp_exp_name}_without_subj_{holdout_subj_id}_model.pkl'), 
             f_optimizer=os.path.join(dir_results, f'{temp_exp_name}_without_subj_{holdout_subj_id}_opt.pkl'), 
@@ -271,17 +233,13 @@ for holdout_subj_id in subject_ids_lst:
     fine_tune_test_set = get_subset(fine_tune_set, target_trial_num=fine_tune_test_set_size, from_back=True)
     
     # Extract fine_tune_test_set sequences
-    fine_tune_test_sampler = SequenceSampler(
-        fine_tune_test_set.get_metadata(), n_windows, n_windows_stride, randomize=True
+    fine_tune_test_seq_set = WindowSequenceDataset(
+        fine_tune_test_set, n_windows, n_windows_stride, center_label=model_name != 'USleep'
     )
-    fine_tune_test_set.target_transform = get_center_label if model_name != 'USleep' else None
-
-    if model_name != 'USleep':
-        y_fine_tune_test = [fine_tune_test_set[idx][1] for idx in fine_tune_test_sampler] 
-    else:
-        y_fine_tune_test = [fine_tune_test_set[idx][1][1] for idx in fine_tune_test_sampler]
 
-    new_class_weights = compute_class_weight('balanced', classes=np.unique(y_fine_tune_test), y=y_fine_tune_test)
+    # class weights from the label histogram of the test windows
+    fine_tune_test_stats = split_stats(fine_tune_test_set)
+    new_class_weights = fine_tune_test_stats.class_weights
     # Only update class_weights if generated weights for all classes
     if len(new_class_weights) == n_classes:
         class_weights = new_class_weights
@@ -292,7 +250,7 @@ for holdout_subj_id in subject_ids_lst:
     ### ---------- Fine tuning ----------
     # dict_subj_results = {0: [finetune_baseline_acc,]}
     dict_subj_results = {}
-    fine_tune_train_set_size = len(fine_tune_train_set.get_metadata())
+    fine_tune_train_set_size = split_stats(fine_tune_train_set).n_trials
     for fine_tune_data_amount in data_amount_start + np.arange(0, 1 + (fine_tune_train_set_size - data_amount_start) // data_amount_step) * data_amount_step:
         
         final_accuracy = []
@@ -301,11 +259,10 @@ for holdout_subj_id in subject_ids_lst:
             # Finetune with a subset of fine_tune_train_set
             fine_tune_train_subset = get_subset(fine_tune_train_set, target_trial_num=int(fine_tune_data_amount), random_sample=False)
 
-            # Extract fine_tune_test_set sequences
-            fine_tune_train_subset_sampler = SequenceSampler(
-                fine_tune_train_subset.get_metadata(), n_windows, n_windows_stride, randomize=True
+            # Extract fine_tune_train_subset sequences
+            fine_tune_train_subset_seq_set = WindowSequenceDataset(
+                fine_tune_train_subset, n_windows, n_windows_stride, center_label=model_name != 'USleep'
             )
-            fine_tune_train_subset.target_transform = get_center_label if model_name != 'USleep' else None
 
             fine_tune_model = model_object(
                 n_chans = n_channels,
@@ -335,15 +292,13 @@ for holdout_subj_id in subject_ids_lst:
                 criterion=torch.nn.CrossEntropyLoss,
                 criterion__weight=torch.Tensor(class_weights).to(device),
                 optimizer=torch.optim.Adam,
-                iterator_train__shuffle=False,
-                iterator_train__sampler=fine_tune_train_subset_sampler,
-                iterator_valid__sampler=fine_tune_test_sampler,
-                train_split=predefined_split(fine_tune_test_set),  
+                iterator_train__shuffle=True,
+                train_split=predefined_split(fine_tune_test_seq_set),  
                 optimizer__lr=args.fine_tune_lr,
                 batch_size=int(min(batch_size, fine_tune_data_amount // 2)),
                 callbacks=callbacks,
                 device=device,
-                classes=np.unique(y_fine_tune_test),
+                classes=fine_tune_test_stats.classes,
             )
             fine_tune_clf.initialize()
 
@@ -369,9 +324,9 @@ for holdout_subj_id in subject_ids_lst:
 
             # Continue training / finetuning
             print(f'Fine tuning model for subject {holdout_subj_id} ' +
-                  f'with {len(fine_tune_train_subset_sampler)} sequences ' +
+                  f'with {len(fine_tune_train_subset_seq_set)} sequences ' +
                   f'= {len(fine_tune_train_subset)} trials (repetition {i})')
-            _ = fine_tune_clf.partial_fit(fine_tune_train_subset, y=None, epochs=args.fine_tune_n_epochs)
+            _ = fine_tune_clf.partial_fit(fine_tune_train_subset_seq_set, y=None, epochs=args.fine_tune_n_epochs)
 
             # Get final accuracy
             results_columns = ['valid_bal_acc',]
@@ -1,3 +1,4 @@
+import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -6,7 +7,7 @@ from models import classifier, Temporal_Imputer, masking
 from loss import EntropyLoss, CrossEntropyLabelSmooth, evidential_uncertainty, evident_dl
 from scipy.spatial.distance import cdist
 from torch.optim.lr_scheduler import StepLR
-from copy import deepcopy
+from utils import ModelCheckpointer
 
 ## The unsupervised adaptation algorithms
 class Algorithm(torch.nn.Module):
@@ -68,7 +69,34 @@ class MAPU(Algorithm):
             epsilon=0.1
         )
 
-    def pretrain(self, src_dataloader, avg_meter):
+    def extract_clean_and_masked(self, x, masked_x):
+        """
+        Extract (features, sequence features) for the clean and the masked input.
+        With hparams['single_pass_masking'] both go through the feature extractor
+        as one concatenated batch, otherwise as two separate forward passes.
+        """
+        if not self.hparams.get('single_pass_masking', False):
+            return self.feature_extractor(x), self.feature_extractor(masked_x)
+
+        batch_size = x.shape[0]
+        outputs = self.feature_extractor(torch.cat((x, masked_x)))
+        return (
+            tuple(out[:batch_size] for out in outputs),
+            tuple(out[batch_size:] for out in outputs)
+        )
+
+    def pretrain(self, src_dataloader, avg_meter, cache_path=None):
+        """
+        Train on the source domain. If cache_path is given and exists, the network and 
+        temporal verifier are loaded from it and training is skipped; otherwise they are 
+        saved there after training. The caller keys cache_path by content, e.g. with 
+        utils.hash_pretrain_config over source subjects, self.hparams and seed.
+        """
+        if cache_path is not None and os.path.exists(cache_path):
+            cached = torch.load(cache_path, map_location=self.device)
+            self.network.load_state_dict(cached['network'])
+            self.temporal_verifier.load_state_dict(cached['temporal_verifier'])
+            return cached['network']
 
         for epoch in range(1, self.hparams["num_epochs"] + 1):
             for step, (src_x, src_y, _) in enumerate(src_dataloader):
@@ -78,12 +106,11 @@ class MAPU(Algorithm):
                 self.pre_optimizer.zero_grad()
                 self.tov_optimizer.zero_grad()
 
-                # forward pass correct sequences
-                src_feat, seq_src_feat = self.feature_extractor(src_x)
-
                 # masking the input_sequences
                 masked_data, mask = masking(src_x, num_splits=8, num_masked=1)
-                src_feat_mask, seq_src_feat_mask = self.feature_extractor(masked_data)
+                # forward pass correct and masked sequences
+                (src_feat, seq_src_feat), (src_feat_mask, seq_src_feat_mask) = \
+                    self.extract_clean_and_masked(src_x, masked_data)
 
                 ''' Temporal order verification  '''
                 # pass the data with and without detach
@@ -111,15 +138,23 @@ class MAPU(Algorithm):
             for key, val in avg_meter.items():
                 print(f'{key}\t: {val.avg:2.4f}')
             print(f'-------------------------------------')
-        src_only_model = deepcopy(self.network.state_dict())
+        src_only_model = {name: tensor.detach().clone() for name, tensor in self.network.state_dict().items()}
+        if cache_path is not None:
+            torch.save({
+                'network': src_only_model,
+                'temporal_verifier': self.temporal_verifier.state_dict()
+            }, cache_path)
         return src_only_model
 
-    def update(self, trg_dataloader, avg_meter):
-
-        # defining best and last model
-        best_src_risk = float('inf')
-        best_model = self.network.state_dict()
-        last_model = self.network.state_dict()
+    def update(self, trg_dataloader, avg_meter, val_fn=None, eval_every=10):
+        """
+        Adapt to the target domain. The best model is selected every eval_every epochs and 
+        at the last epoch by val_fn(network) -> metric (lower is better) if supplied, otherwise by the 
+        epoch-average target risk (entropy + TOV objective). With hparams['ema_decay'] 
+        an EMA of the weights is kept as well, available as self.checkpointer.ema.
+        """
+        # best weights go into preallocated shadow tensors instead of deep copies
+        self.checkpointer = ModelCheckpointer(self.network, ema_decay=self.hparams.get('ema_decay'))
 
         # freeze both classifier and ood detector
         for k, v in self.classifier.named_parameters():
@@ -130,6 +165,7 @@ class MAPU(Algorithm):
         # obtain pseudo labels
         for epoch in range(1, self.hparams["num_epochs"] + 1):
 
+            epoch_trg_risk = torch.zeros((), device=self.device)
             for step, (trg_x, _, trg_idx) in enumerate(trg_dataloader):
 
                 trg_x = trg_x.float().to(self.device)
@@ -138,10 +174,9 @@ class MAPU(Algorithm):
                 self.tov_optimizer.zero_grad()
 
                 # extract features
-                trg_feat, trg_feat_seq = self.feature_extractor(trg_x)
-
                 masked_data, mask = masking(trg_x, num_splits=8, num_masked=1)
-                trg_feat_mask, seq_trg_feat_mask = self.feature_extractor(masked_data)
+                (trg_feat, trg_feat_seq), (trg_feat_mask, seq_trg_feat_mask) = \
+                    self.extract_clean_and_masked(trg_x, masked_data)
 
                 tov_predictions = self.temporal_verifier(seq_trg_feat_mask)
                 tov_loss = self.mse_loss(tov_predictions, trg_feat_seq)
@@ -168,6 +203,8 @@ class MAPU(Algorithm):
                 loss.backward()
                 self.optimizer.step()
                 self.tov_optimizer.step()
+                self.checkpointer.update_ema()
+                epoch_trg_risk += loss.detach()
 
                 losses = {'entropy_loss': trg_ent.detach().item(), 'Masking_loss': tov_loss.detach().item()}
                 for key, val in losses.items():
@@ -175,16 +212,22 @@ class MAPU(Algorithm):
 
             self.lr_scheduler.step()
 
-            # saving the best model based on src risk
-            if (epoch + 1) % 10 == 0 and avg_meter['Src_cls_loss'].avg < best_src_risk:
-                best_src_risk = avg_meter['Src_cls_loss'].avg
-                best_model = deepcopy(self.network.state_dict())
+            # saving the best model based on the validation hook or target risk; the last
+            # epoch is always a candidate, so trailing epochs (or runs shorter than eval_every) count
+            if epoch % eval_every == 0 or epoch == self.hparams["num_epochs"]:
+                if val_fn is not None:
+                    metric = val_fn(self.network)
+                else:
+                    metric = epoch_trg_risk.item() / len(trg_dataloader)
+                self.checkpointer.step(metric, epoch)
 
             print(f'[Epoch : {epoch}/{self.hparams["num_epochs"]}]')
             for key, val in avg_meter.items():
                 print(f'{key}\t: {val.avg:2.4f}')
             print(f'-------------------------------------')
 
+        last_model = self.network.state_dict()
+        best_model = self.checkpointer.best
         return last_model, best_model
 
 # class SHOT(Algorithm):
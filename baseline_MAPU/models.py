@@ -85,6 +85,7 @@ class ShallowFBCSPFeatureExtractor(torch.nn.Module):
         super(ShallowFBCSPFeatureExtractor, self).__init__()  
         self.features = None  # To store the output of the hooked layer
         self.logits = None    # To store the logits from the conv_classifier layer
+        self.masked_logits = None  # Logits of the masked half in forward_clean_and_masked
         
         self.model = ShallowFBCSPNet(
             sample_shape[0],
@@ -109,6 +110,31 @@ class ShallowFBCSPFeatureExtractor(torch.nn.Module):
         prediction = self.model(x)
         return self.features, prediction
 
+    def forward_clean_and_masked(self, x, masked_x):
+        """
+        Run clean and masked inputs through the network in one forward pass and split
+        the hooked features, predictions and logits back into the two halves.
+        In training mode batch norm statistics are computed over the doubled batch.
+
+        Parameters
+        ---------------------------------------
+        x: torch tensor, has shape: (batch_size, *sample_shape)
+        masked_x: torch tensor, masked version of x with the same shape
+
+        return
+        ---------------------------------------
+        (features, prediction), (masked_features, masked_prediction)
+        """
+        batch_size = x.shape[0]
+        features, prediction = self(torch.cat((x, masked_x)))
+        # self.logits holds the clean half so callers can keep reading it after the call
+        self.masked_logits = self.logits[batch_size:]
+        self.logits = self.logits[:batch_size]
+        return (
+            (features[:batch_size], prediction[:batch_size]),
+            (features[batch_size:], prediction[batch_size:])
+        )
+
     def close_hooks(self):
         self.hook.remove()
         self.logits_hook.remove()
@@ -126,51 +152,102 @@ class classifier(nn.Module):
         return predictions
     
 ## Temporal Imputer
-class Temporal_Imputer(nn.Module):
-    def __init__(self, configs):
-        super(Temporal_Imputer, self).__init__()
-        self.seq_length = configs.features_len
-        self.num_channels = configs.final_out_channels
-        self.hid_dim = configs.AR_hid_dim
-        self.rnn = nn.LSTM(input_size=self.num_channels, hidden_size=self.hid_dim)
-
-    def forward(self, x):
-        x = x.view(x.size(0), -1, self.num_channels)
-        out, (h, c) = self.rnn(x)
-        out = out.view(x.size(0), self.num_channels, -1)
-        # take the last time step
-        return out
-
 ## not using the config object
 class myTemporal_Imputer(torch.nn.Module):
+    """
+    Predicts the features of the full signal from the features of the masked signal,
+    scanning over the temporal axis of the feature map. All samples in the batch are
+    processed in parallel.
+
+    imputer_type selects the temporal model, all with the same input / output shapes:
+    'lstm' (default), 'gru', or 'conv' (1D convolution over time, no recurrence and 
+    therefore the cheapest on CPU).
+    """
     # hidden dimension should be the same as final out channels
-    def __init__(self, final_out_channels, AR_hid_dim):
+    def __init__(self, final_out_channels, AR_hid_dim, imputer_type='lstm', kernel_size=5):
         super(myTemporal_Imputer, self).__init__()
         self.num_channels = final_out_channels
         self.hid_dim = AR_hid_dim
-        self.rnn = torch.nn.LSTM(input_size=self.num_channels, hidden_size=self.hid_dim)
+        self.imputer_type = imputer_type
+        match imputer_type:
+            case 'lstm':
+                self.rnn = torch.nn.LSTM(input_size=self.num_channels, hidden_size=self.hid_dim, batch_first=True)
+            case 'gru':
+                self.rnn = torch.nn.GRU(input_size=self.num_channels, hidden_size=self.hid_dim, batch_first=True)
+            case 'conv':
+                self.rnn = torch.nn.Conv1d(self.num_channels, self.hid_dim, kernel_size, padding=kernel_size // 2)
+            case _:
+                raise ValueError(f'Imputer type {imputer_type} is not defined.')
 
     def forward(self, x):
-        x = x.view(x.size(0), -1, self.num_channels)
-        out, (h, c) = self.rnn(x)
-        out = out.view(x.size(0), self.num_channels, -1)
-        # take the last time step
-        return out
+        """
+        Parameters
+        ---------------------------------------
+        x: torch tensor, has shape: (batch_size, num_channels, seq_length), trailing 
+        singleton dimensions are flattened into seq_length
+
+        return
+        ---------------------------------------
+        out: imputed features, has shape: (batch_size, hid_dim, seq_length)
+        """
+        x = x.reshape(x.size(0), self.num_channels, -1)
+        if self.imputer_type == 'conv':
+            return self.rnn(x)
+
+        # keep the recurrent weights in one contiguous block for the fused (cuDNN) kernel
+        self.rnn.flatten_parameters()
+        # recur over time, not over the batch: (batch_size, seq_length, num_channels)
+        out, _ = self.rnn(x.transpose(1, 2))
+        return out.transpose(1, 2)
+
+
+class Temporal_Imputer(myTemporal_Imputer):
+    def __init__(self, configs):
+        super(Temporal_Imputer, self).__init__(
+            configs.final_out_channels, 
+            configs.AR_hid_dim, 
+            imputer_type=getattr(configs, 'imputer_type', 'lstm')
+        )
+        self.seq_length = configs.features_len
 
 # temporal masking
-def masking(x, num_splits=8, num_masked=4):
+def masking(x, num_splits=8, num_masked=4, out=None):
+    """
+    Randomly zero out num_masked of num_splits temporal patches in every channel.
+    The same patches are masked for all samples in the batch, a different random
+    set of patches for each channel.
+
+    Parameters
+    ---------------------------------------
+    x: torch tensor, has shape: (batch_size, n_chans, n_times). n_times must be
+    divisible by num_splits
+    out: optional tuple of preallocated (masked_x, mask) tensors to write into,
+    with the same shapes as the returned ones
+
+    return
+    ---------------------------------------
+    masked_x: x with the selected patches zeroed, has shape: (batch_size, n_chans, n_times)
+    mask: content of the selected patches, has shape: (batch_size, n_chans, num_masked * patch_len)
+    """
     # num_masked = int(masking_ratio * num_splits)
     patches = rearrange(x, 'a b (p l) -> a b p l', p=num_splits)
-    masked_patches = patches.clone()  # deepcopy(patches)
+    batch_size, n_chans, _, patch_len = patches.shape
     # calculate of patches needed to be masked, and get random indices, dividing it up for mask vs unmasked
-    rand_indices = torch.rand(x.shape[1], num_splits).argsort(dim=-1)
-    selected_indices = rand_indices[:, :num_masked]
-    masks = []
-    for i in range(masked_patches.shape[1]):
-        masks.append(masked_patches[:, i, (selected_indices[i, :]), :])
-        masked_patches[:, i, (selected_indices[i, :]), :] = 0
-        # orig_patches[:, i, (selected_indices[i, :]), :] =
-    mask = rearrange(torch.stack(masks), 'b a p l -> a b (p l)')
-    masked_x = rearrange(masked_patches, 'a b p l -> a b (p l)', p=num_splits)
-
-    return masked_x, mask
\ No newline at end of file
+    # (drawn on CPU as before so the random stream doesn't depend on the device)
+    rand_indices = torch.rand(n_chans, num_splits).argsort(dim=-1)
+    selected_indices = rand_indices[:, :num_masked].to(x.device)
+    # channel x patch boolean mask, True where the patch is masked
+    patch_mask = torch.zeros(n_chans, num_splits, dtype=torch.bool, device=x.device)
+    patch_mask.scatter_(1, selected_indices, True)
+    keep = (~patch_mask).to(x.dtype)[None, :, :, None]
+    gather_indices = selected_indices[None, :, :, None].expand(batch_size, -1, -1, patch_len)
+
+    if out is None:
+        masked_x = rearrange(patches * keep, 'a b p l -> a b (p l)')
+        mask = rearrange(torch.gather(patches, 2, gather_indices), 'a b p l -> a b (p l)')
+    else:
+        masked_x, mask = out
+        torch.mul(patches, keep, out=masked_x.view(batch_size, n_chans, num_splits, patch_len))
+        torch.gather(patches, 2, gather_indices, out=mask.view(batch_size, n_chans, num_masked, patch_len))
+
+    return masked_x, mask
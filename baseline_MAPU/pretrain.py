@@ -0,0 +1,129 @@
+import os
+import torch
+
+from baseline_MAPU.models import masking
+
+# Source files of the pretraining code, part of the pretrain cache key (utils.hash_pretrain_config).
+# Only these: edits elsewhere in the drivers don't invalidate cached source models
+PRETRAIN_CODE_PATHS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+    for file_name in ['pretrain.py', 'models.py', 'loss.py']
+]
+
+
+def pretrain_source_model(
+        network,
+        temporal_verifier,
+        src_pretrain_loader,
+        src_valid_loader,
+        pretrain_optimizer,
+        tov_optimizer,
+        cross_entropy,
+        mse_loss,
+        n_epochs,
+        device,
+        add_tov_loss=True,
+        single_pass_masking=False
+    ) -> dict:
+    """
+    Train the network (feature extractor + classifier) on the source data, with the temporal
+    order verification (tov) loss of the temporal verifier if add_tov_loss. Shared by the
+    one-to-one and multi-to-one MAPU drivers.
+
+    Parameters
+    ---------------------------------------
+    temporal_verifier, tov_optimizer: None if not add_tov_loss
+    single_pass_masking: run the clean and masked inputs through the network in one
+    forward pass
+
+    return
+    ---------------------------------------
+    dict of per-epoch 'pretrain_test_acc', 'pretrain_train_acc', 'pretrain_tov_loss' and
+    'pretrain_cls_loss'
+    """
+    pretrain_train_acc_lst = []
+    pretrain_test_acc_lst = []
+    pretrain_tov_loss_lst = []
+    pretrain_cls_loss_lst = []
+    for epoch in range(1, n_epochs + 1):
+
+        network.train()
+        pretrain_correct = 0
+        batch_avg_tov_loss = 0
+        batch_avg_cls_loss = 0
+        # Train for one epoch: Iterate through pretraining batches
+        for batch_idx, (src_x, src_y, _) in enumerate(src_pretrain_loader):
+
+            pretrain_optimizer.zero_grad()
+            if add_tov_loss:
+                tov_optimizer.zero_grad()
+            src_x, src_y = src_x.to(device), src_y.to(device)
+
+            if add_tov_loss and single_pass_masking:
+                # clean and masked signals go through the network in one forward pass
+                masked_x, mask = masking(src_x, num_splits=10, num_masked=2)
+                (src_features, src_prediction), (masked_features, masked_prediction) = \
+                    network.forward_clean_and_masked(src_x, masked_x)
+            else:
+                src_features, src_prediction = network(src_x)
+            pretrain_correct += (src_prediction.argmax(1) == src_y).sum().item()
+            src_features = src_features.squeeze(-1)
+            src_classification_loss = cross_entropy(src_prediction, src_y)
+            batch_avg_cls_loss = (batch_avg_cls_loss * batch_idx + src_classification_loss) / (batch_idx + 1)
+
+            if add_tov_loss:
+                if not single_pass_masking:
+                    masked_x, mask = masking(src_x, num_splits=10, num_masked=2)
+                    # mask the signal
+                    masked_features, masked_prediction = network(masked_x)
+                # extract features from masked signal
+                masked_features = masked_features.squeeze(-1)
+                # predict full features from masked features
+                tov_predictions = temporal_verifier(masked_features.detach())
+                # calculate difference btw the full features and predicted features
+                tov_loss = mse_loss(tov_predictions, src_features)
+                batch_avg_tov_loss = (batch_avg_tov_loss * batch_idx + tov_loss) / (batch_idx + 1)
+            else:
+                tov_loss = 0
+                batch_avg_tov_loss = 0
+
+            total_loss = src_classification_loss + tov_loss
+            total_loss.backward()
+            pretrain_optimizer.step()
+            if add_tov_loss:
+                tov_optimizer.step()
+
+        pretrain_accuracy = pretrain_correct / len(src_pretrain_loader.dataset)
+        # Save pretrain accuracy
+        pretrain_train_acc_lst.append(pretrain_accuracy)
+        # Save batch-averaged tov loss
+        pretrain_tov_loss_lst.append(batch_avg_tov_loss)
+        # Save batch-averaged classification loss
+        pretrain_cls_loss_lst.append(batch_avg_cls_loss)
+
+        # Test model on validation set
+        network.eval()
+        valid_correct = 0
+        with torch.no_grad():
+            for _, (valid_x, valid_y, _) in enumerate(src_valid_loader):
+                valid_x, valid_y = valid_x.to(device), valid_y.to(device)
+                _, valid_prediction = network(valid_x)
+                valid_correct += (valid_prediction.argmax(1) == valid_y).sum().item()
+
+        # Save validation accuracy
+        valid_accuracy = valid_correct / len(src_valid_loader.dataset)
+        pretrain_test_acc_lst.append(valid_accuracy)
+        print(
+            f'[Epoch : {epoch}/{n_epochs}] '
+            f'training accuracy = {100 * pretrain_accuracy:.1f}% '
+            f'validation accuracy = {100 * valid_accuracy:.1f}% '
+            f'tov_loss = {batch_avg_tov_loss: .3e} '
+            f'classification_loss = {batch_avg_cls_loss: .3e} '
+        )
+
+    return {
+        'pretrain_test_acc': pretrain_test_acc_lst,
+        'pretrain_train_acc': pretrain_train_acc_lst,
+        'pretrain_tov_loss': pretrain_tov_loss_lst,
+        'pretrain_cls_loss': pretrain_cls_loss_lst
+    }
@@ -1,3 +1,6 @@
+import torch
+
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
 
@@ -14,4 +17,63 @@ class AverageMeter(object):
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
\ No newline at end of file
+        self.avg = self.sum / self.count
+
+class ModelCheckpointer(object):
+    """
+    Tracks the best (and optionally an exponential moving average of the) weights of 
+    a model in shadow tensors preallocated once, updated in place with copy_. Avoids 
+    deep-copying the state dict on the training path.
+    """
+
+    def __init__(self, model, ema_decay=None, mode='min'):
+        """
+        Parameters
+        ---------------------------------------
+        model: nn.Module to track
+        ema_decay: float in (0, 1), keep an EMA of the weights with this decay if given
+        mode: 'min' or 'max', whether a lower or higher metric is better
+        """
+        assert mode in ('min', 'max'), f'mode must be min or max, got {mode}'
+        self.model = model
+        self.ema_decay = ema_decay
+        self.mode = mode
+        self.best_metric = float('inf') if mode == 'min' else -float('inf')
+        self.best_epoch = None
+        self.best = self._allocate_shadow()
+        self.ema = self._allocate_shadow() if ema_decay is not None else None
+
+    @torch.no_grad()
+    def _allocate_shadow(self):
+        return {name: tensor.detach().clone() for name, tensor in self.model.state_dict().items()}
+
+    @torch.no_grad()
+    def snapshot(self, shadow):
+        """Copy the current model weights into shadow tensors in place"""
+        for name, tensor in self.model.state_dict().items():
+            shadow[name].copy_(tensor)
+
+    @torch.no_grad()
+    def update_ema(self):
+        """Fold the current weights into the EMA. Call after each optimizer step"""
+        if self.ema is None:
+            return
+        for name, tensor in self.model.state_dict().items():
+            if tensor.is_floating_point():
+                self.ema[name].lerp_(tensor, 1 - self.ema_decay)
+            else:
+                # integer buffers such as num_batches_tracked
+                self.ema[name].copy_(tensor)
+
+    def step(self, metric, epoch=None):
+        """
+        Snapshot the current weights as the best ones if metric improved. 
+        Returns whether it did.
+        """
+        metric = float(metric)
+        improved = metric < self.best_metric if self.mode == 'min' else metric > self.best_metric
+        if improved:
+            self.best_metric = metric
+            self.best_epoch = epoch
+            self.snapshot(self.best)
+        return improved
@@ -0,0 +1,270 @@
+'''
+Benchmarks for the training / calibration hot paths, on synthetic EEG shaped like the
+datasets used in the experiments so that they run offline:
+    Schirrmeister2017: 44 channels x 1125 samples, 4 classes
+    BNCI2014_001:      22 channels x 1000 samples, 4 classes
+
+For every benchmark the throughput (windows/s), peak CUDA memory (on GPU), the process peak
+RSS (cumulative over the benchmarks run so far) and optionally a per-op profile are recorded
+and appended, with the current commit, to a JSON history so that regressions between
+commits are visible. Run from the repository root:
+    python benchmarks/benchmark_hot_paths.py --dataset Schirrmeister2017 --profile
+'''
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import subprocess
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from braindecode.models import ShallowFBCSPNet
+from utils import train_one_epoch, test_model
+from instrumentation import peak_memory_bytes, process_peak_rss_bytes
+from loss import contrastive_loss_btw_subject
+from models.HypernetBCI import HyperBCINet
+from models.Embedder import Conv1dEmbedder
+from models.Hypernet import LinearHypernet
+from models.Supportnet import Supportnet
+from baseline_MAPU.models import masking
+from baseline_CLUDA.CLUDA_augmentations import Augmenter
+
+DATASET_SHAPES = {
+    'Schirrmeister2017': {'n_chans': 44, 'n_times': 1125, 'n_classes': 4},
+    'BNCI2014_001': {'n_chans': 22, 'n_times': 1000, 'n_classes': 4},
+}
+DEFAULT_HISTORY_PATH = os.path.join(REPO_ROOT, 'benchmarks', 'history.json')
+
+
+def make_synthetic_loader(n_chans, n_times, n_classes, n_windows=288, batch_size=64, shuffle=True):
+    """DataLoader yielding (X, y, idx) like the braindecode windows datasets"""
+    X = torch.randn(n_windows, n_chans, n_times)
+    y = torch.randint(0, n_classes, (n_windows,))
+    return DataLoader(TensorDataset(X, y, torch.arange(n_windows)), batch_size=batch_size, shuffle=shuffle)
+
+
+def build_benchmarks(n_chans, n_times, n_classes, batch_size, device):
+    """
+    Return {name: (fn, windows_per_call)}. Every fn runs one unit of work; inputs and models
+    are created here, outside of the timed region.
+    """
+    cuda = device == 'cuda'
+    loader = make_synthetic_loader(n_chans, n_times, n_classes, batch_size=batch_size)
+    test_loader = make_synthetic_loader(n_chans, n_times, n_classes, batch_size=batch_size, shuffle=False)
+    x = torch.randn(batch_size, n_chans, n_times, device=device)
+    benchmarks = {}
+
+    ### ShallowFBCSPNet training / testing loops
+    model = ShallowFBCSPNet(n_chans, n_classes, input_window_samples=n_times, final_conv_length='auto').to(device)
+    loss_fn = torch.nn.NLLLoss()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=10)
+
+    def run_train_one_epoch():
+        train_one_epoch(loader, model, loss_fn, optimizer, scheduler, 1, device=device)
+
+    def run_test_model():
+        with redirect_stdout(io.StringIO()):
+            test_model(test_loader, model, loss_fn, print_batch_stats=False, device=device)
+
+    benchmarks['train_one_epoch'] = (run_train_one_epoch, len(loader.dataset))
+    benchmarks['test_model'] = (run_test_model, len(test_loader.dataset))
+
+    ### HyperBCINet forward in its three states
+    sample_shape = torch.Size([n_chans, n_times])
+    primary_net = ShallowFBCSPNet(n_chans, n_classes, input_window_samples=n_times, final_conv_length='auto')
+    # strided conv embedder keeps LinearHypernet at a size that fits on CPU
+    embedding_shape = torch.Size([40, (n_times - 25) // 25 + 1])
+    embedder = Conv1dEmbedder(sample_shape, embedding_shape, kernel_size=25, stride=25)
+    weight_shape = primary_net.final_layer.conv_classifier.weight.shape
+    hypernet = LinearHypernet(embedding_shape, weight_shape)
+    hnbci = HyperBCINet(primary_net, embedder, embedding_shape, sample_shape, hypernet).to(device)
+    hnbci.primary_params = {name: param for name, param in hnbci.primary_net.named_parameters()}
+
+    def run_hnbci_training():
+        hnbci.train()
+        hnbci.calibrating = False
+        hnbci(x).sum().backward()
+
+    @torch.no_grad()
+    def run_hnbci_calibration():
+        hnbci.eval()
+        hnbci.calibrate()
+        hnbci(x)
+
+    @torch.no_grad()
+    def run_hnbci_test():
+        hnbci.eval()
+        hnbci.calibrating = False
+        hnbci(x)
+
+    benchmarks['HyperBCINet.forward[training]'] = (run_hnbci_training, batch_size)
+    benchmarks['HyperBCINet.forward[calibration]'] = (run_hnbci_calibration, batch_size)
+    benchmarks['HyperBCINet.forward[test]'] = (run_hnbci_test, batch_size)
+
+    ### Supportnet prototype attention, on ShallowFBCSP 'drop' layer sized embeddings
+    captured = {}
+    hook = model.drop.register_forward_hook(lambda module, input, output: captured.update(emb=output))
+    with torch.no_grad():
+        model(x[:2])
+    hook.remove()
+    emb_len = captured['emb'].shape[2]
+    supportnet = Supportnet(torch.nn.Identity(), torch.nn.Identity(), torch.nn.Identity()).to(device)
+    support_emb = torch.randn(batch_size, 40, emb_len, device=device)
+    support_y = torch.arange(batch_size, device=device) % n_classes
+    task_emb = torch.randn(batch_size, 40, emb_len, device=device)
+
+    @torch.no_grad()
+    def run_prototype_attention():
+        supportnet.attention_transform_with_prototypes(support_emb, support_y, task_emb, num_classes=n_classes)
+
+    benchmarks['Supportnet.attention_transform_with_prototypes'] = (run_prototype_attention, batch_size)
+
+    ### Inter-subject contrastive loss
+    subject_cnt, emb_cnt_per_subj = 8, batch_size // 8
+    contrastive_loss = contrastive_loss_btw_subject(
+        subject_cnt, emb_cnt_per_subj, subject_cnt * emb_cnt_per_subj, device=device
+    )
+    embeddings = torch.randn(subject_cnt * emb_cnt_per_subj, 40, device=device, requires_grad=True)
+
+    def run_contrastive_loss():
+        contrastive_loss(embeddings).backward()
+
+    benchmarks['contrastive_loss_btw_subject'] = (run_contrastive_loss, subject_cnt * emb_cnt_per_subj)
+
+    ### MAPU temporal masking and CLUDA augmentation
+    num_splits = next(n for n in (10, 9, 8, 5, 4, 2, 1) if n_times % n == 0)
+
+    def run_masking():
+        masking(x, num_splits=num_splits, num_masked=max(1, num_splits // 5))
+
+    augmenter = Augmenter(cutout_length=0, cutout_prob=0, dropout_prob=0, is_cuda=cuda)
+    sequence_mask = torch.ones([n_chans, n_times], device=device)
+
+    def run_augmenter():
+        augmenter(x, sequence_mask)
+
+    benchmarks['masking'] = (run_masking, batch_size)
+    benchmarks['Augmenter'] = (run_augmenter, batch_size)
+
+    return benchmarks
+
+
+def profile_ops(fn, device, top_k=10):
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device == 'cuda':
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities) as prof:
+        fn()
+    events = sorted(prof.key_averages(), key=lambda e: e.self_cpu_time_total, reverse=True)[:top_k]
+    return [{
+        'name': e.key,
+        'calls': e.count,
+        'self_cpu_time_us': e.self_cpu_time_total,
+        'cpu_time_us': e.cpu_time_total
+    } for e in events]
+
+
+def time_benchmark(fn, n_windows, device, n_repeats=5, profile=False):
+    def synchronize():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    # warm up (allocator, cudnn autotune, lazy init)
+    fn()
+    synchronize()
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    durations = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        fn()
+        synchronize()
+        durations.append(time.perf_counter() - start)
+
+    result = {
+        'median_s': float(np.median(durations)),
+        'min_s': float(np.min(durations)),
+        'windows_per_s': n_windows / float(np.median(durations)),
+        'peak_memory_bytes': peak_memory_bytes(device),
+        'process_peak_rss_bytes': process_peak_rss_bytes()
+    }
+    if profile:
+        result['profile'] = profile_ops(fn, device)
+    return result
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def append_to_history(record, history_path):
+    history = []
+    if os.path.exists(history_path) and os.path.getsize(history_path) > 0:
+        with open(history_path, 'r') as f:
+            history = json.load(f)
+
+    # compare against the latest run with the same dataset and device
+    previous = next((
+        r for r in reversed(history)
+        if r['dataset'] == record['dataset'] and r['device'] == record['device']
+    ), None)
+    for name, result in record['results'].items():
+        line = f"{name:<50} {result['windows_per_s']:>12.1f} windows/s"
+        if previous is not None and name in previous['results']:
+            ratio = result['windows_per_s'] / previous['results'][name]['windows_per_s']
+            line += f"  ({ratio:.2f}x vs {previous['commit']})"
+        print(line)
+
+    history.append(record)
+    with open(history_path, 'w') as f:
+        json.dump(history, f, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HypernetBCI hot path benchmarks')
+    parser.add_argument('--dataset', default='Schirrmeister2017', choices=list(DATASET_SHAPES))
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--n_repeats', default=5, type=int)
+    parser.add_argument('--only', default=None, type=str, help='Run only benchmarks whose name contains this')
+    parser.add_argument('--profile', action='store_true', help='Also record the top ops of each benchmark')
+    parser.add_argument('--history', default=DEFAULT_HISTORY_PATH, type=str)
+    parser.add_argument('--cpu', action='store_true', help='Benchmark on CPU even if CUDA is available')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+    torch.manual_seed(20200220)
+    shape = DATASET_SHAPES[args.dataset]
+    benchmarks = build_benchmarks(**shape, batch_size=args.batch_size, device=device)
+
+    results = {}
+    for name, (fn, n_windows) in benchmarks.items():
+        if args.only is not None and args.only not in name:
+            continue
+        results[name] = time_benchmark(fn, n_windows, device, n_repeats=args.n_repeats, profile=args.profile)
+
+    append_to_history({
+        'commit': current_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'dataset': args.dataset,
+        'device': device,
+        'batch_size': args.batch_size,
+        'torch_version': torch.__version__,
+        'results': results
+    }, args.history)
+    print(f'Results appended to {args.history}')
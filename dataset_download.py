@@ -1,4 +1,5 @@
 from braindecode.datasets import MOABBDataset, SleepPhysionet
+from window_store import ingest_sleep_physionet
 
 # BNCI2014_001 has 9 subjects
 # BNCI2014_001_dataset = MOABBDataset(dataset_name="BNCI2014_001", subject_ids=list(range(1, 10)))
@@ -7,5 +8,7 @@ from braindecode.datasets import MOABBDataset, SleepPhysionet
 # Schirrmeister2017_dataset = MOABBDataset(dataset_name="Schirrmeister2017", subject_ids=list(range(1, 15)))
 
 # SleepPhysionet has 78 subjects and 2 recordings per subject
-sleepphysionet_dataset = SleepPhysionet(subject_ids=range(79), recording_ids=[1, 2,], crop_wake_mins=30)
-# sleepphysionet_dataset = SleepPhysionet(subject_ids=[1, 2, 3], recording_ids=[1, 2,], crop_wake_mins=30)
\ No newline at end of file
+# Downloads and preprocesses one night at a time into the window store used by SS_baseline_2.py;
+# rerunning only processes the nights that are not in the store yet
+sleepphysionet_dataset = ingest_sleep_physionet('data/SleepPhysionet_windows', subject_ids=range(79), recording_ids=[1, 2,], crop_wake_mins=30, n_jobs=4)
+# sleepphysionet_dataset = SleepPhysionet(subject_ids=[1, 2, 3], recording_ids=[1, 2,], crop_wake_mins=30)
@@ -0,0 +1,150 @@
+'''
+On-disk embedding cache for the embedding analyses (t-SNE, prototypes, nearest neighbours).
+Embeddings of every window are written batch by batch into a preallocated float32 memmap,
+next to columnar subject id / label arrays, under a directory keyed by the hash of the
+model weights and a fingerprint of the dataset (cache_dir/<weights key>/<dataset fingerprint>):
+
+    store = extract_embeddings(encoder, windows_dataset, 'results/embeddings', hash_model_weights(encoder.state_dict()))
+    project_embedding_store(store, NeighborGraphProjection())
+
+The number of rows written is saved after every batch, so an interrupted extraction resumes
+where it stopped; an extraction with the same weights and dataset is read back without
+running the model. Windows are ordered by subject, in the order of
+windows_dataset.split('subject'). Subject ids are stored as int64, not as the string keys of
+split('subject').
+'''
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from braindecode.datasets import BaseConcatDataset
+
+EMBEDDINGS_FILE = 'embeddings.npy'
+SUBJECT_IDS_FILE = 'subject_ids.npy'
+LABELS_FILE = 'labels.npy'
+PROGRESS_FILE = 'progress.json'
+
+
+class EmbeddingStore(object):
+    """
+    Read-only view of a completed extraction. embeddings is a memmap of shape
+    (n_windows, embedding_dim); slicing it reads from disk without loading the rest
+    """
+    def __init__(self, store_dir: str) -> None:
+        self.store_dir = store_dir
+        self.embeddings = np.load(os.path.join(store_dir, EMBEDDINGS_FILE), mmap_mode='r')
+        self.subject_ids = np.load(os.path.join(store_dir, SUBJECT_IDS_FILE), mmap_mode='r')
+        self.labels = np.load(os.path.join(store_dir, LABELS_FILE), mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.embeddings)
+
+    def subject(self, subject_id) -> np.ndarray:
+        """Embeddings of one subject; windows of a subject are contiguous, so this is a view"""
+        rows = np.flatnonzero(self.subject_ids == int(subject_id))
+        return self.embeddings[rows[0]:rows[-1] + 1]
+
+
+def dataset_fingerprint(subject_datasets: list) -> str:
+    """
+    Content key of the windows to embed, read from the metadata and raw info only: subject
+    ids, labels, window bounds, channels and sampling rate of every recording
+
+    Parameters
+    ---------------------------------------
+    subject_datasets: list of (subject_id, windows dataset of one recording)
+    """
+    sha = hashlib.sha256()
+    for subject_id, ds in subject_datasets:
+        sha.update(str(subject_id).encode())
+        sha.update(np.asarray(ds.metadata['target'], dtype=np.int64).tobytes())
+        sha.update(ds.metadata[['i_start_in_trial', 'i_stop_in_trial']].to_numpy(dtype=np.int64).tobytes())
+        sha.update(json.dumps([ds.raw.info['ch_names'], ds.raw.info['sfreq']]).encode())
+    return sha.hexdigest()[:16]
+
+
+def _read_progress(store_dir: str, n_total: int) -> int:
+    path = os.path.join(store_dir, PROGRESS_FILE)
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'r') as f:
+        progress = json.load(f)
+    # the dataset changed (e.g. subjects were added), start over
+    return progress['n_done'] if progress['n_total'] == n_total else 0
+
+
+def _write_progress(store_dir: str, n_done: int, n_total: int) -> None:
+    # write then rename, the progress file is never half written
+    path = os.path.join(store_dir, PROGRESS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'n_done': n_done, 'n_total': n_total}, f)
+    os.replace(path + '.tmp', path)
+
+
+@torch.no_grad()
+def extract_embeddings(
+        embed_fn,
+        windows_dataset: BaseConcatDataset,
+        cache_dir: str,
+        key: str,
+        batch_size=72,
+        device='cuda'
+    ) -> EmbeddingStore:
+    """
+    Parameters
+    ---------------------------------------
+    embed_fn: callable, maps a batch of windows (batch_size, n_chans, n_times) to a batch of
+    embeddings of any shape; they are flattened. An nn.Module is put in eval mode
+    key: str, identifies embed_fn, e.g. hash_model_weights of its weights. The store lives
+    in cache_dir/key/<dataset_fingerprint of windows_dataset>
+
+    return
+    ---------------------------------------
+    EmbeddingStore of all windows of windows_dataset
+    """
+    if isinstance(embed_fn, torch.nn.Module):
+        embed_fn.eval()
+
+    # windows ordered by subject
+    subject_datasets = [
+        (int(subject_id), ds) for subject_id, subject_set in windows_dataset.split('subject').items()
+        for ds in subject_set.datasets
+    ]
+    store_dir = os.path.join(cache_dir, key, dataset_fingerprint(subject_datasets))
+    os.makedirs(store_dir, exist_ok=True)
+    ordered_dataset = BaseConcatDataset([ds for _, ds in subject_datasets])
+    n_total = len(ordered_dataset)
+
+    n_done = _read_progress(store_dir, n_total)
+    if n_done == n_total:
+        return EmbeddingStore(store_dir)
+
+    embeddings_path = os.path.join(store_dir, EMBEDDINGS_FILE)
+    if n_done == 0 or not os.path.exists(embeddings_path):
+        # columnar metadata comes from the windows metadata, no need to run the model
+        np.save(os.path.join(store_dir, SUBJECT_IDS_FILE), np.concatenate([
+            np.full(len(ds), subject_id, dtype=np.int64) for subject_id, ds in subject_datasets
+        ]))
+        np.save(os.path.join(store_dir, LABELS_FILE), np.concatenate([
+            np.asarray(ds.metadata['target'], dtype=np.int64) for _, ds in subject_datasets
+        ]))
+        n_done = 0
+        embedding_dim = embed_fn(torch.as_tensor(ordered_dataset[0][0])[None].to(device)).flatten(1).shape[1]
+        embeddings = np.lib.format.open_memmap(embeddings_path, mode='w+', dtype=np.float32, shape=(n_total, embedding_dim))
+    else:
+        print(f'Resuming embedding extraction in {store_dir} at window {n_done}/{n_total}')
+        embeddings = np.load(embeddings_path, mmap_mode='r+')
+
+    dataloader = DataLoader(Subset(ordered_dataset, range(n_done, n_total)), batch_size=batch_size)
+    for X, _, _ in dataloader:
+        batch_embeddings = embed_fn(X.to(device)).flatten(1)
+        embeddings[n_done:n_done + len(X)] = batch_embeddings.float().cpu().numpy()
+        n_done += len(X)
+        embeddings.flush()
+        _write_progress(store_dir, n_done, n_total)
+
+    del embeddings
+    return EmbeddingStore(store_dir)
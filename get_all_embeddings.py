@@ -2,14 +2,15 @@ import os
 import torch
 import pandas as pd
 import numpy as np
-from sklearn.manifold import TSNE
 from copy import deepcopy
 from braindecode.datautil import load_concat_dataset
 from torch.utils.data import DataLoader
 from braindecode.models import ShallowFBCSPNet
 from baseline_CLUDA.CLUDA_models import ShallowFBCSPEncoder
 import matplotlib.pyplot as plt
-from utils import train_one_epoch, test_model
+from utils import train_one_epoch, test_model, hash_model_weights
+from embedding_store import extract_embeddings
+from projection import NeighborGraphProjection, project_embedding_store
 
 subject_ids_lst = list(range(1, 14))
 # subject_ids_lst = [1, 2]
@@ -31,6 +32,8 @@ os.makedirs(os.path.join(dir_results, experiment_folder_name), exist_ok=True)
 acc_curve_path = os.path.join(dir_results, f'{experiment_folder_name}/', 'accuracy_curve.png')
 model_param_path = os.path.join(dir_results, f'{experiment_folder_name}/', 'model_params.pth')
 embeddings_path = os.path.join(dir_results, f'{experiment_folder_name}/', 'embeddings.pkl')
+# full embeddings, one store per model weights
+embeddings_cache_dir = os.path.join(dir_results, f'{experiment_folder_name}/', 'embeddings')
 
 # Load dataset
 windows_dataset = load_concat_dataset(
@@ -152,40 +155,27 @@ encoder.model.load_state_dict(torch.load(model_param_path))
 if cuda:
     encoder.cuda()
 
-# Calculate embeddings
+# Calculate embeddings, or read them back if this model's embeddings are cached
 print('Calculate and reduce embeddings to 2D')
-embedding_lst = []
-subject_id_lst = []
-label_lst = []
-splitted_by_subj = windows_dataset.split('subject')
-for subject_id, subject_dataset in splitted_by_subj.items():
-
-    subject_dataloader = DataLoader(subject_dataset, batch_size=batch_size)
-    for _, (src_x, src_y, _) in enumerate(subject_dataloader):
-        encoder.eval()
-        src_x = src_x.to(device)
-        batch_embeddings = encoder(src_x)
-        for embedding, label in zip(
-            batch_embeddings.detach().cpu().numpy(), 
-            src_y.cpu().numpy()
-        ):
-            embedding_lst.append(embedding.flatten())
-            label_lst.append(label)
-            subject_id_lst.append(subject_id)
-
-# print(embedding_lst[0])
+embedding_store = extract_embeddings(
+    encoder, 
+    windows_dataset, 
+    embeddings_cache_dir, 
+    hash_model_weights(encoder.state_dict()), 
+    batch_size=batch_size, 
+    device=device
+)
 
 df_embeddings = pd.DataFrame({
-    'embedding': embedding_lst, 
-    'subject_id': subject_id_lst, 
-    'label': label_lst
+    # the string keys of split('subject'), as before the store
+    'subject_id': embedding_store.subject_ids.astype(str), 
+    'label': embedding_store.labels
 })
 
 # Dimensionality reduction
-tsne_model = TSNE(n_components=2, random_state=0, perplexity=10)
-reduced_embeddings = tsne_model.fit_transform(
-    np.vstack(df_embeddings['embedding'].values)
-)
+# PCA + cached kNN graph + t-SNE; subjects added later are projected, not refitted
+projection = NeighborGraphProjection(perplexity=10, random_state=0)
+reduced_embeddings = project_embedding_store(embedding_store, projection)
 df_embeddings['reduced_embedding'] = reduced_embeddings.tolist()
 
 print('Save embeddings')
@@ -0,0 +1,211 @@
+'''
+Opt-in instrumentation for the shared training / testing loops (utils.train_one_epoch,
+utils.test_model): wall time per phase (data fetch, host->device copy, forward, backward,
+optimizer step, .item() syncs), peak memory and samples/s, written to pluggable sinks.
+peak_memory_bytes is the CUDA peak of the pass (None on CPU); process_peak_rss_bytes is
+the high-water mark of the whole process so far, it does not reset between passes.
+
+    instrumentation = LoopInstrumentation(
+        sinks=[StdoutSink(), CSVSink('results/loop_timing.csv'), TensorBoardSink('results/runs/exp')],
+        device=device
+    )
+    train_one_epoch(..., instrumentation=instrumentation)
+
+A loop is input-bound when 'data' and 'h2d' dominate, compute-bound when 'forward',
+'backward' and 'optimizer' do. Without instrumentation the loops only enter a shared
+no-op context per phase.
+'''
+import os
+import csv
+import time
+import resource
+import platform
+from contextlib import nullcontext
+
+import torch
+
+PHASES = ('data', 'h2d', 'forward', 'backward', 'optimizer', 'sync')
+INPUT_PHASES = ('data', 'h2d')
+COMPUTE_PHASES = ('forward', 'backward', 'optimizer')
+
+_NULL_PHASE = nullcontext()
+
+
+def null_phase(name: str):
+    """Stand-in for LoopInstrumentation.phase when instrumentation is disabled"""
+    return _NULL_PHASE
+
+
+def peak_memory_bytes(device):
+    """
+    Peak memory allocated on a CUDA device since the last torch.cuda.reset_peak_memory_stats.
+    None on CPU, where there is no per-pass counter (see process_peak_rss_bytes)
+    """
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return None
+
+
+def process_peak_rss_bytes() -> int:
+    """High-water mark of the resident memory of the whole process since it started"""
+    # ru_maxrss is in KB on linux, bytes on macOS
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class _PhaseTimer(object):
+    """Reusable context manager adding its elapsed time to totals[name]"""
+    def __init__(self, totals: dict, name: str, synchronize: bool) -> None:
+        self.totals = totals
+        self.name = name
+        self.synchronize = synchronize
+        self.start = 0.
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        # CUDA kernels run asynchronously, wait for them so time lands in the right phase
+        if self.synchronize:
+            torch.cuda.synchronize()
+        self.totals[self.name] += time.perf_counter() - self.start
+        return False
+
+
+class LoopInstrumentation(object):
+    """
+    Collects per-phase timings over one pass of a loop (start() ... end()) and sends the
+    resulting record to every sink
+    """
+    def __init__(self, sinks=None, device='cuda', synchronize=True) -> None:
+        """
+        Parameters
+        ---------------------------------------
+        sinks: list of objects with write(record) (and optionally close()), default stdout
+        synchronize: on CUDA, synchronize at the end of every phase. Makes the split
+        between phases exact at the cost of some overlap between host and device work
+        """
+        self.sinks = sinks if sinks is not None else [StdoutSink()]
+        self.device = device
+        synchronize = synchronize and torch.device(device).type == 'cuda'
+        self.totals = {name: 0. for name in PHASES}
+        self.timers = {name: _PhaseTimer(self.totals, name, synchronize) for name in PHASES}
+        self.steps = {}
+        self.tag = None
+        self.epoch = None
+
+    def start(self, tag: str, epoch=None) -> None:
+        """
+        Begin a pass. tag names the loop ('train', 'test'); epoch is the x axis of the
+        record, by default the number of passes with this tag so far
+        """
+        self.tag = tag
+        self.epoch = epoch if epoch is not None else self.steps.get(tag, 0)
+        self.steps[tag] = self.steps.get(tag, 0) + 1
+        for name in self.totals:
+            self.totals[name] = 0.
+        self.n_samples = 0
+        self.n_batches = 0
+        if torch.device(self.device).type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.start_time = time.perf_counter()
+
+    def phase(self, name: str) -> _PhaseTimer:
+        return self.timers[name]
+
+    def iterate(self, dataloader):
+        """Yield the batches of dataloader, timing each fetch as the 'data' phase"""
+        iterator = iter(dataloader)
+        data_timer = self.timers['data']
+        while True:
+            with data_timer:
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def count(self, n_samples: int) -> None:
+        self.n_samples += n_samples
+        self.n_batches += 1
+
+    def end(self) -> dict:
+        """Finish the pass, write the record to the sinks and return it"""
+        wall = time.perf_counter() - self.start_time
+        record = {
+            'tag': self.tag,
+            'epoch': self.epoch,
+            'n_batches': self.n_batches,
+            'n_samples': self.n_samples,
+            'wall_s': wall,
+            'samples_per_s': self.n_samples / wall if wall > 0 else 0.,
+            'peak_memory_bytes': peak_memory_bytes(self.device),
+            'process_peak_rss_bytes': process_peak_rss_bytes()
+        }
+        record.update({f'{name}_s': self.totals[name] for name in PHASES})
+        # loop bookkeeping, progress bar, scheduler step, ...
+        record['other_s'] = wall - sum(self.totals.values())
+        input_time = sum(self.totals[name] for name in INPUT_PHASES)
+        compute_time = sum(self.totals[name] for name in COMPUTE_PHASES)
+        record['bound'] = 'input' if input_time > compute_time else 'compute'
+
+        for sink in self.sinks:
+            sink.write(record)
+        return record
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+
+class StdoutSink(object):
+    def write(self, record: dict) -> None:
+        phases = ', '.join(f"{name} {record[f'{name}_s']:.3f}s" for name in PHASES)
+        memory = f"{record['process_peak_rss_bytes'] / 2 ** 20:.0f} MiB process peak RSS"
+        if record['peak_memory_bytes'] is not None:
+            memory = f"{record['peak_memory_bytes'] / 2 ** 20:.0f} MiB CUDA peak, " + memory
+        print(
+            f"[{record['tag']} {record['epoch']}] {record['samples_per_s']:.1f} samples/s, "
+            f"{memory}, {record['bound']}-bound ({phases}, other {record['other_s']:.3f}s)"
+        )
+
+
+class CSVSink(object):
+    """Appends one row per record; the header is written when the file is created"""
+    FIELDS = ['tag', 'epoch', 'n_batches', 'n_samples', 'wall_s', 'samples_per_s', 'peak_memory_bytes',
+              'process_peak_rss_bytes'] + [f'{name}_s' for name in PHASES] + ['other_s', 'bound']
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def write(self, record: dict) -> None:
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+            if new_file:
+                writer.writeheader()
+            writer.writerow(record)
+
+
+class TensorBoardSink(object):
+    """
+    Writes the numeric fields of each record as scalars '<tag>/<field>' to local
+    TensorBoard event files (peak_memory_bytes only on CUDA). Needs the tensorboard package.
+    """
+    def __init__(self, log_dir: str) -> None:
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(log_dir=log_dir)
+
+    def write(self, record: dict) -> None:
+        for key, value in record.items():
+            if key in ('tag', 'epoch', 'bound') or value is None:
+                continue
+            self.writer.add_scalar(f"{record['tag']}/{key}", value, record['epoch'])
+        self.writer.flush()
+
+    def close(self) -> None:
+        self.writer.close()
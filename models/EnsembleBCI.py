@@ -0,0 +1,191 @@
+import torch
+
+from replica_training import StackedReplicas
+
+
+def log_variance_embedding(x: torch.Tensor) -> torch.Tensor:
+    """
+    Per-channel log-variance of each trial, a model-free embedding of band power
+
+    Parameters
+    ---------------------------------------
+    x: torch tensor, has shape: (batch_size, n_chans, n_times)
+
+    return
+    ---------------------------------------
+    embeddings, has shape: (batch_size, n_chans)
+    """
+    return torch.log(x.var(dim=-1) + 1e-8)
+
+
+def _stacked_name(name: str) -> str:
+    """Buffer name of a stacked member tensor (buffer names can't contain dots)"""
+    return 'stacked_' + name.replace('.', '_')
+
+
+def _reset_active_stack_hook(module, incompatible_keys) -> None:
+    module._reset_active_stack()
+
+
+class EnsembleBCI(torch.nn.Module):
+    """
+    Calibration-free ensemble of per-subject models of the same architecture (say one
+    ShallowFBCSPNet per source subject). The members are stacked into a
+    replica_training.StackedReplicas, so one vmapped forward returns the log-probabilities
+    of every member; the ensemble output is their weighted average.
+
+    Member weights are one of
+        'uniform': every member counts the same
+        'accuracy': proportional to member_accuracies, e.g. each member's accuracy on the
+        other source subjects
+        'similarity': softmax over members of -distance / temperature between the mean
+        embedding of a few unlabeled target trials and each member's source subject
+        prototype (see fit_weights)
+    With top_k, only the k members with the highest weights are kept, so inference cost
+    is that of k members whatever the number of subjects. Ties go to the lower member
+    index. top_k needs 'accuracy' or 'similarity' weighting; with 'similarity' every member
+    stays active (uniform weights) until fit_weights.
+
+    The stacked member weights are buffers of the module ('stacked_<name>'), so they are
+    part of state_dict() and follow .to() / .cuda().
+    """
+    def __init__(
+            self,
+            members: list,
+            weighting='uniform',
+            member_accuracies=None,
+            source_prototypes=None,
+            embedder=log_variance_embedding,
+            top_k=None,
+            temperature=1.
+        ) -> None:
+        """
+        Parameters
+        ---------------------------------------
+        members: list of nn.Module, the per-subject models, on the same device
+        member_accuracies: list of float, one per member, needed for 'accuracy' weighting
+        source_prototypes: torch tensor, mean embedding of each member's training data, has
+        shape: (n_members, *embedding_shape). Needed for 'similarity' weighting
+        embedder: callable, maps a batch of trials to a batch of embeddings
+        """
+        super(EnsembleBCI, self).__init__()
+        assert top_k is None or weighting != 'uniform', \
+            "top_k needs accuracy or similarity weighting, with uniform weights it would keep arbitrary members"
+        self.n_members = len(members)
+        self.weighting = weighting
+        self.embedder = embedder
+        self.top_k = top_k
+        self.temperature = temperature
+
+        # stacked members, one vmapped forward for all of them. Their tensors are registered
+        # as buffers; self.members only keeps the stateless skeleton and reads them back
+        self.members = StackedReplicas.from_models(members)
+        self.members.eval()
+        for name, tensor in {**self.members.params, **self.members.buffers}.items():
+            assert not hasattr(self, _stacked_name(name)), f'Member tensor {name} clashes with {_stacked_name(name)}'
+            self.register_buffer(_stacked_name(name), tensor.detach())
+
+        self.register_buffer('member_accuracies', None if member_accuracies is None else 
+                             torch.as_tensor(member_accuracies, dtype=torch.float))
+        self.register_buffer('source_prototypes', None if source_prototypes is None else 
+                             torch.as_tensor(source_prototypes, dtype=torch.float))
+
+        # weights of the active (not pruned) members, normalized
+        self.register_buffer('member_weights', torch.full((self.n_members,), 1. / self.n_members))
+        self.register_buffer('active_members', torch.arange(self.n_members))
+        # stacked active members, gathered once per set_weights / move / load_state_dict
+        self._active_stack = None
+        self.register_load_state_dict_post_hook(_reset_active_stack_hook)
+        match weighting:
+            case 'uniform':
+                self.set_weights(torch.ones(self.n_members))
+            case 'accuracy':
+                assert self.member_accuracies is not None, "Accuracy weighting needs member_accuracies"
+                self.set_weights(self.member_accuracies)
+            case 'similarity':
+                # every member with uniform weight until fit_weights is called with target trials
+                assert self.source_prototypes is not None, "Similarity weighting needs source_prototypes"
+            case _:
+                raise ValueError(f'Weighting {weighting} is not defined.')
+
+    def set_weights(self, weights: torch.Tensor) -> None:
+        """Set (unnormalized) member weights, keep the top_k members and renormalize"""
+        weights = torch.as_tensor(weights, dtype=torch.float, device=self.member_weights.device)
+        if self.top_k is not None and self.top_k < self.n_members:
+            # stable sort, so that ties go to the lower member index
+            top_members = torch.sort(weights, descending=True, stable=True).indices[:self.top_k]
+            self.active_members = top_members.sort().values
+        else:
+            self.active_members = torch.arange(self.n_members, device=weights.device)
+        active_weights = weights[self.active_members]
+        self.member_weights = active_weights / active_weights.sum()
+        self._reset_active_stack()
+
+    @torch.no_grad()
+    def fit_weights(self, x_unlabeled: torch.Tensor) -> torch.Tensor:
+        """
+        'similarity' weighting: weight members by how close the target trials are to their
+        source subject in embedding space. Needs no labels.
+
+        Parameters
+        ---------------------------------------
+        x_unlabeled: torch tensor, a few target trials, has shape: (n_trials, *sample_shape)
+
+        return
+        ---------------------------------------
+        weights of all members (0 for pruned ones), has shape: (n_members,)
+        """
+        assert self.weighting == 'similarity', "Only similarity weights are fitted on target trials"
+        target_prototype = self.embedder(x_unlabeled).mean(0)
+        distances = (self.source_prototypes - target_prototype).flatten(1).norm(dim=1)
+        self.set_weights(torch.softmax(-distances / self.temperature, dim=0))
+        return self.all_member_weights()
+
+    def all_member_weights(self) -> torch.Tensor:
+        weights = torch.zeros(self.n_members, device=self.member_weights.device)
+        weights[self.active_members] = self.member_weights
+        return weights
+
+    def _reset_active_stack(self) -> None:
+        self._active_stack = None
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to() / .cuda() / .half() replace the stacked buffers
+        self._reset_active_stack()
+        return super(EnsembleBCI, self)._apply(fn, *args, **kwargs)
+
+    def _get_active_stack(self) -> StackedReplicas:
+        if self._active_stack is None:
+            self.members.params = {name: getattr(self, _stacked_name(name)) for name in self.members.params}
+            self.members.buffers = {name: getattr(self, _stacked_name(name)) for name in self.members.buffers}
+            if len(self.active_members) == self.n_members:
+                self._active_stack = self.members
+            else:
+                self._active_stack = self.members.select(self.active_members)
+        return self._active_stack
+
+    def member_log_probs(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Log-probabilities of the active members, in one batched forward
+
+        return
+        ---------------------------------------
+        has shape: (n_active_members, batch_size, n_classes)
+        """
+        outputs = self._get_active_stack()(x, shared_input=True)
+        # no-op if the members already end with log_softmax
+        return torch.log_softmax(outputs, dim=-1)
+
+    def forward(self, x):
+        """
+        Parameters
+        ---------------------------------------
+        x: torch tensor, has shape: (batch_size, *sample_shape)
+
+        return
+        ---------------------------------------
+        log-probabilities of the ensemble, has shape: (batch_size, n_classes)
+        """
+        log_probs = self.member_log_probs(x)
+        averaged = torch.einsum('m,mbc->bc', self.member_weights, log_probs)
+        return torch.log_softmax(averaged, dim=-1)
@@ -1,3 +1,5 @@
+import os
+import json
 import torch
 from torch.nn.utils.stateless import functional_call
 from copy import deepcopy
@@ -163,4 +165,79 @@ class HyperBCINet(torch.nn.Module):
         #     print(f"x on device {x.device}, other tensor in primary params on device {self.primary_params.get('conv_time_spat.conv_time.weight').device}")
 
         # print('Forward pass using functional call')
-        return functional_call(self.primary_net, self.primary_params, x)
\ No newline at end of file
+        return functional_call(self.primary_net, self.primary_params, x)
+
+    @torch.no_grad()
+    def fold_calibrated(self) -> torch.nn.Module:
+        """
+        Return a copy of the primary network with the current primary_params (including the
+        generated conv_classifier weight) written into its own parameters. The copy is a
+        plain module: no embedder, hypernet or functional_call.
+        """
+        folded_net = deepcopy(self.primary_net)
+        folded_params = dict(folded_net.named_parameters())
+        for name, tensor in self.primary_params.items():
+            folded_params[name].copy_(tensor.detach())
+        return folded_net.eval()
+
+    def export_calibrated(self, path: str, export_format='torchscript', preprocessing=None) -> None:
+        """
+        Export the calibrated model as a frozen inference artifact, plus a json metadata file
+        next to it (same name, .json extension). Neither needs braindecode to be loaded.
+
+        Parameters
+        ---------------------------------------
+        path: str, where to save the model
+        export_format: str, 'torchscript' or 'onnx'
+        preprocessing: dict, preprocessing the model expects its input to have gone 
+        through, e.g. {'factor': 1e6, 'l_freq': 4., 'h_freq': 38., 'factor_new': 1e-3, 
+        'init_block_size': 1000}. Saved as is in the metadata
+        """
+        folded_net = self.fold_calibrated().cpu()
+        example_input = torch.zeros(1, *self.sample_shape)
+
+        match export_format:
+            case 'torchscript':
+                torch.jit.trace(folded_net, example_input).save(path)
+            case 'onnx':
+                torch.onnx.export(
+                    folded_net, 
+                    example_input, 
+                    path, 
+                    input_names=['input'], 
+                    output_names=['output'],
+                    dynamic_axes={'input': {0: 'batch_size'}, 'output': {0: 'batch_size'}}
+                )
+            case _:
+                raise ValueError('Export format is not defined.')
+
+        with torch.no_grad():
+            n_outputs = folded_net(example_input).shape[1]
+        metadata = {
+            'format': export_format,
+            'sample_shape': list(self.sample_shape),
+            'n_outputs': n_outputs,
+            'preprocessing': preprocessing
+        }
+        with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+            json.dump(metadata, f, indent=4)
+
+
+def load_calibrated(path: str):
+    """
+    Load a model exported by HyperBCINet.export_calibrated. Returns the model (a TorchScript
+    module, or an onnxruntime InferenceSession for onnx) and its metadata dict.
+    """
+    with open(os.path.splitext(path)[0] + '.json', 'r') as f:
+        metadata = json.load(f)
+
+    match metadata['format']:
+        case 'torchscript':
+            model = torch.jit.load(path, map_location='cpu').eval()
+        case 'onnx':
+            import onnxruntime
+            model = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        case _:
+            raise ValueError('Export format is not defined.')
+
+    return model, metadata
@@ -0,0 +1,204 @@
+'''
+Online (streaming) inference with a calibrated model. Multichannel samples arrive in chunks
+from a source (file replay, or a TCP socket standing in for LSL), are preprocessed
+incrementally with the same chain as offline, kept in a ring buffer of input_window_samples,
+and classified every hop_samples. Latency is measured from chunk arrival to decision.
+
+Example:
+    preprocessor = StreamingPreprocessor(n_chans, sfreq)
+    decoder = OnlineDecoder(calibrate_HNBCI, preprocessor, n_chans, input_window_samples, hop_samples=125)
+    for decision in decoder.run(FileReplaySource.from_raw(raw, chunk_size=25)):
+        print(decision['prediction'])
+    print(decoder.latency_report())
+'''
+import socket
+import time
+
+import numpy as np
+import torch
+
+
+class RingBuffer(object):
+    """
+    Fixed-size multichannel sample buffer. Every sample is written twice (at i and i + size),
+    so the latest window is always one contiguous slice and never needs to be rolled.
+    """
+    def __init__(self, n_chans: int, size: int, dtype=np.float32) -> None:
+        self.size = size
+        self.buffer = np.zeros((n_chans, 2 * size), dtype=dtype)
+        self.write_idx = 0
+        self.n_written = 0
+
+    @property
+    def full(self) -> bool:
+        return self.n_written >= self.size
+
+    def push(self, chunk: np.ndarray) -> None:
+        n_samples = chunk.shape[1]
+        self.n_written += n_samples
+        if n_samples > self.size:
+            chunk = chunk[:, -self.size:]
+            n_samples = self.size
+        idx = (self.write_idx + np.arange(n_samples)) % self.size
+        self.buffer[:, idx] = chunk
+        self.buffer[:, idx + self.size] = chunk
+        self.write_idx = (self.write_idx + n_samples) % self.size
+
+    def latest(self) -> np.ndarray:
+        """The last size samples, oldest first. A view into the buffer, has shape: (n_chans, size)"""
+        return self.buffer[:, self.write_idx:self.write_idx + self.size]
+
+
+class FileReplaySource(object):
+    """
+    Replays a recording as a stream of chunks, optionally paced in real time
+    """
+    def __init__(self, data: np.ndarray, sfreq: float, chunk_size=25, realtime=False) -> None:
+        """
+        Parameters
+        ---------------------------------------
+        data: np array, raw (unpreprocessed) signal, has shape: (n_chans, n_times)
+        chunk_size: number of samples per chunk
+        realtime: if True, wait chunk_size / sfreq seconds between chunks
+        """
+        self.data = data
+        self.sfreq = sfreq
+        self.chunk_size = chunk_size
+        self.realtime = realtime
+
+    @classmethod
+    def from_raw(cls, raw, chunk_size=25, realtime=False):
+        """Replay the EEG channels of an mne Raw"""
+        raw = raw.copy().pick_types(eeg=True, meg=False, stim=False)
+        return cls(raw.get_data(), raw.info['sfreq'], chunk_size, realtime)
+
+    def __iter__(self):
+        chunk_duration = self.chunk_size / self.sfreq
+        next_time = time.perf_counter()
+        for start in range(0, self.data.shape[1], self.chunk_size):
+            if self.realtime:
+                next_time += chunk_duration
+                time.sleep(max(0., next_time - time.perf_counter()))
+            yield self.data[:, start:start + self.chunk_size]
+
+
+class SocketSource(object):
+    """
+    Reads chunks from a TCP socket. Each chunk is chunk_size samples x n_chans channels of
+    little-endian float32, sample-major (like an LSL pull_chunk). Ends when the sender closes.
+    """
+    def __init__(self, host: str, port: int, n_chans: int, chunk_size=25) -> None:
+        self.host = host
+        self.port = port
+        self.n_chans = n_chans
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_size * n_chans * 4
+
+    def __iter__(self):
+        with socket.create_connection((self.host, self.port)) as conn:
+            payload = bytearray(self.chunk_bytes)
+            view = memoryview(payload)
+            while True:
+                n_received = 0
+                while n_received < self.chunk_bytes:
+                    n = conn.recv_into(view[n_received:], self.chunk_bytes - n_received)
+                    if n == 0:
+                        return
+                    n_received += n
+                chunk = np.frombuffer(payload, dtype='<f4').reshape(self.chunk_size, self.n_chans)
+                yield chunk.T.copy()
+
+
+class OnlineDecoder(object):
+    """
+    Runs a model on a sliding window over an incoming stream. Works with any model mapping
+    (batch_size, n_chans, input_window_samples) to class scores, including a calibrated
+    HyperBCINet, which is put in testing state (no weight generation).
+    """
+    def __init__(
+            self,
+            model: torch.nn.Module,
+            preprocessor,
+            n_chans: int,
+            input_window_samples: int,
+            hop_samples: int,
+            device='cpu'
+        ) -> None:
+        """
+        Parameters
+        ---------------------------------------
+        preprocessor: object with process(chunk) -> chunk, e.g. StreamingPreprocessor
+        hop_samples: number of new samples between two consecutive decisions
+        """
+        self.model = model.to(device)
+        self.model.eval()
+        if hasattr(self.model, 'calibrating'):
+            self.model.calibrating = False
+        self.preprocessor = preprocessor
+        self.hop_samples = hop_samples
+        self.device = device
+        self.ring = RingBuffer(n_chans, input_window_samples)
+        # model input is written in place, no allocation per decision
+        self.input = torch.zeros((1, n_chans, input_window_samples), device=device)
+        self.samples_since_decision = 0
+        self.latencies = []
+
+    def reset(self) -> None:
+        self.ring = RingBuffer(self.ring.buffer.shape[0], self.ring.size)
+        self.samples_since_decision = 0
+        self.latencies = []
+        if hasattr(self.preprocessor, 'reset'):
+            self.preprocessor.reset()
+
+    @torch.inference_mode()
+    def _decide(self, arrival_time: float) -> dict:
+        self.input[0].copy_(torch.from_numpy(self.ring.latest()))
+        scores = self.model(self.input)
+        probabilities = torch.softmax(scores.reshape(1, -1), dim=1)[0].cpu().numpy()
+        latency = time.perf_counter() - arrival_time
+        self.latencies.append(latency)
+        return {
+            'sample': self.ring.n_written,
+            'prediction': int(probabilities.argmax()),
+            'probabilities': probabilities,
+            'latency': latency
+        }
+
+    def process_chunk(self, chunk: np.ndarray) -> list:
+        """
+        Preprocess one chunk of raw samples, has shape: (n_chans, n_samples), and return
+        the decisions that became due
+        """
+        arrival_time = time.perf_counter()
+        chunk = self.preprocessor.process(chunk)
+        decisions = []
+        start = 0
+        while start < chunk.shape[1]:
+            # push up to the next decision point, so a long chunk yields every due decision
+            n_samples = min(chunk.shape[1] - start, self.hop_samples - self.samples_since_decision)
+            self.ring.push(chunk[:, start:start + n_samples])
+            self.samples_since_decision += n_samples
+            start += n_samples
+            if self.samples_since_decision >= self.hop_samples:
+                self.samples_since_decision = 0
+                if self.ring.full:
+                    decisions.append(self._decide(arrival_time))
+        return decisions
+
+    def run(self, source):
+        """Consume a source and yield decisions as they are made"""
+        for chunk in source:
+            yield from self.process_chunk(chunk)
+
+    def latency_report(self, percentiles=(50, 90, 95, 99)) -> dict:
+        """Per-decision latency statistics in milliseconds"""
+        if not self.latencies:
+            return {}
+        latencies_ms = 1e3 * np.asarray(self.latencies)
+        report = {f'p{p}': float(np.percentile(latencies_ms, p)) for p in percentiles}
+        report.update({
+            'mean': float(latencies_ms.mean()),
+            'max': float(latencies_ms.max()),
+            'n_decisions': len(latencies_ms)
+        })
+        return report
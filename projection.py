@@ -0,0 +1,231 @@
+'''
+2-D projection of high-dimensional embeddings (e.g. 5760-d ShallowFBCSP 'drop' features of
+every window) for visualization. Instead of running t-SNE on the raw embeddings:
+    1. randomized PCA (torch.pca_lowrank) down to n_pca_components
+    2. kNN graph in PCA space, computed in chunks on all cores and cached on disk
+    3. Barnes-Hut t-SNE on the sparse kNN graph (metric='precomputed'), initialized with the
+       first two principal components
+New points are placed without refitting (transform): projected with the fitted PCA basis and
+put at the distance-weighted mean of the 2-D positions of their nearest fitted points.
+
+    projection = NeighborGraphProjection(perplexity=10)
+    reduced_embeddings = project_embedding_store(embedding_store, projection)
+'''
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+from scipy.sparse import csr_matrix
+from sklearn.manifold import TSNE
+
+# fields of NeighborGraphProjection that change the fitted embedding
+PROJECTION_SETTINGS = ['n_pca_components', 'perplexity', 'n_neighbors', 'n_transform_neighbors', 'random_state']
+
+
+def knn_graph(Z: torch.Tensor, reference: torch.Tensor, n_neighbors: int, exclude_self=False, chunk_size=2048):
+    """
+    Exact k nearest neighbours of every row of Z among the rows of reference, computed chunk
+    by chunk so that only a (chunk_size, n_reference) distance matrix is in memory
+
+    return
+    ---------------------------------------
+    distances, indices: np.ndarray of shape (n, n_neighbors)
+    """
+    distances, indices = [], []
+    for start in range(0, len(Z), chunk_size):
+        chunk_distances = torch.cdist(Z[start:start + chunk_size], reference)
+        if exclude_self:
+            rows = torch.arange(len(chunk_distances))
+            chunk_distances[rows, rows + start] = float('inf')
+        chunk_distances, chunk_indices = torch.topk(chunk_distances, n_neighbors, dim=1, largest=False)
+        distances.append(chunk_distances)
+        indices.append(chunk_indices)
+    return torch.cat(distances).numpy(), torch.cat(indices).numpy()
+
+
+class NeighborGraphProjection(object):
+    """
+    PCA -> cached kNN graph -> t-SNE projection to 2-D, with out-of-sample transform
+    """
+    def __init__(self, n_pca_components=50, perplexity=10, n_neighbors=None, n_transform_neighbors=10,
+                 random_state=0, n_jobs=-1) -> None:
+        """
+        Parameters
+        ---------------------------------------
+        n_neighbors: int, size of the kNN graph, by default (and at least) 3 * perplexity + 1 as
+        t-SNE needs
+        n_transform_neighbors: int, fitted points a new point is interpolated from
+        """
+        self.n_pca_components = n_pca_components
+        self.perplexity = perplexity
+        self.n_neighbors = n_neighbors if n_neighbors is not None else int(3 * perplexity + 1)
+        if self.n_neighbors < int(3 * perplexity + 1):
+            raise ValueError(f'n_neighbors={self.n_neighbors} is too small, t-SNE needs at least {int(3 * perplexity + 1)}.')
+        self.n_transform_neighbors = n_transform_neighbors
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+
+        # fitted state
+        self.mean = None
+        self.components = None
+        self.pca_embedding = None
+        self.embedding = None
+
+    def settings(self) -> dict:
+        return {name: getattr(self, name) for name in PROJECTION_SETTINGS}
+
+    def settings_key(self) -> str:
+        """Short hash of settings(), to key saved projections by"""
+        return hashlib.sha256(json.dumps(self.settings(), sort_keys=True).encode()).hexdigest()[:16]
+
+    def _pca_project(self, X) -> torch.Tensor:
+        return (torch.as_tensor(np.asarray(X, dtype=np.float32)) - self.mean) @ self.components
+
+    def fit_transform(self, X, cache_dir=None) -> np.ndarray:
+        """
+        Parameters
+        ---------------------------------------
+        X: array of shape (n_samples, n_features), e.g. EmbeddingStore.embeddings
+        cache_dir: str, where the kNN graph is cached. It is only valid for this X, so use a
+        directory keyed by the data (e.g. the embedding store directory)
+
+        return
+        ---------------------------------------
+        2-D embedding, has shape: (n_samples, 2)
+        """
+        # thread count and RNG are process wide, restore them for the caller's training
+        n_threads = torch.get_num_threads()
+        if self.n_jobs is not None and self.n_jobs > 0:
+            torch.set_num_threads(self.n_jobs)
+        try:
+            return self._fit_transform(X, cache_dir)
+        finally:
+            torch.set_num_threads(n_threads)
+
+    def _fit_transform(self, X, cache_dir) -> np.ndarray:
+        X = torch.from_numpy(np.array(X, dtype=np.float32))
+        n_pca_components = min(self.n_pca_components, *X.shape)
+        self.mean = X.mean(0)
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.random_state)
+            _, _, V = torch.pca_lowrank(X, q=n_pca_components, center=True)
+        self.components = V
+        Z = self._pca_project(X)
+        self.pca_embedding = Z
+        del X
+
+        graph_path = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            graph_path = os.path.join(cache_dir, f'knn_{len(Z)}_{self.settings_key()}.npz')
+        if graph_path is not None and os.path.exists(graph_path):
+            graph = np.load(graph_path)
+            distances, indices = graph['distances'], graph['indices']
+        else:
+            distances, indices = knn_graph(Z, Z, min(self.n_neighbors, len(Z) - 1), exclude_self=True)
+            if graph_path is not None:
+                np.savez(graph_path, distances=distances, indices=indices)
+
+        n_samples = len(Z)
+        # t-SNE queries n_neighbors + 1 entries per row and then drops the point itself,
+        # so every row starts with its self entry as an explicit zero
+        distances = np.hstack([np.zeros((n_samples, 1), dtype=distances.dtype), distances])
+        indices = np.hstack([np.arange(n_samples)[:, None], indices])
+        row_length = indices.shape[1]
+        # t-SNE squares euclidean distances itself, precomputed ones are used as given
+        graph = csr_matrix(
+            (distances.ravel() ** 2, indices.ravel(), np.arange(0, n_samples * row_length + 1, row_length)),
+            shape=(n_samples, n_samples)
+        )
+        # PCA init, scaled as sklearn does for init='pca' (not allowed with a precomputed metric)
+        init = Z[:, :2].numpy()
+        init = init / np.std(init[:, 0]) * 1e-4
+        tsne_model = TSNE(
+            n_components=2,
+            perplexity=self.perplexity,
+            metric='precomputed',
+            init=init,
+            method='barnes_hut',
+            random_state=self.random_state,
+            n_jobs=self.n_jobs
+        )
+        self.embedding = tsne_model.fit_transform(graph)
+        return self.embedding
+
+    def transform(self, X) -> np.ndarray:
+        """
+        Place new points in the fitted 2-D embedding without refitting
+
+        return
+        ---------------------------------------
+        2-D embedding of X, has shape: (n_samples, 2)
+        """
+        assert self.embedding is not None, "Projection has not been fitted"
+        distances, indices = knn_graph(self._pca_project(X), self.pca_embedding, self.n_transform_neighbors)
+        weights = 1. / (distances + 1e-8)
+        weights /= weights.sum(1, keepdims=True)
+        return np.einsum('nk,nkd->nd', weights, self.embedding[indices])
+
+    def save(self, path: str, **arrays) -> None:
+        """Save the fitted state and settings, plus any extra arrays (e.g. the fitted subject ids)"""
+        np.savez(
+            path,
+            settings=np.array(json.dumps(self.settings(), sort_keys=True)),
+            mean=self.mean.numpy(),
+            components=self.components.numpy(),
+            pca_embedding=self.pca_embedding.numpy(),
+            embedding=self.embedding,
+            **arrays
+        )
+
+    def load(self, path: str) -> dict:
+        """
+        Load a fitted state saved by save into this projection, return the extra arrays.
+        The saved settings must be the ones of this projection.
+        """
+        state = dict(np.load(path))
+        settings = json.loads(str(state.pop('settings')))
+        if settings != json.loads(json.dumps(self.settings(), sort_keys=True)):
+            raise ValueError(f'Projection {path} was fitted with {settings}, not {self.settings()}.')
+        self.mean = torch.from_numpy(state.pop('mean'))
+        self.components = torch.from_numpy(state.pop('components'))
+        self.pca_embedding = torch.from_numpy(state.pop('pca_embedding'))
+        self.embedding = state.pop('embedding')
+        return state
+
+
+def project_embedding_store(store, projection: NeighborGraphProjection) -> np.ndarray:
+    """
+    2-D embedding of every window of an EmbeddingStore. The fitted projection is saved next
+    to the stores of the same model weights (the parent directory of store.store_dir), keyed
+    by the projection settings. When a store gains subjects, only their windows are
+    projected (transform) and the windows fitted before keep their position, as long as
+    their embeddings are unchanged; otherwise the projection is refitted.
+
+    return
+    ---------------------------------------
+    2-D embedding, has shape: (n_windows, 2)
+    """
+    projection_path = os.path.join(
+        os.path.dirname(os.path.normpath(store.store_dir)), f'projection_{projection.settings_key()}.npz'
+    )
+    subject_ids = np.asarray(store.subject_ids)
+    if os.path.exists(projection_path):
+        fitted_subject_ids = projection.load(projection_path)['subject_ids']
+        fitted = np.isin(subject_ids, fitted_subject_ids)
+        fitted_rows = np.flatnonzero(fitted)
+        # windows of the fitted subjects must be the ones that were fitted, in the same order
+        if (np.array_equal(subject_ids[fitted], fitted_subject_ids) and torch.allclose(
+                projection._pca_project(store.embeddings[fitted_rows]), projection.pca_embedding, atol=1e-4)):
+            reduced_embeddings = np.empty((len(subject_ids), 2), dtype=projection.embedding.dtype)
+            reduced_embeddings[fitted] = projection.embedding
+            if not fitted.all():
+                print(f'Projecting {np.sum(~fitted)} new windows onto the fitted embedding')
+                reduced_embeddings[~fitted] = projection.transform(store.embeddings[np.flatnonzero(~fitted)])
+            return reduced_embeddings
+
+    reduced_embeddings = projection.fit_transform(store.embeddings, cache_dir=store.store_dir)
+    projection.save(projection_path, subject_ids=subject_ids)
+    return reduced_embeddings
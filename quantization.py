@@ -0,0 +1,285 @@
+'''
+Reduced-precision inference for CPU deployment: int8 (dynamic or static, calibrated on a
+subject's own calibration set) and fp16 / bf16 versions of primary nets, embedders and
+hypernets, and a report of the accuracy / latency / size change against the fp32 model.
+
+Typical use with a calibrated HyperBCINet:
+    classifier = calibrate_HNBCI.fold_calibrated().cpu()
+    quantized = quantize_model(classifier, 'static', calibration_loader=subj_calibrate_loader)
+    report = accuracy_delta_report(classifier, quantized, subj_valid_loader)
+
+or, quantizing the calibration path (embedder + hypernet) before calibration:
+    quantized_HNBCI = quantize_hypernet_bci(HNBCI, 'static', calibration_loader=subj_calibrate_loader)
+    report = hypernet_accuracy_delta_report(HNBCI, quantized_HNBCI, subj_calibrate_loader, subj_valid_loader)
+'''
+import io
+import time
+from copy import deepcopy
+
+import torch
+from torch.ao.quantization import QuantWrapper, quantize_dynamic, get_default_qconfig, prepare, convert
+from torch.utils.data import DataLoader
+
+# layers that get int8 weights and activations in 'static' mode
+STATIC_QUANTIZED_LAYERS = (torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Linear)
+
+
+class _CastInput(torch.nn.Module):
+    """Run a reduced-precision model on fp32 input and return fp32 output"""
+    def __init__(self, model: torch.nn.Module, dtype: torch.dtype) -> None:
+        super(_CastInput, self).__init__()
+        self.model = model
+        self.dtype = dtype
+
+    def forward(self, x):
+        return self.model(x.to(self.dtype)).float()
+
+
+@torch.no_grad()
+def _merge_combined_convs(model: torch.nn.Module) -> None:
+    # braindecode's CombinedConv (the temporal + spatial conv of ShallowFBCSPNet / Deep4Net)
+    # multiplies the conv_time and conv_spat weights inside its forward, so neither conv layer
+    # is ever called and neither would be quantized. Replace it by the equivalent single Conv2d
+    for name, module in list(model.named_modules()):
+        if type(module).__name__ != 'CombinedConv' or not name:
+            continue
+        conv_time, conv_spat = module.conv_time, module.conv_spat
+        merged = torch.nn.Conv2d(
+            1, conv_spat.out_channels, (conv_time.kernel_size[0], conv_spat.kernel_size[1]), bias=True
+        )
+        merged.weight.copy_((conv_time.weight * conv_spat.weight.permute(1, 0, 2, 3)).sum(0).unsqueeze(1))
+        bias = torch.zeros(conv_spat.out_channels)
+        if conv_time.bias is not None:
+            bias += torch.einsum('stc,t->s', conv_spat.weight[:, :, 0, :], conv_time.bias)
+        if conv_spat.bias is not None:
+            bias += conv_spat.bias
+        merged.bias.copy_(bias)
+        model.set_submodule(name, merged)
+
+
+def _prepare_static(model: torch.nn.Module) -> None:
+    """
+    Wrap every STATIC_QUANTIZED_LAYERS layer of model in place with quant / dequant stubs and
+    activation observers. Layer by layer (eager mode) rather than by tracing the model, so
+    shape-dependent braindecode modules and forward hooks (e.g. ShallowFBCSPEmbedder) keep working
+    """
+    _merge_combined_convs(model)
+    qconfig = get_default_qconfig('x86')
+    for name, module in list(model.named_modules()):
+        if name and isinstance(module, STATIC_QUANTIZED_LAYERS):
+            wrapped = QuantWrapper(module)
+            wrapped.qconfig = qconfig
+            model.set_submodule(name, wrapped)
+    prepare(model, inplace=True)
+
+
+def quantized_layer_names(model: torch.nn.Module) -> list:
+    """Names of the layers of a quantize_model / quantize_hypernet_bci output that run in reduced precision"""
+    return [
+        name for name, module in model.named_modules()
+        if isinstance(module, QuantWrapper)
+        or type(module).__module__.startswith('torch.ao.nn.quantized.dynamic')
+        or any(param.dtype in (torch.float16, torch.bfloat16) for param in module.parameters(recurse=False))
+    ]
+
+
+def quantize_model(
+        model: torch.nn.Module,
+        mode='dynamic',
+        calibration_loader: DataLoader = None,
+        n_calibration_batches=None
+    ) -> torch.nn.Module:
+    """
+    Return a reduced-precision copy of model for CPU inference. The input model is untouched.
+
+    Parameters
+    ---------------------------------------
+    mode: str, one of
+        'dynamic': int8 weights for Linear / LSTM / GRU layers, activations quantized on the
+        fly. No calibration data needed; conv layers stay fp32
+        'static': int8 weights and activations for conv and linear layers (including
+        braindecode's merged temporal + spatial conv), with activation ranges observed on
+        calibration_loader (e.g. the subject's calibration set). Other layers stay fp32
+        'fp16' / 'bf16': all weights cast to half / bfloat16 (bf16 is the one with CPU kernels)
+    calibration_loader: DataLoader yielding (X, y, _), required for 'static'
+    n_calibration_batches: int, use only this many calibration batches
+    """
+    model = deepcopy(model).cpu().eval()
+
+    match mode:
+        case 'dynamic':
+            return quantize_dynamic(
+                model,
+                {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU},
+                dtype=torch.qint8
+            )
+        case 'static':
+            assert calibration_loader is not None, 'Static quantization needs calibration data'
+            _prepare_static(model)
+            # observe activation ranges
+            with torch.no_grad():
+                for batch_idx, (X, _, _) in enumerate(calibration_loader):
+                    if n_calibration_batches is not None and batch_idx >= n_calibration_batches:
+                        break
+                    model(X.float())
+            return convert(model, inplace=True)
+        case 'fp16':
+            return _CastInput(model.half(), torch.float16)
+        case 'bf16':
+            return _CastInput(model.to(torch.bfloat16), torch.bfloat16)
+        case _:
+            raise ValueError(f'Quantization mode {mode} is not defined.')
+
+
+def quantize_hypernet_bci(
+        model: torch.nn.Module,
+        mode='dynamic',
+        calibration_loader: DataLoader = None,
+        n_calibration_batches=None
+    ) -> torch.nn.Module:
+    """
+    Return a copy of a HyperBCINet whose embedder and hypernet (the calibration path) are
+    quantized. The primary net is left in fp32, since it runs through functional_call with
+    the generated weight; quantize it after calibration via fold_calibrated() instead.
+
+    Parameters
+    ---------------------------------------
+    mode: str, as in quantize_model. For 'static', the embedder activations are observed on
+    the calibration_loader trials and the hypernet activations on their embeddings
+    """
+    model = deepcopy(model).cpu().eval()
+    if mode != 'static':
+        model.embedder = quantize_model(model.embedder, mode)
+        model.hypernet = quantize_model(model.hypernet, mode)
+        return model
+
+    assert calibration_loader is not None, 'Static quantization needs calibration data'
+    _prepare_static(model.embedder)
+    _prepare_static(model.hypernet)
+    # observe activation ranges along the calibration path of HyperBCINet.forward, without
+    # touching the primary params
+    with torch.no_grad():
+        for batch_idx, (X, _, _) in enumerate(calibration_loader):
+            if n_calibration_batches is not None and batch_idx >= n_calibration_batches:
+                break
+            for embedding in model.embedder(X.float()):
+                model.hypernet(embedding)
+    convert(model.embedder, inplace=True)
+    convert(model.hypernet, inplace=True)
+    return model
+
+
+def model_size_bytes(model: torch.nn.Module) -> int:
+    """Size of the serialized state dict"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+@torch.no_grad()
+def _compare_predictions(
+        reference_model: torch.nn.Module,
+        quantized_model: torch.nn.Module,
+        dataloader: DataLoader
+    ) -> dict:
+    """Accuracy of both models, prediction agreement and per-trial latency on dataloader"""
+    reference_model = reference_model.cpu().eval()
+    quantized_model.eval()
+    correct = {'reference': 0, 'quantized': 0}
+    elapsed = {'reference': 0., 'quantized': 0.}
+    agreement = 0
+
+    for X, y, _ in dataloader:
+        X = X.float()
+        predictions = {}
+        for name, model in [('reference', reference_model), ('quantized', quantized_model)]:
+            start = time.perf_counter()
+            predictions[name] = model(X).argmax(1)
+            elapsed[name] += time.perf_counter() - start
+            correct[name] += (predictions[name] == y).sum().item()
+        agreement += (predictions['reference'] == predictions['quantized']).sum().item()
+
+    size = len(dataloader.dataset)
+    report = {
+        'reference_accuracy': correct['reference'] / size,
+        'quantized_accuracy': correct['quantized'] / size,
+        'prediction_agreement': agreement / size,
+        'reference_latency_ms_per_trial': 1e3 * elapsed['reference'] / size,
+        'quantized_latency_ms_per_trial': 1e3 * elapsed['quantized'] / size
+    }
+    report['accuracy_delta'] = report['quantized_accuracy'] - report['reference_accuracy']
+    return report
+
+
+def _print_report(report: dict, latency_name: str) -> None:
+    print(
+        f"Accuracy {100 * report['reference_accuracy']:.1f}% -> {100 * report['quantized_accuracy']:.1f}%, "
+        f"{latency_name} {report[f'reference_{latency_name}_ms_per_trial']:.3f} -> "
+        f"{report[f'quantized_{latency_name}_ms_per_trial']:.3f} ms/trial, "
+        f"size {report['reference_size_bytes']} -> {report['quantized_size_bytes']} bytes\n"
+        f"Quantized layers: {', '.join(report['quantized_layers']) or 'none'}"
+    )
+
+
+def accuracy_delta_report(
+        reference_model: torch.nn.Module,
+        quantized_model: torch.nn.Module,
+        dataloader: DataLoader
+    ) -> dict:
+    """
+    Compare a quantized model against its fp32 reference on a held-out set (e.g. the 1test
+    run) on CPU: accuracy of both, prediction agreement, per-trial latency, model size and
+    which layers were quantized
+    """
+    report = _compare_predictions(reference_model, quantized_model, dataloader)
+    report['reference_size_bytes'] = model_size_bytes(reference_model)
+    report['quantized_size_bytes'] = model_size_bytes(quantized_model)
+    report['quantized_layers'] = quantized_layer_names(quantized_model)
+    _print_report(report, 'latency')
+    return report
+
+
+@torch.no_grad()
+def _calibrate_copy(model: torch.nn.Module, calibration_loader: DataLoader):
+    """
+    Calibrate a CPU copy of a HyperBCINet on calibration_loader, as the calibration drivers
+    do, and return its folded primary net and the calibration time
+    """
+    model = deepcopy(model).cpu().eval()
+    model.primary_params = {name: tensor.cpu() for name, tensor in model.primary_params.items()}
+    model.calibrate()
+    start = time.perf_counter()
+    for X, _, _ in calibration_loader:
+        model(X.float())
+    elapsed = time.perf_counter() - start
+    model.calibrating = False
+    return model.fold_calibrated(), elapsed
+
+
+def hypernet_accuracy_delta_report(
+        reference_model: torch.nn.Module,
+        quantized_model: torch.nn.Module,
+        calibration_loader: DataLoader,
+        dataloader: DataLoader
+    ) -> dict:
+    """
+    Compare a HyperBCINet with quantized embedder / hypernet (quantize_hypernet_bci) against
+    its fp32 reference: both are calibrated on the same calibration_loader, then their
+    calibrated primary nets are scored on dataloader (e.g. the 1test run). Neither input
+    model is modified. Reports accuracy of both, prediction agreement, per-trial calibration
+    time, embedder + hypernet size and which layers were quantized
+    """
+    reference_net, reference_elapsed = _calibrate_copy(reference_model, calibration_loader)
+    quantized_net, quantized_elapsed = _calibrate_copy(quantized_model, calibration_loader)
+
+    report = _compare_predictions(reference_net, quantized_net, dataloader)
+    # both primary nets are fp32, only the calibration path differs
+    del report['reference_latency_ms_per_trial'], report['quantized_latency_ms_per_trial']
+    n_calibration_trials = len(calibration_loader.dataset)
+    report['reference_calibration_ms_per_trial'] = 1e3 * reference_elapsed / n_calibration_trials
+    report['quantized_calibration_ms_per_trial'] = 1e3 * quantized_elapsed / n_calibration_trials
+    report['reference_size_bytes'] = model_size_bytes(reference_model.embedder) + model_size_bytes(reference_model.hypernet)
+    report['quantized_size_bytes'] = model_size_bytes(quantized_model.embedder) + model_size_bytes(quantized_model.hypernet)
+    report['quantized_layers'] = quantized_layer_names(quantized_model)
+    _print_report(report, 'calibration')
+    return report
@@ -0,0 +1,214 @@
+'''
+Train R replicas of one model in lockstep, each on its own data, as a single stacked model:
+parameters and buffers of the replicas are stacked along a new first dimension
+(torch.func.stack_module_state) and the forward pass is vmapped over it. Used for the
+'repetition' loop of the fine-tuning experiments, where every repetition fine-tunes the same
+pretrained model on a different random subset with small batches.
+
+One optimizer over the stacked parameters trains every replica independently: the loss is
+the sum of the per-replica losses, so the gradient of each slice only depends on its own
+replica, and Adam(W)'s state is elementwise, hence per replica as well.
+
+Only models whose forward is a pure function of their parameters, buffers and input can be
+replicated this way (e.g. ShallowFBCSPNet); HyperBCINet stores weights and embeddings on the
+module during the forward pass and is not supported.
+
+Distinct models of the same architecture can be stacked too (StackedReplicas.from_models),
+e.g. the per-subject models of the ensemble baseline, to evaluate all of them on a test set
+in one pass (evaluate_replicas).
+'''
+from copy import deepcopy
+
+import torch
+from torch import nn
+from torch.func import stack_module_state, functional_call, vmap
+
+from utils import autocast_context, make_grad_scaler
+
+
+class StackedReplicas(object):
+    """
+    n_replicas copies of a model with stacked parameters / buffers, has the same
+    train / eval / parameters interface as the model it replicates
+    """
+    def __init__(self, model: nn.Module, n_replicas: int) -> None:
+        """
+        Parameters
+        ---------------------------------------
+        model: nn.Module, every replica starts from its weights. Parameters with
+        requires_grad=False (e.g. after freeze_param) stay frozen in all replicas
+        """
+        self.n_replicas = n_replicas
+        self.params, self.buffers = stack_module_state([deepcopy(model) for _ in range(n_replicas)])
+        # stateless skeleton; functional_call swaps in the stacked tensors
+        self.base = deepcopy(model).to('meta')
+
+    @classmethod
+    def from_models(cls, models: list) -> 'StackedReplicas':
+        """Stack distinct models of the same architecture, on the same device"""
+        replicas = cls.__new__(cls)
+        replicas.n_replicas = len(models)
+        replicas.params, replicas.buffers = stack_module_state(models)
+        replicas.base = deepcopy(models[0]).to('meta')
+        return replicas
+
+    def select(self, indices: torch.Tensor) -> 'StackedReplicas':
+        """Replicas at indices, stacked again (a copy, detached from the original)"""
+        replicas = self.__class__.__new__(self.__class__)
+        replicas.n_replicas = len(indices)
+        replicas.params = {name: param[indices].detach() for name, param in self.params.items()}
+        replicas.buffers = {name: buffer[indices] for name, buffer in self.buffers.items()}
+        replicas.base = self.base
+        return replicas
+
+    def parameters(self) -> list:
+        return [param for param in self.params.values() if param.requires_grad]
+
+    def train(self, mode=True) -> None:
+        self.base.train(mode)
+
+    def eval(self) -> None:
+        self.base.train(False)
+
+    def _call(self, params, buffers, x):
+        return functional_call(self.base, (params, buffers), (x,))
+
+    def __call__(self, X: torch.Tensor, shared_input=False) -> torch.Tensor:
+        """
+        Parameters
+        ---------------------------------------
+        X: torch tensor, has shape: (n_replicas, batch_size, *sample_shape), or
+        (batch_size, *sample_shape) if shared_input, to run every replica on the same batch
+
+        return
+        ---------------------------------------
+        output of every replica, has shape: (n_replicas, batch_size, ...)
+        """
+        in_dims = (0, 0, None if shared_input else 0)
+        # batch norm running stats are batched buffers, so their in-place update is allowed
+        return vmap(self._call, in_dims=in_dims, randomness='different')(self.params, self.buffers, X)
+
+    def state_dict(self, replica: int) -> dict:
+        """Weights of one replica, loadable into the model that was replicated"""
+        return {name: tensor[replica].detach().clone() for name, tensor in {**self.params, **self.buffers}.items()}
+
+
+def train_one_epoch_replicas(
+    dataloaders: list,
+    replicas: StackedReplicas,
+    loss_fn,
+    optimizer,
+    scheduler,
+    device="cuda",
+    precision='fp32',
+    scaler=None,
+    accumulation_steps=1
+):
+    """
+    train_one_epoch for stacked replicas. Replica r trains on dataloaders[r]; the loaders
+    must yield batches of the same size in lockstep (same subset size and batch size).
+    precision, scaler, accumulation_steps: as in train_one_epoch
+
+    return
+    ---------------------------------------
+    lists of per-replica average train loss and accuracy
+    """
+    assert len(dataloaders) == replicas.n_replicas, "Need one dataloader per replica"
+    replicas.train()
+    train_loss = torch.zeros(replicas.n_replicas, device=device)
+    correct = torch.zeros(replicas.n_replicas, dtype=torch.long, device=device)
+    n_batches = len(dataloaders[0])
+    per_step_scheduler = getattr(scheduler, 'per_step', False)
+    autocast = autocast_context(precision, device)
+    if scaler is None:
+        scaler = make_grad_scaler(precision, device)
+
+    optimizer.zero_grad()
+    for batch_idx, batches in enumerate(zip(*dataloaders)):
+        X = torch.stack([X for X, _, _ in batches]).to(device)
+        y = torch.stack([y for _, y, _ in batches]).to(device)
+        with autocast:
+            pred = replicas(X)
+            losses = vmap(loss_fn)(pred, y)
+        # sum, not mean: every replica gets the gradient of its own loss. Averaged over the
+        # batches of this step, the last step may have fewer
+        group_start = batch_idx - batch_idx % accumulation_steps
+        group_size = min(accumulation_steps, n_batches - group_start)
+        scaler.scale(losses.sum() / group_size).backward()
+        if batch_idx + 1 == group_start + group_size:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+            if per_step_scheduler:
+                scheduler.step()
+
+        train_loss += losses.detach()
+        correct += (pred.argmax(-1) == y).sum(1)
+
+    if not per_step_scheduler:
+        scheduler.step()
+
+    size = len(dataloaders[0].dataset)
+    return (train_loss / n_batches).tolist(), (correct / size).tolist()
+
+
+@torch.no_grad()
+def test_replicas(dataloader, replicas: StackedReplicas, loss_fn, device="cuda"):
+    """
+    test_model for stacked replicas, all evaluated on the same dataloader
+
+    return
+    ---------------------------------------
+    lists of per-replica average test loss and accuracy
+    """
+    replicas.eval()
+    test_loss = torch.zeros(replicas.n_replicas, device=device)
+    correct = torch.zeros(replicas.n_replicas, dtype=torch.long, device=device)
+
+    for X, y, _ in dataloader:
+        X, y = X.to(device), y.to(device)
+        pred = replicas(X, shared_input=True)
+        y = y.expand(replicas.n_replicas, -1)
+        test_loss += vmap(loss_fn)(pred, y)
+        correct += (pred.argmax(-1) == y).sum(1)
+
+    test_loss = (test_loss / len(dataloader)).tolist()
+    correct = (correct / len(dataloader.dataset)).tolist()
+    print(
+        f"Test Accuracy: {100 * sum(correct) / len(correct):.1f}% "
+        f"({', '.join(f'{100 * acc:.1f}%' for acc in correct)})\n"
+    )
+    return test_loss, correct
+
+
+@torch.no_grad()
+def evaluate_replicas(dataloader, replicas: StackedReplicas, device="cuda", ensemble_mask=None):
+    """
+    Evaluate every replica and their ensemble on the same dataloader, in one pass over the
+    data. The ensemble predicts the argmax of the outputs averaged over the replicas in
+    ensemble_mask. Activation memory grows with n_replicas * batch_size.
+
+    Parameters
+    ---------------------------------------
+    ensemble_mask: list of bool, one per replica, which replicas the ensemble averages over.
+    Default all of them
+
+    return
+    ---------------------------------------
+    list of per-replica accuracy, ensemble accuracy
+    """
+    replicas.eval()
+    if ensemble_mask is None:
+        ensemble_mask = [True] * replicas.n_replicas
+    ensemble_mask = torch.as_tensor(ensemble_mask, dtype=torch.bool, device=device)
+    correct = torch.zeros(replicas.n_replicas, dtype=torch.long, device=device)
+    ensemble_correct = torch.zeros((), dtype=torch.long, device=device)
+
+    for X, y, _ in dataloader:
+        X, y = X.to(device), y.to(device)
+        pred = replicas(X, shared_input=True)
+        correct += (pred.argmax(-1) == y).sum(1)
+        ensemble_correct += (pred[ensemble_mask].mean(0).argmax(-1) == y).sum()
+
+    size = len(dataloader.dataset)
+    return (correct / size).tolist(), (ensemble_correct / size).item()
@@ -0,0 +1,147 @@
+'''
+Sequence dataset for the sleep staging scripts: sequences of n_windows consecutive windows
+served as slices of one contiguous float32 (n_windows_total, C, T) array per preloaded
+recording, or read in one call from disk for recordings that are not preloaded (the window
+store), with labels read from the windows metadata.
+
+It replaces the braindecode SequenceSampler + BaseConcatDataset.__getitem__(list of indices)
+pattern, which copies every window of a sequence out of the raw on each access (overlapping
+sequences fetch the shared windows again) and has to load the signal just to read a label.
+
+    train_seq_set = WindowSequenceDataset(train_set, n_windows, n_windows_stride)
+    test_seq_set = WindowSequenceDataset(test_set, n_windows, n_windows_stride)
+    compute_class_weight('balanced', classes=np.unique(test_seq_set.y), y=test_seq_set.y)
+    EEGClassifier(..., iterator_train__shuffle=True, train_split=predefined_split(test_seq_set))
+'''
+import hashlib
+
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset
+from braindecode.datasets import BaseConcatDataset
+
+
+def _windows_key(ds) -> str:
+    """Hash of the window starts and targets of a recording, changes with any window subset"""
+    hasher = hashlib.sha1(ds.metadata['i_start_in_trial'].to_numpy().astype(np.int64).tobytes())
+    hasher.update(ds.metadata['target'].to_numpy().astype(np.int64).tobytes())
+    return hasher.hexdigest()
+
+
+def sequence_table(ds, n_windows: int, n_windows_stride: int) -> tuple:
+    """
+    Start window of every sequence of a recording and the labels of its windows. Cached on
+    the dataset (ds._sequence_tables), so it is freed with it. Sequences start every
+    n_windows_stride windows, as in SequenceSampler, and never span two recordings.
+
+    Parameters
+    ---------------------------------------
+    ds: EEGWindowsDataset, windows of one recording
+
+    return
+    ---------------------------------------
+    starts: np.ndarray of shape (n_sequences,)
+    labels: np.ndarray of shape (n_sequences, n_windows)
+    """
+    if not hasattr(ds, '_sequence_tables'):
+        ds._sequence_tables = {}
+    key = (_windows_key(ds), n_windows, n_windows_stride)
+    if key not in ds._sequence_tables:
+        targets = ds.metadata['target'].to_numpy().astype(np.int64)
+        starts = np.arange(0, len(ds) - n_windows + 1, n_windows_stride)
+        labels = targets[starts[:, None] + np.arange(n_windows)]
+        ds._sequence_tables[key] = (starts, labels)
+    return ds._sequence_tables[key]
+
+
+def _window_bounds(ds) -> tuple:
+    i_start = ds.metadata['i_start_in_trial'].to_numpy()
+    i_stop = ds.metadata['i_stop_in_trial'].to_numpy()
+    window_len = int(i_stop[0] - i_start[0])
+    assert np.all(i_stop - i_start == window_len), 'All windows must have the same length'
+    assert ds.transform is None, 'Window transforms are not supported'
+    return i_start, i_stop, window_len
+
+
+def _read_windows(raw, i_start, i_stop, window_len) -> np.ndarray:
+    """Windows [i_start, i_stop) of raw as a float32 array of shape (n_windows, C, T)"""
+    if np.all(i_start[1:] == i_stop[:-1]):
+        # back to back windows are read in one call
+        data = raw.get_data(start=int(i_start[0]), stop=int(i_stop[-1]))
+        # (C, n_windows * T) -> (n_windows, C, T)
+        data = data.reshape(data.shape[0], len(i_start), window_len).transpose(1, 0, 2)
+    else:
+        data = np.stack([raw.get_data(start=int(start), stop=int(stop)) for start, stop in zip(i_start, i_stop)])
+    return np.ascontiguousarray(data, dtype=np.float32)
+
+
+def window_array(ds) -> np.ndarray:
+    """
+    All windows of a recording as one contiguous float32 array of shape (n_windows, C, T).
+    Back to back windows (window stride == window size) are read from the raw in one call.
+    """
+    return _read_windows(ds.raw, *_window_bounds(ds))
+
+
+class LazyWindowArray(object):
+    """
+    Windows of a recording that is not preloaded (e.g. from window_store.load_window_store),
+    read from disk on access: slicing [start:stop] reads only those windows, as a float32
+    (stop - start, C, T) array. Nothing of the signal is held in memory.
+    """
+    def __init__(self, ds) -> None:
+        self.raw = ds.raw
+        self.i_start, self.i_stop, self.window_len = _window_bounds(ds)
+
+    def __len__(self) -> int:
+        return len(self.i_start)
+
+    def __getitem__(self, index: slice) -> np.ndarray:
+        return _read_windows(self.raw, self.i_start[index], self.i_stop[index], self.window_len)
+
+
+class WindowSequenceDataset(Dataset):
+    """
+    Sequences of n_windows consecutive windows of a windowed BaseConcatDataset. Item i is
+    (X, y, i) with X the (n_windows, C, T) windows of the sequence and y the center label
+    (same window as utils.get_center_label) or, with center_label=False, the labels of all
+    windows (USleep). Preloaded recordings are copied once into a window array and X is a
+    view into it; recordings that are not preloaded stay on disk and X is read per item.
+    """
+    def __init__(self, windows_set: BaseConcatDataset, n_windows: int, n_windows_stride: int, center_label=True) -> None:
+        self.n_windows = n_windows
+        self.center_label = center_label
+        self.center_idx = int(np.ceil(n_windows / 2)) if n_windows > 1 else 0
+        self.windows = []
+        recording_idx, starts, labels = [], [], []
+        for ds in windows_set.datasets:
+            if len(ds) < n_windows:
+                continue
+            rec_starts, rec_labels = sequence_table(ds, n_windows, n_windows_stride)
+            recording_idx.append(np.full(len(rec_starts), len(self.windows)))
+            starts.append(rec_starts)
+            labels.append(rec_labels)
+            self.windows.append(window_array(ds) if ds.raw.preload else LazyWindowArray(ds))
+        assert self.windows, f'No recording has {n_windows} windows'
+
+        self.recording_idx = np.concatenate(recording_idx)
+        self.starts = np.concatenate(starts)
+        # labels of every window of every sequence, shape (n_sequences, n_windows)
+        self.labels = np.concatenate(labels)
+
+    @property
+    def y(self) -> np.ndarray:
+        """Targets of all sequences, without touching the signal"""
+        if self.center_label:
+            return self.labels[:, self.center_idx]
+        return self.labels
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __getitem__(self, index: int):
+        start = self.starts[index]
+        X = torch.from_numpy(self.windows[self.recording_idx[index]][start:start + self.n_windows])
+        y = self.labels[index, self.center_idx] if self.center_label else self.labels[index]
+        return X, y, index
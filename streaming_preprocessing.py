@@ -0,0 +1,277 @@
+'''
+Stateful, chunk-wise versions of the preprocessing chain used offline in the MI scripts
+(pick_types, x1e6, mne 'filter', exponential_moving_standardize). Each operator carries its
+state across calls, so a recording can be fed in consecutive chunks of arbitrary size, either
+from a live stream or from a recording too large to load at once.
+
+With the default settings the output is numerically equivalent to the offline chain: the
+FIR bandpass uses the same taps and edge padding as mne's zero-phase filter, and the
+exponential moving standardization reproduces braindecode's weighting and init block. The
+price is latency: an operator only returns a sample once everything it depends on has
+arrived (half the FIR length for the filter, init_block_size samples at the start for EMS),
+so process() may return fewer samples than it was given. flush() returns the rest at the end.
+'''
+import numpy as np
+from mne import pick_types
+from mne.filter import create_filter
+from scipy.signal import butter, sosfilt, sosfilt_zi, lfilter, oaconvolve
+
+
+def _odd_reflect(x: np.ndarray, n_pad: int, left: bool) -> np.ndarray:
+    """
+    Pad of n_pad samples for one edge of x, as mne's 'reflect_limited': point reflection
+    about the edge sample, limited to the signal length, then zeros
+    """
+    n_reflect = min(n_pad, x.shape[1] - 1)
+    zeros = np.zeros((x.shape[0], n_pad - n_reflect))
+    if left:
+        return np.concatenate((zeros, 2 * x[:, :1] - x[:, n_reflect:0:-1]), axis=1)
+    return np.concatenate((2 * x[:, -1:] - x[:, -2:-n_reflect - 2:-1], zeros), axis=1)
+
+
+class StreamingFIRBandpass(object):
+    """
+    The FIR bandpass of mne's Raw.filter (zero phase, firwin design, reflect_limited padding),
+    applied by overlap-save convolution with carried input history. Output lags the input by
+    half the filter length.
+    """
+    def __init__(self, n_chans: int, sfreq: float, l_freq=4., h_freq=38.) -> None:
+        self.n_chans = n_chans
+        self.h = create_filter(None, sfreq, l_freq, h_freq, verbose=False)
+        # linear phase, odd length: output n depends on inputs up to n + delay
+        self.delay = (len(self.h) - 1) // 2
+        self.reset()
+
+    def reset(self) -> None:
+        # last len(h) - 1 samples of the (start-padded) input
+        self.history = None
+        # input held back until the start padding can be built
+        self.pending = np.zeros((self.n_chans, 0))
+
+    def _convolve(self, extended: np.ndarray) -> np.ndarray:
+        return oaconvolve(extended, self.h[None, :], mode='valid', axes=-1)
+
+    def process(self, chunk: np.ndarray) -> np.ndarray:
+        """
+        Parameters
+        ---------------------------------------
+        chunk: np array, has shape: (n_chans, n_samples)
+
+        return
+        ---------------------------------------
+        filtered samples that are complete, has shape: (n_chans, n_out)
+        """
+        if self.history is None:
+            self.pending = np.concatenate((self.pending, chunk), axis=1)
+            if self.pending.shape[1] <= self.delay:
+                return np.zeros((self.n_chans, 0))
+            extended = np.concatenate((_odd_reflect(self.pending, self.delay, left=True), self.pending), axis=1)
+            self.pending = np.zeros((self.n_chans, 0))
+        else:
+            extended = np.concatenate((self.history, chunk), axis=1)
+        self.history = extended[:, -(len(self.h) - 1):]
+        return self._convolve(extended)
+
+    def flush(self) -> np.ndarray:
+        """Filter the last delay samples with the end padding, then reset"""
+        if self.history is None:
+            # the whole recording is shorter than delay samples
+            if not self.pending.shape[1]:
+                return self.pending
+            extended = np.concatenate((
+                _odd_reflect(self.pending, self.delay, left=True),
+                self.pending,
+                _odd_reflect(self.pending, self.delay, left=False)
+            ), axis=1)
+        else:
+            tail = self.history[:, -(self.delay + 1):]
+            extended = np.concatenate((self.history, _odd_reflect(tail, self.delay, left=False)), axis=1)
+        self.reset()
+        return self._convolve(extended)
+
+
+class StreamingBandpass(object):
+    """
+    Causal Butterworth bandpass filter (second-order sections) with carried filter state.
+    No added latency, but not equivalent to the offline (zero-phase FIR) filter.
+    """
+    def __init__(self, n_chans: int, sfreq: float, l_freq=4., h_freq=38., order=4) -> None:
+        self.n_chans = n_chans
+        self.sos = butter(order, [l_freq, h_freq], btype='bandpass', fs=sfreq, output='sos')
+        # (n_sections, n_chans, 2), initialized on the first chunk
+        self.zi = None
+
+    def reset(self) -> None:
+        self.zi = None
+
+    def process(self, chunk: np.ndarray) -> np.ndarray:
+        """
+        Parameters
+        ---------------------------------------
+        chunk: np array, has shape: (n_chans, n_samples)
+
+        return
+        ---------------------------------------
+        filtered chunk, has shape: (n_chans, n_samples)
+        """
+        if self.zi is None:
+            # steady state for a signal starting at the first sample, avoids a startup step
+            self.zi = sosfilt_zi(self.sos)[:, None, :] * chunk[None, :, :1]
+        filtered, self.zi = sosfilt(self.sos, chunk, axis=-1, zi=self.zi)
+        return filtered
+
+    def flush(self) -> np.ndarray:
+        self.reset()
+        return np.zeros((self.n_chans, 0))
+
+
+class StreamingEMS(object):
+    """
+    Exponential moving standardization with carried running mean and variance. Uses the same
+    bias-corrected (pandas adjust=True) exponential weighting as braindecode's
+    exponential_moving_standardize. If init_block_size is given, the first init_block_size
+    samples are standardized with their own mean and std as braindecode does; they are
+    returned once the whole block has arrived.
+    """
+    def __init__(self, n_chans: int, factor_new=1e-3, init_block_size=None, eps=1e-4) -> None:
+        self.n_chans = n_chans
+        self.factor_new = factor_new
+        self.decay = 1 - factor_new
+        self.init_block_size = init_block_size
+        self.eps = eps
+        self.reset()
+
+    def reset(self) -> None:
+        # running weighted sums of x and of the squared deviation, and samples seen so far
+        self.mean_zi = np.zeros((self.n_chans, 1))
+        self.var_zi = np.zeros((self.n_chans, 1))
+        self.n_seen = 0
+        # input and output held back until the init block is complete
+        self.pending_in = []
+        self.pending_out = []
+        self.init_done = self.init_block_size is None
+
+    def _ewm(self, x: np.ndarray, zi: np.ndarray):
+        # weighted sum s_t = x_t + decay * s_{t-1}, divided by the sum of weights
+        weighted_sum, zi = lfilter([1.], [1., -self.decay], x, axis=-1, zi=zi)
+        t = np.arange(self.n_seen + 1, self.n_seen + x.shape[-1] + 1)
+        weight_sum = (1 - self.decay ** t) / self.factor_new
+        return weighted_sum / weight_sum, zi
+
+    def _standardize(self, chunk: np.ndarray) -> np.ndarray:
+        mean, self.mean_zi = self._ewm(chunk, self.mean_zi)
+        demeaned = chunk - mean
+        var, self.var_zi = self._ewm(demeaned * demeaned, self.var_zi)
+        self.n_seen += chunk.shape[-1]
+        return demeaned / np.maximum(self.eps, np.sqrt(var))
+
+    def _release_init_block(self) -> np.ndarray:
+        data = np.concatenate(self.pending_in, axis=1)
+        standardized = np.concatenate(self.pending_out, axis=1)
+        init_block = data[:, :self.init_block_size]
+        init_mean = np.mean(init_block, axis=1, keepdims=True)
+        init_std = np.std(init_block, axis=1, keepdims=True)
+        standardized[:, :self.init_block_size] = (init_block - init_mean) / np.maximum(self.eps, init_std)
+        self.pending_in, self.pending_out = [], []
+        self.init_done = True
+        return standardized
+
+    def process(self, chunk: np.ndarray) -> np.ndarray:
+        """
+        Parameters
+        ---------------------------------------
+        chunk: np array, has shape: (n_chans, n_samples)
+
+        return
+        ---------------------------------------
+        standardized samples that are complete, has shape: (n_chans, n_out)
+        """
+        standardized = self._standardize(chunk)
+        if self.init_done:
+            return standardized
+        self.pending_in.append(chunk)
+        self.pending_out.append(standardized)
+        if self.n_seen < self.init_block_size:
+            return np.zeros((self.n_chans, 0))
+        return self._release_init_block()
+
+    def flush(self) -> np.ndarray:
+        """Return samples still held back (recording shorter than the init block), then reset"""
+        standardized = self._release_init_block() if self.pending_in else np.zeros((self.n_chans, 0))
+        self.reset()
+        return standardized
+
+
+class StreamingPreprocessor(object):
+    """
+    The MI preprocessing chain applied chunk by chunk: scale (V -> uV), bandpass,
+    exponential moving standardization. Expects channels already picked.
+
+    filter_method='fir' reproduces the offline mne filter (adds half the FIR length of
+    latency); 'iir' uses a causal Butterworth filter with no added latency.
+    """
+    def __init__(
+            self,
+            n_chans: int,
+            sfreq: float,
+            l_freq=4.,
+            h_freq=38.,
+            factor=1e6,
+            factor_new=1e-3,
+            init_block_size=1000,
+            filter_method='fir'
+        ) -> None:
+        self.factor = factor
+        match filter_method:
+            case 'fir':
+                self.bandpass = StreamingFIRBandpass(n_chans, sfreq, l_freq, h_freq)
+            case 'iir':
+                self.bandpass = StreamingBandpass(n_chans, sfreq, l_freq, h_freq)
+            case _:
+                raise ValueError(f'Filter method {filter_method} is not defined.')
+        self.ems = StreamingEMS(n_chans, factor_new, init_block_size)
+
+    def reset(self) -> None:
+        self.bandpass.reset()
+        self.ems.reset()
+
+    def process(self, chunk: np.ndarray) -> np.ndarray:
+        chunk = np.asarray(chunk, dtype=np.float64) * self.factor
+        return self.ems.process(self.bandpass.process(chunk))
+
+    def flush(self) -> np.ndarray:
+        standardized = self.ems.process(self.bandpass.flush())
+        return np.concatenate((standardized, self.ems.flush()), axis=1)
+
+
+def preprocess_raw_in_chunks(raw, chunk_size=100000, out=None, **preprocessor_kwargs) -> np.ndarray:
+    """
+    Apply the offline MI preprocessing chain to an mne Raw chunk by chunk. With a Raw loaded
+    with preload=False and out an np.memmap, only one chunk is held in memory at a time.
+
+    Parameters
+    ---------------------------------------
+    raw: mne Raw, unpreprocessed recording
+    chunk_size: number of samples read per chunk
+    out: optional array to write into, has shape: (n_eeg_chans, n_times)
+    preprocessor_kwargs: passed to StreamingPreprocessor
+
+    return
+    ---------------------------------------
+    out: preprocessed EEG channels, has shape: (n_eeg_chans, n_times)
+    """
+    picks = pick_types(raw.info, eeg=True, meg=False, stim=False)
+    preprocessor = StreamingPreprocessor(len(picks), raw.info['sfreq'], **preprocessor_kwargs)
+    if out is None:
+        out = np.empty((len(picks), raw.n_times))
+
+    write_idx = 0
+    for start in range(0, raw.n_times, chunk_size):
+        chunk = raw.get_data(picks=picks, start=start, stop=min(start + chunk_size, raw.n_times))
+        processed = preprocessor.process(chunk)
+        out[:, write_idx:write_idx + processed.shape[1]] = processed
+        write_idx += processed.shape[1]
+    processed = preprocessor.flush()
+    out[:, write_idx:write_idx + processed.shape[1]] = processed
+
+    return out
@@ -0,0 +1,21 @@
+import numpy as np
+
+from projection import NeighborGraphProjection
+
+
+def test_fit_transform_end_to_end(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(200, 64)).astype(np.float32)
+    projection = NeighborGraphProjection(n_pca_components=10, perplexity=5, n_jobs=1)
+
+    embedding = projection.fit_transform(X, cache_dir=str(tmp_path))
+    assert embedding.shape == (200, 2)
+    assert np.isfinite(embedding).all()
+
+    # cached kNN graph gives the same embedding
+    assert np.allclose(NeighborGraphProjection(n_pca_components=10, perplexity=5, n_jobs=1)
+                       .fit_transform(X, cache_dir=str(tmp_path)), embedding)
+
+    new_points = projection.transform(rng.normal(size=(7, 64)).astype(np.float32))
+    assert new_points.shape == (7, 2)
+    assert np.isfinite(new_points).all()
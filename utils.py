@@ -3,19 +3,27 @@ from braindecode.datasets.base import EEGWindowsDataset
 from sklearn.metrics import balanced_accuracy_score
 from importlib import import_module
 import random
+import math
+import inspect
 from numbers import Integral
 import numpy as np
 import argparse
 import json
 import pickle as pkl
-# from contextlib import nullcontext
+import hashlib
 import os
+from collections import OrderedDict
+from contextlib import nullcontext
 
 import torch
 from tqdm import tqdm
 from torch import nn
 from torch.optim.lr_scheduler import LRScheduler
 from torch.utils.data import DataLoader
+from skorch.callbacks import Callback
+
+from instrumentation import null_phase
+from baseline_MAPU.utils import ModelCheckpointer
 
 def generate_non_repeating_integers(x, y):
     # Check if y is greater than x
@@ -107,6 +115,57 @@ def get_subset(input_set, target_trial_num, random_sample=False, from_back=False
     return BaseConcatDataset(new_ds_lst)
 
 
+class SplitStats(object):
+    """
+    Trial counts and label histograms of a split (BaseConcatDataset), per run and in total,
+    read once from the metadata of each run instead of concatenating it with get_metadata()
+    """
+    def __init__(self, split: BaseConcatDataset) -> None:
+        targets = [
+            np.asarray((ds.metadata if hasattr(ds, 'metadata') else ds.windows.metadata)['target'], dtype=np.int64)
+            for ds in split.datasets
+        ]
+        n_labels = max((int(t.max()) + 1 for t in targets if len(t)), default=0)
+        self.run_trials = np.array([len(t) for t in targets], dtype=np.int64)
+        self.n_trials = int(self.run_trials.sum())
+        # shape (n_runs, n_labels)
+        self.run_label_counts = np.stack([np.bincount(t, minlength=n_labels) for t in targets])
+        self.label_counts = self.run_label_counts.sum(0)
+
+    @property
+    def classes(self) -> np.ndarray:
+        """Labels present in the split"""
+        return np.flatnonzero(self.label_counts)
+
+    @property
+    def class_weights(self) -> np.ndarray:
+        """compute_class_weight('balanced') weights of the classes present"""
+        return balanced_class_weights(self.label_counts)
+
+
+def split_stats(split: BaseConcatDataset) -> SplitStats:
+    """
+    SplitStats of split, cached on the split. Subsets from get_subset are new splits and get
+    their own; the cache is dropped if the runs of split change.
+    """
+    cached = getattr(split, '_split_stats', None)
+    # the cache holds the runs themselves, not their id(), so it can't match reused ids
+    if (cached is None or len(cached[0]) != len(split.datasets) 
+            or any(a is not b for a, b in zip(cached[0], split.datasets))):
+        cached = (list(split.datasets), SplitStats(split))
+        split._split_stats = cached
+    return cached[1]
+
+
+def balanced_class_weights(label_counts: np.ndarray) -> np.ndarray:
+    """
+    compute_class_weight('balanced', classes=np.unique(y), y=y) from the label histogram
+    np.bincount(y): one weight per class present, n_samples / (n_classes * count)
+    """
+    label_counts = label_counts[label_counts > 0]
+    return label_counts.sum() / (len(label_counts) * label_counts)
+
+
 def import_model(model_name: str) -> object:
     # try import from braindecode models first
     try:
@@ -149,6 +208,51 @@ def load_from_pickle(path):
     return dict_rtn
 
 
+def hash_pretrain_config(source_subjects, hparams, seed, code_paths=(), data_fingerprint=None):
+    """
+    Content key of a pretraining run. Two runs with the same source subjects and data,
+    pretraining hyperparameters, seed and pretraining code share the same key, so 
+    the pretrained model can be reused instead of retrained.
+
+    Parameters
+    ---------------------------------------
+    source_subjects: iterable of subject ids the model is pretrained on
+    hparams: dict of the hyperparameters that affect pretraining
+    seed: random seed used for pretraining
+    code_paths: absolute paths of the source files of the pretraining code (e.g. 
+    baseline_MAPU.pretrain.PRETRAIN_CODE_PATHS), their content is part of the key
+    data_fingerprint: str, content key of the source windows (e.g. 
+    embedding_store.dataset_fingerprint), so a re-windowed or re-split dataset is not reused
+    """
+    code_hashes = []
+    for path in code_paths:
+        with open(path, 'rb') as f:
+            code_hashes.append(hashlib.sha256(f.read()).hexdigest())
+
+    content = json.dumps({
+        'source_subjects': sorted(str(subj) for subj in source_subjects),
+        'hparams': hparams,
+        'seed': seed,
+        'code': code_hashes,
+        'data': data_fingerprint
+    }, sort_keys=True, default=str)
+
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+
+def hash_model_weights(state_dict: dict) -> str:
+    """
+    Content key of a model's weights: names, shapes, dtypes and values of every tensor
+    in its state dict
+    """
+    sha = hashlib.sha256()
+    for name in sorted(state_dict):
+        tensor = state_dict[name].detach().cpu()
+        sha.update(f'{name}:{tuple(tensor.shape)}:{tensor.dtype}'.encode())
+        sha.update(tensor.reshape(-1).contiguous().view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
 def parse_training_config():
     """
     Parse arguments
@@ -160,6 +264,9 @@ def parse_training_config():
     parser.add_argument('--model_name', default='SleepStagerChambon2018', type=str)
     parser.add_argument('--model_kwargs', default=None)
     parser.add_argument('--dataset_name', default='SleepPhysionet', type=str)
+    parser.add_argument('--window_store_dir', default='data/SleepPhysionet_windows', type=str, 
+                        help='On-disk store of preprocessed SleepPhysionet windows, one directory per night')
+    parser.add_argument('--n_jobs', default=4, type=int, help='Parallel workers for data ingestion')
     parser.add_argument('--data_amount_start', default=0, type=int)
     parser.add_argument('--data_amount_step', default=20, type=int, 
                         help='Increment training set size by this much each time. \
@@ -173,24 +280,51 @@ def parse_training_config():
     parser.add_argument('--random_seed', default=20200220, type=int)
 
     parser.add_argument('--lr_warmup', default=False, type=bool, help='whether to warm up learning rate during training')
+    parser.add_argument('--lr_schedule', default='epoch_cosine', type=str, 
+                        help='epoch_cosine (per epoch), warmup_cosine or one_cycle (per optimizer step)')
+    parser.add_argument('--warmup_fraction', default=0.1, type=float, 
+                        help='Fraction of optimizer steps used for warmup by the per-step schedules')
     parser.add_argument('--lr', default=1e-3, type=float, help='learning rate')
     parser.add_argument('--fine_tune_lr', default=1e-3, type=float, help='fine tune learning rate')
 
     parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--precision', default='fp32', type=str, help='fp32, fp16 or bf16 (autocast)')
+    parser.add_argument('--accumulation_steps', default=1, type=int, 
+                        help='Batches per optimizer step, effective batch size is batch_size * accumulation_steps')
 
     parser.add_argument('--n_epochs', default=50, type=int)
     parser.add_argument('--pretrain_n_epochs', default=50, type=int)
     parser.add_argument('--adaptation_n_epochs', default=50, type=int)
     parser.add_argument('--fine_tune_n_epochs', default=30, type=int)
+    parser.add_argument('--vectorize_repetitions', default=False, type=bool, 
+                        help='Fine tune all repetitions in lockstep as one stacked (vmapped) model')
 
     parser.add_argument('--significance_level', default=0.95, type=float)
 
+    parser.add_argument('--ensemble_weighting', default='uniform', type=str, 
+                        help='uniform, accuracy or similarity weighting of the EnsembleBCI members')
+    parser.add_argument('--ensemble_top_k', default=None, type=int, help='Keep only the k highest-weighted members (accuracy or similarity weighting)')
+    parser.add_argument('--ensemble_temperature', default=1., type=float)
+    parser.add_argument('--ensemble_n_unlabeled_trials', default=20, type=int, 
+                        help='Unlabeled target trials used for similarity weighting')
+
+    parser.add_argument('--early_stopping_patience', default=None, type=int, 
+                        help='Stop after this many epochs without improvement, None to run all epochs')
+    parser.add_argument('--early_stopping_min_delta', default=0., type=float)
+    parser.add_argument('--early_stopping_slope_window', default=None, type=int, 
+                        help='Also stop when the train loss slope over this many epochs flattens')
+    parser.add_argument('--early_stopping_slope_tol', default=1e-3, type=float)
+    parser.add_argument('--early_stopping_valid_fraction', default=0.2, type=float, 
+                        help='Fraction of the training trials held out to monitor early stopping on')
+
     parser.add_argument('--weight_decay', default=0, type=int)
     parser.add_argument('--fine_tune_weight_decay', default=0, type=int)
     
     parser.add_argument('--fine_tune_freeze_layer', default=None, type=list)
     parser.add_argument('--freeze_most_layers', default=False, type=bool)
     parser.add_argument('--fine_tune_freeze_layers_but', default=None, type=list)
+    parser.add_argument('--cache_frozen_prefix', default=False, type=bool, 
+                        help='Compute the frozen leading layers once per subset and fine tune the rest on their outputs')
 
     parser.add_argument('--forward_pass_kwargs', default=None)
 
@@ -203,12 +337,15 @@ def parse_training_config():
     parser.add_argument('--add_tov_loss', default=True, type=bool)
     parser.add_argument('--pretrain_lr', default=1e-3, type=float, help='pretraining learning rate')
     parser.add_argument('--imputer_lr', default=1e-5, type=float, help='imputer learning rate')
+    parser.add_argument('--imputer_type', default='lstm', type=str, help='lstm, gru or conv')
     parser.add_argument('--adaptation_lr', default=1e-5, type=float, help='adaptation learning rate')
     parser.add_argument('--adaptation_lr_decay', default=1e-5, type=float)
     parser.add_argument('--adaptation_lr_step_size', default=1e-5, type=float)
     parser.add_argument('--ent_loss_wt', default=0.4216, type=float)
     parser.add_argument('--im', default=0.5514, type=float)
     parser.add_argument('--TOV_wt', default=0.6385, type=float)
+    parser.add_argument('--single_pass_masking', default=False, type=bool, 
+                        help='Extract features of clean and masked inputs in one forward pass')
 
     args = parser.parse_args()
     with open(args.json, 'r') as f:
@@ -244,6 +381,494 @@ def freeze_all_param_but(module_obj, parameter_name_lst):
         param.requires_grad = False
 
 
+def resolve_amp_dtype(precision: str, device) -> torch.dtype:
+    """
+    Autocast dtype for a precision setting, None for full precision. fp16 falls back to
+    bf16 on CPU, bf16 falls back to fp16 on GPUs without bf16 support.
+
+    Parameters
+    ---------------------------------------
+    precision: str, one of 'fp32', 'fp16', 'bf16'
+    """
+    device_type = torch.device(device).type
+    match precision:
+        case 'fp32':
+            return None
+        case 'fp16':
+            return torch.float16 if device_type == 'cuda' else torch.bfloat16
+        case 'bf16':
+            if device_type == 'cuda' and not torch.cuda.is_bf16_supported():
+                return torch.float16
+            return torch.bfloat16
+        case _:
+            raise ValueError(f'Precision {precision} is not defined.')
+
+
+def autocast_context(precision: str, device):
+    """Reusable context manager running the forward pass (and loss) in the given precision"""
+    amp_dtype = resolve_amp_dtype(precision, device)
+    if amp_dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=amp_dtype)
+
+
+def make_grad_scaler(precision: str, device):
+    """
+    Loss scaler for a training run, only active when autocasting to fp16 (bf16 has the
+    exponent range of fp32). Create it once per run and pass it to every epoch, its scale
+    adapts over steps.
+    """
+    enabled = resolve_amp_dtype(precision, device) == torch.float16
+    return torch.amp.GradScaler(torch.device(device).type, enabled=enabled)
+
+
+class WarmupCosineLR(LRScheduler):
+    """
+    Step-level learning rate schedule: linear warmup, then cosine annealing over the
+    remaining steps. Stepped after every optimizer step (train_one_epoch does so for any
+    scheduler with per_step = True), so a run of a few batches per epoch still gets a full
+    warmup and decay.
+
+    schedule='cosine' warms up from 0 to the base lr; 'one_cycle' warms up from
+    base lr / initial_div_factor, as torch's OneCycleLR.
+    """
+    per_step = True
+
+    def __init__(
+            self, 
+            optimizer, 
+            total_steps: int, 
+            warmup_steps=0, 
+            schedule='cosine', 
+            min_lr_ratio=0., 
+            initial_div_factor=25., 
+            last_epoch=-1
+        ) -> None:
+        """
+        Parameters
+        ---------------------------------------
+        total_steps: int, number of optimizer steps of the whole run
+        warmup_steps: int, number of steps of linear warmup
+        min_lr_ratio: float, final lr as a fraction of the base lr
+        """
+        match schedule:
+            case 'cosine':
+                self.warmup_start_ratio = 0.
+            case 'one_cycle':
+                self.warmup_start_ratio = 1. / initial_div_factor
+            case _:
+                raise ValueError(f'Schedule {schedule} is not defined.')
+        self.total_steps = total_steps
+        self.warmup_steps = warmup_steps
+        self.min_lr_ratio = min_lr_ratio
+        super(WarmupCosineLR, self).__init__(optimizer, last_epoch)
+
+    def lr_ratio(self, step: int) -> float:
+        if step < self.warmup_steps:
+            progress = (step + 1) / self.warmup_steps
+            return self.warmup_start_ratio + (1. - self.warmup_start_ratio) * progress
+        progress = min(1., (step - self.warmup_steps) / max(1, self.total_steps - self.warmup_steps - 1))
+        return self.min_lr_ratio + (1. - self.min_lr_ratio) * 0.5 * (1. + math.cos(math.pi * progress))
+
+    def get_lr(self):
+        ratio = self.lr_ratio(self.last_epoch)
+        return [base_lr * ratio for base_lr in self.base_lrs]
+
+
+def make_lr_scheduler(optimizer, lr_schedule: str, n_epochs: int, dataloader=None, 
+                      accumulation_steps=1, warmup_fraction=0.1) -> LRScheduler:
+    """
+    Parameters
+    ---------------------------------------
+    lr_schedule: str, one of
+        'epoch_cosine': CosineAnnealingLR(T_max=n_epochs - 1), stepped once per epoch
+        'warmup_cosine' / 'one_cycle': WarmupCosineLR over all optimizer steps of the run,
+        counted from the length of dataloader
+    warmup_fraction: float, fraction of the steps used for warmup
+    """
+    if lr_schedule == 'epoch_cosine':
+        return torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=n_epochs - 1)
+    assert dataloader is not None, 'Step-level schedules need the dataloader to count steps'
+    total_steps = n_epochs * math.ceil(len(dataloader) / accumulation_steps)
+    match lr_schedule:
+        case 'warmup_cosine':
+            schedule = 'cosine'
+        case 'one_cycle':
+            schedule = 'one_cycle'
+        case _:
+            raise ValueError(f'LR schedule {lr_schedule} is not defined.')
+    return WarmupCosineLR(optimizer, total_steps, int(warmup_fraction * total_steps), schedule)
+
+
+class EarlyStopping(ModelCheckpointer):
+    """
+    Convergence monitor for a training loop. Call step() once per epoch; it snapshots the
+    best weights into in-memory shadow tensors and returns True once training should stop,
+    either because the validation metric has not improved by min_delta for patience epochs,
+    or because the training loss has flattened (least-squares slope over the last
+    slope_window epochs smaller than slope_tol times the mean loss). restore() copies the
+    best weights back into the model in place.
+    """
+    def __init__(self, model, patience=5, min_delta=0., mode='max', slope_window=None, 
+                 slope_tol=1e-3, min_epochs=0):
+        """
+        Parameters
+        ---------------------------------------
+        patience: int, number of epochs without improvement before stopping. None to only
+        use the loss slope criterion
+        min_delta: float, smallest change of the metric that counts as an improvement
+        mode: 'min' or 'max', whether a lower or higher metric is better
+        slope_window: int, number of epochs for the loss slope criterion, None to disable
+        min_epochs: int, never stop before this many epochs
+        """
+        super(EarlyStopping, self).__init__(model, mode=mode)
+        self.patience = patience
+        self.min_delta = min_delta
+        self.slope_window = slope_window
+        self.slope_tol = slope_tol
+        self.min_epochs = min_epochs
+        self.n_epochs = 0
+        self.n_bad_epochs = 0
+        self.losses = []
+        self.stopped_epoch = None
+
+    def loss_plateaued(self) -> bool:
+        if self.slope_window is None or len(self.losses) < self.slope_window:
+            return False
+        losses = np.asarray(self.losses[-self.slope_window:])
+        slope = np.polyfit(np.arange(self.slope_window), losses, 1)[0]
+        # still decreasing by at least slope_tol of its magnitude per epoch?
+        return -slope < self.slope_tol * np.abs(losses).mean()
+
+    def step(self, metric, epoch=None, train_loss=None) -> bool:
+        """
+        Record one epoch. Returns whether training should stop
+
+        Parameters
+        ---------------------------------------
+        metric: validation metric of this epoch
+        train_loss: training loss of this epoch, for the slope criterion
+        """
+        metric = float(metric)
+        delta = metric - self.best_metric if self.mode == 'max' else self.best_metric - metric
+        if delta > self.min_delta:
+            self.best_metric = metric
+            self.best_epoch = epoch
+            self.snapshot(self.best)
+            self.n_bad_epochs = 0
+        else:
+            self.n_bad_epochs += 1
+        if train_loss is not None:
+            self.losses.append(float(train_loss))
+        self.n_epochs += 1
+
+        if self.n_epochs < self.min_epochs:
+            return False
+        stop = (self.patience is not None and self.n_bad_epochs >= self.patience) or self.loss_plateaued()
+        if stop:
+            self.stopped_epoch = epoch
+        return stop
+
+    @torch.no_grad()
+    def restore(self) -> None:
+        """Load the best weights back into the model (no-op before the first step)"""
+        if self.best_epoch is None:
+            return
+        for name, tensor in self.model.state_dict().items():
+            tensor.copy_(self.best[name])
+
+
+def early_stopping_enabled(args) -> bool:
+    return args.early_stopping_patience is not None or args.early_stopping_slope_window is not None
+
+
+def make_early_stopping(model, args, mode='max'):
+    """EarlyStopping configured from the early_stopping_* training config keys, None if disabled"""
+    if not early_stopping_enabled(args):
+        return None
+    return EarlyStopping(
+        model, 
+        patience=args.early_stopping_patience, 
+        min_delta=args.early_stopping_min_delta, 
+        mode=mode,
+        slope_window=args.early_stopping_slope_window, 
+        slope_tol=args.early_stopping_slope_tol
+    )
+
+
+def split_early_stopping_valid(train_set: BaseConcatDataset, valid_fraction: float):
+    """
+    Hold out the last valid_fraction of the trials of a training split (e.g. '0train') to
+    monitor early stopping on, so that model selection never sees the test runs
+
+    return
+    ---------------------------------------
+    train_set, valid_set: BaseConcatDataset
+    """
+    n_trials = split_stats(train_set).n_trials
+    assert n_trials >= 2, "Need at least 2 training trials to hold out an early stopping set"
+    n_valid = min(max(1, int(round(n_trials * valid_fraction))), n_trials - 1)
+    return get_subset(train_set, n_trials - n_valid), get_subset(train_set, n_valid, from_back=True)
+
+
+class EarlyStoppingCallback(Callback):
+    """
+    EarlyStopping for skorch / braindecode EEGClassifier. Monitors a history column, stops
+    the fit when EarlyStopping says so, and restores the best module weights at the end.
+    The epoch where the last fit stopped (None if it ran to the end) is in stopped_epoch.
+    """
+    def __init__(self, monitor='valid_accuracy', lower_is_better=False, loss_monitor='train_loss', 
+                 **early_stopping_kwargs):
+        self.monitor = monitor
+        self.lower_is_better = lower_is_better
+        self.loss_monitor = loss_monitor
+        self.early_stopping_kwargs = early_stopping_kwargs
+
+    def on_train_begin(self, net, **kwargs):
+        mode = 'min' if self.lower_is_better else 'max'
+        self.early_stopping = EarlyStopping(net.module_, mode=mode, **self.early_stopping_kwargs)
+        self.stopped_epoch = None
+
+    def on_epoch_end(self, net, **kwargs):
+        history = net.history[-1]
+        stop = self.early_stopping.step(
+            history[self.monitor], 
+            epoch=history['epoch'], 
+            train_loss=history.get(self.loss_monitor)
+        )
+        if stop:
+            self.stopped_epoch = history['epoch']
+            # skorch ends the fit loop on KeyboardInterrupt
+            raise KeyboardInterrupt
+
+    def on_train_end(self, net, **kwargs):
+        self.early_stopping.restore()
+
+
+def _map_tensors(obj, fn):
+    """Apply fn to every tensor of a (nested) dict of tensors, as saved with torch.save"""
+    if isinstance(obj, dict):
+        return {key: _map_tensors(value, fn) for key, value in obj.items()}
+    return fn(obj) if isinstance(obj, torch.Tensor) else obj
+
+
+class WeightCache(object):
+    """
+    LRU cache of pretrained weights files (state dicts, or dicts of them, saved with
+    torch.save), to restore a model to its pretrained state many times without reading
+    and deserializing the file each time. Every file is read once into pinned host memory;
+    the most recently used ones also have a master copy on the device, from which models
+    are restored by in-place copies into their existing parameter storage.
+    """
+    def __init__(self, device='cuda', max_device_entries=1, max_host_entries=4) -> None:
+        """
+        Parameters
+        ---------------------------------------
+        max_device_entries: int, number of files (e.g. one subject's pretrained model) with 
+        a device master copy
+        max_host_entries: int, number of files kept in host memory
+        """
+        assert max_host_entries >= max_device_entries, "Device entries must also be host entries"
+        self.device = torch.device(device)
+        self.max_device_entries = max_device_entries
+        self.max_host_entries = max_host_entries
+        self.host = OrderedDict()
+        self.masters = OrderedDict()
+        # tensors handed out by restore_dict, refilled in place on later calls
+        self.owned = {}
+
+    def get(self, path: str) -> dict:
+        """Device master copy of the weights in path. Treat it as read-only"""
+        if path in self.masters:
+            self.masters.move_to_end(path)
+            return self.masters[path]
+
+        if path in self.host:
+            self.host.move_to_end(path)
+        else:
+            pin = self.device.type == 'cuda'
+            host = _map_tensors(
+                torch.load(path, map_location='cpu'), 
+                lambda tensor: tensor.detach().pin_memory() if pin else tensor.detach()
+            )
+            self.host[path] = host
+            if len(self.host) > self.max_host_entries:
+                evicted, _ = self.host.popitem(last=False)
+                self.masters.pop(evicted, None)
+                self.owned = {key: value for key, value in self.owned.items() if key[0] != evicted}
+
+        self.masters[path] = _map_tensors(
+            self.host[path], lambda tensor: tensor.to(self.device, non_blocking=True)
+        )
+        if len(self.masters) > self.max_device_entries:
+            self.masters.popitem(last=False)
+        return self.masters[path]
+
+    def restore(self, path: str, model: nn.Module, subkey=None) -> None:
+        """Load the cached state dict (or its subkey entry) into model, in place"""
+        weights = self.get(path)
+        # load_state_dict copies into the existing parameters and buffers
+        model.load_state_dict(weights if subkey is None else weights[subkey])
+
+    @torch.no_grad()
+    def restore_dict(self, path: str, subkey=None) -> dict:
+        """
+        New dict of tensors holding the cached weights, in place of deepcopy(weights). The
+        tensors are allocated on the first call and refilled in place on later calls for the
+        same (path, subkey), so tensors of a dict previously returned for it are overwritten;
+        tensors put into that dict by the caller are not.
+        """
+        weights = self.get(path)
+        weights = weights if subkey is None else weights[subkey]
+        key = (path, subkey)
+        if key not in self.owned:
+            self.owned[key] = {
+                name: tensor.detach().clone().requires_grad_(tensor.requires_grad) 
+                for name, tensor in weights.items()
+            }
+        else:
+            for name, tensor in weights.items():
+                self.owned[key][name].copy_(tensor)
+        return dict(self.owned[key])
+
+
+def check_forward_kwargs(model: nn.Module, forward_pass_kwargs: dict) -> None:
+    """
+    Raise a TypeError up front if model.forward does not accept forward_pass_kwargs, rather
+    than in the middle of an epoch (or not at all, for a forward with **kwargs)
+    """
+    if not forward_pass_kwargs:
+        return
+    try:
+        inspect.signature(model.forward).bind_partial(**forward_pass_kwargs)
+    except TypeError as e:
+        raise TypeError(
+            f'forward_pass_kwargs {sorted(forward_pass_kwargs)} do not match '
+            f'{type(model).__name__}.forward: {e}'
+        ) from None
+
+
+def compute_loss(
+    model: nn.Module, 
+    pred: torch.Tensor, 
+    y: torch.Tensor, 
+    loss_fn, 
+    optimize_for_acc=True,
+    regularize_tensor_distance=False,
+    regularization_coef=1
+) -> torch.Tensor:
+    """
+    Loss of one batch, kept on device (no .item()). Sum of the prediction loss and the 
+    distance between the generated weight tensor and the reference tensor (HyperBCINet)
+
+    Parameters
+    ---------------------------------------
+    optimize_for_acc: bool, include loss_fn(pred, y)
+    regularize_tensor_distance: bool, include model.calculate_tensor_distance()
+    regularization_coef: float, weight of the tensor distance term
+    """
+    loss = loss_fn(pred, y) if optimize_for_acc else pred.new_zeros(())
+    if regularize_tensor_distance:
+        loss = loss + regularization_coef * model.calculate_tensor_distance()
+    return loss
+
+
+def trainable_parameters(model: nn.Module) -> list:
+    """Parameters that still require grad, to build optimizers over after freezing"""
+    return [param for param in model.parameters() if param.requires_grad]
+
+
+# layers whose output depends on train() / eval() mode
+TRAIN_MODE_DEPENDENT_LAYERS = (
+    nn.modules.batchnorm._BatchNorm, 
+    nn.modules.instancenorm._InstanceNorm, 
+    nn.modules.dropout._DropoutNd
+)
+
+
+def has_train_mode_dependent_layers(module: nn.Module) -> bool:
+    return any(isinstance(submodule, TRAIN_MODE_DEPENDENT_LAYERS) for submodule in module.modules())
+
+
+def split_frozen_prefix(model: nn.Sequential):
+    """
+    Split a sequential model (e.g. ShallowFBCSPNet) into its longest leading run of fully
+    frozen children without batch norm / dropout layers, and the rest. Those layers behave
+    differently in train mode, so they stay in the trained part and the cached prefix
+    outputs are the same in train and eval mode.
+
+    return
+    ---------------------------------------
+    prefix, suffix: nn.Sequential sharing the modules of model, suffix(prefix(x)) == model(x)
+    """
+    if not isinstance(model, nn.Sequential):
+        raise ValueError(f'{type(model).__name__} is not sequential, cannot split off a frozen prefix.')
+    children = list(model.named_children())
+    n_frozen = 0
+    for _, module in children:
+        if any(param.requires_grad for param in module.parameters()) or has_train_mode_dependent_layers(module):
+            break
+        n_frozen += 1
+    return nn.Sequential(OrderedDict(children[:n_frozen])), nn.Sequential(OrderedDict(children[n_frozen:]))
+
+
+class CachedFeatureLoader(object):
+    """
+    Minimal DataLoader over tensors already on the device, yields (X, y, None) batches.
+    Has the len() and .dataset that train_one_epoch and test_model use.
+    """
+    def __init__(self, features: torch.Tensor, y: torch.Tensor, batch_size: int, shuffle=False) -> None:
+        self.dataset = features
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self) -> int:
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def __iter__(self):
+        n = len(self.dataset)
+        order = torch.randperm(n, device=self.dataset.device) if self.shuffle else None
+        for start in range(0, n, self.batch_size):
+            if order is None:
+                yield self.dataset[start:start + self.batch_size], self.y[start:start + self.batch_size], None
+            else:
+                batch = order[start:start + self.batch_size]
+                yield self.dataset[batch], self.y[batch], None
+
+
+@torch.no_grad()
+def cache_prefix_outputs(prefix: nn.Module, dataloader: DataLoader, device="cuda", shuffle=False):
+    """
+    Run the frozen prefix once over dataloader and return a CachedFeatureLoader of its
+    outputs, to train / evaluate the suffix on. The prefix must not contain batch norm or
+    dropout layers (see split_frozen_prefix), so its outputs do not depend on the mode.
+    """
+    assert not has_train_mode_dependent_layers(prefix), \
+        "Prefix has batch norm / dropout layers, its cached outputs would differ from train mode"
+    prefix.eval()
+    features, labels = [], []
+    for X, y, _ in dataloader:
+        features.append(prefix(X.to(device)))
+        labels.append(y.to(device))
+    return CachedFeatureLoader(torch.cat(features), torch.cat(labels), dataloader.batch_size, shuffle)
+
+
+def warmup_context(warmup_scheduler):
+    """dampening() context of a pytorch_warmup scheduler, a no-op context if there is none"""
+    return nullcontext() if warmup_scheduler is None else warmup_scheduler.dampening()
+
+
+def rescale_grads(optimizer, factor: float) -> None:
+    """Multiply the accumulated gradients of every parameter of optimizer by factor"""
+    if factor == 1:
+        return
+    for group in optimizer.param_groups:
+        for param in group['params']:
+            if param.grad is not None:
+                param.grad.mul_(factor)
+
+
 '''
 Define a method for training one epoch. Adapted from
 https://braindecode.org/stable/auto_examples/model_building/plot_train_in_pure_pytorch_and_pytorch_lightning.html
@@ -257,46 +882,91 @@ def train_one_epoch(
     epoch: int, 
     device="cuda", 
     print_batch_stats=False,
-    # optimize_for_acc=True,
-    # regularize_tensor_distance=False,
-    # regularization_coef=1,
+    warmup_scheduler=None,
+    optimize_for_acc=True,
+    regularize_tensor_distance=False,
+    regularization_coef=1,
+    instrumentation=None,
+    precision='fp32',
+    scaler=None,
+    accumulation_steps=1,
     **forward_pass_kwargs
 ):
+    """
+    Loss and accuracy are accumulated on device and synced once at the end of the epoch.
+
+    Parameters
+    ---------------------------------------
+    scheduler: stepped once at the end of the epoch, or after every optimizer step if 
+    it has per_step = True (WarmupCosineLR)
+    warmup_scheduler: optional pytorch_warmup scheduler, dampens the learning rate after
+    every optimizer step
+    optimize_for_acc, regularize_tensor_distance, regularization_coef: loss terms, see 
+    compute_loss
+    instrumentation: optional instrumentation.LoopInstrumentation, records per-phase
+    timings, samples/s and peak memory of this epoch
+    precision: 'fp32', 'fp16' or 'bf16', see resolve_amp_dtype
+    scaler: GradScaler from make_grad_scaler, shared across epochs. Created per epoch if None
+    accumulation_steps: number of batches whose gradients are summed per optimizer step
+    forward_pass_kwargs: passed to model.forward, checked against its signature
+    """
     # Have to include at least one loss term
-    # assert optimize_for_acc or regularization_coef, "Must include at least one loss term"
+    assert optimize_for_acc or regularize_tensor_distance, "Must include at least one loss term"
+    check_forward_kwargs(model, forward_pass_kwargs)
 
     # Set the model to training mode
     model.train()  
-    train_loss, correct = 0, 0
+    train_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    n_batches = len(dataloader)
+    per_step_scheduler = getattr(scheduler, 'per_step', False)
+    autocast = autocast_context(precision, device)
+    if scaler is None:
+        scaler = make_grad_scaler(precision, device)
+
+    if instrumentation is None:
+        phase, batches = null_phase, dataloader
+    else:
+        instrumentation.start('train', epoch)
+        phase, batches = instrumentation.phase, instrumentation.iterate(dataloader)
 
-    progress_bar = tqdm(enumerate(dataloader), total=len(dataloader),
+    progress_bar = tqdm(enumerate(batches), total=len(dataloader),
                         disable=not print_batch_stats)
 
+    optimizer.zero_grad()
     for batch_idx, (X, y, _) in progress_bar:
-        X, y = X.to(device), y.to(device)
-        optimizer.zero_grad()
-        pred = model(X, **forward_pass_kwargs)
-        
-        # if optimize_for_acc:
-        #     # print(pred.shape)
-        #     # print(y.shape)
-        #     acc_loss = loss_fn(pred, y)
-        # else:
-        #     acc_loss = 0
-        # if regularize_tensor_distance:
-        #     distance = model.calculate_tensor_distance()
-        #     distance_loss = regularization_coef * distance
-        # else:
-        #     distance_loss = 0
-        # loss = acc_loss + distance_loss
-
-        loss = loss_fn(pred, y)
-        loss.backward()
-        optimizer.step()  
-        optimizer.zero_grad()
+        with phase('h2d'):
+            X, y = X.to(device), y.to(device)
+        with phase('forward'), autocast:
+            pred = model(X, **forward_pass_kwargs)
+            loss = compute_loss(
+                model, pred, y, loss_fn, 
+                optimize_for_acc, regularize_tensor_distance, regularization_coef
+            )
+        # average over the batches of this step, the last step may have fewer
+        group_start = batch_idx - batch_idx % accumulation_steps
+        group_size = min(accumulation_steps, n_batches - group_start)
+        with phase('backward'):
+            scaler.scale(loss / group_size).backward()
+        if batch_idx + 1 == group_start + group_size:
+            with phase('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+                # dampening() restores the undampened lrs on entry, so the scheduler
+                # steps inside it
+                if per_step_scheduler:
+                    with warmup_context(warmup_scheduler):
+                        scheduler.step()
+                # the dampening of the last step goes with scheduler.step() below
+                elif warmup_scheduler is not None and batch_idx + 1 < n_batches:
+                    with warmup_scheduler.dampening():
+                        pass
 
-        train_loss += loss.item()
-        correct += (pred.argmax(1) == y).sum().item()
+        train_loss += loss.detach()
+        correct += (pred.argmax(1) == y).sum()
+        if instrumentation is not None:
+            instrumentation.count(len(y))
 
         if print_batch_stats:
             progress_bar.set_description(
@@ -306,7 +976,14 @@ def train_one_epoch(
             )
 
     # Update the learning rate
-    scheduler.step()
+    if not per_step_scheduler:
+        with warmup_context(warmup_scheduler):
+            scheduler.step()
+
+    with phase('sync'):
+        train_loss, correct = train_loss.item(), correct.item()
+    if instrumentation is not None:
+        instrumentation.end()
 
     correct /= len(dataloader.dataset)
     return train_loss / len(dataloader), correct
@@ -326,54 +1003,60 @@ def test_model(
     regularize_tensor_distance=False,
     regularization_coef=1,
     device="cuda", 
+    instrumentation=None,
     **forward_pass_kwargs
 ):
+    """
+    Loss terms and forward_pass_kwargs as in train_one_epoch. Loss and accuracy are 
+    accumulated on device and synced once at the end.
+
+    instrumentation: optional instrumentation.LoopInstrumentation, records per-phase
+    timings, samples/s and peak memory of this pass
+    """
+    check_forward_kwargs(model, forward_pass_kwargs)
     size = len(dataloader.dataset)
     n_batches = len(dataloader)
     # Switch to evaluation mode
     model.eval()  
-    test_loss, correct = 0, 0
+    test_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
+
+    if instrumentation is None:
+        phase, batches = null_phase, dataloader
+    else:
+        instrumentation.start('test')
+        phase, batches = instrumentation.phase, instrumentation.iterate(dataloader)
 
     if print_batch_stats:
-        progress_bar = tqdm(enumerate(dataloader), total=len(dataloader))
+        progress_bar = tqdm(enumerate(batches), total=len(dataloader))
     else:
-        progress_bar = enumerate(dataloader)
+        progress_bar = enumerate(batches)
 
     for batch_idx, (X, y, _) in progress_bar:
-        X, y = X.to(device), y.to(device)
-        pred = model(X, **forward_pass_kwargs)
-
-        # print(pred)
-        # print('---------------------')
-        # print(y)
-
-        if optimize_for_acc:
-            acc_loss = loss_fn(pred, y).item()
-        else:
-            acc_loss = 0
-        if regularize_tensor_distance:
-            distance = model.calculate_tensor_distance()
-            distance_loss = regularization_coef * distance
-        else:
-            distance_loss = 0
-        batch_loss = acc_loss + distance_loss
-
-        # batch_loss = loss_fn(pred, y).item()
-        # if regularize_tensor_distance:
-        #     distance = model.calculate_tensor_distance()
-        #     distance_loss = regularization_coef * distance
-        #     # print(f'Tensor distance loss to reference tensor is {distance_loss:.6f}')
-        #     batch_loss += distance_loss
+        with phase('h2d'):
+            X, y = X.to(device), y.to(device)
+        with phase('forward'):
+            pred = model(X, **forward_pass_kwargs)
+            batch_loss = compute_loss(
+                model, pred, y, loss_fn, 
+                optimize_for_acc, regularize_tensor_distance, regularization_coef
+            )
 
         test_loss += batch_loss
-        correct += (pred.argmax(1) == y).type(torch.float).sum().item()
+        correct += (pred.argmax(1) == y).sum()
+        if instrumentation is not None:
+            instrumentation.count(len(y))
 
         if print_batch_stats:
             progress_bar.set_description(
                 f"Batch {batch_idx + 1}/{len(dataloader)}, "
-                f"Loss: {batch_loss:.6f}"
+                f"Loss: {batch_loss.item():.6f}"
             )
 
+    with phase('sync'):
+        test_loss, correct = test_loss.item(), correct.item()
+    if instrumentation is not None:
+        instrumentation.end()
     test_loss /= n_batches
     correct /= size
 
@@ -449,8 +1132,15 @@ def train_one_epoch_episodic(
     epoch: int, 
     device="cuda", 
     num_classes = 4,
-    print_batch_stats=False
+    print_batch_stats=False,
+    precision='fp32',
+    scaler=None,
+    accumulation_steps=1
 ):
+    """
+    precision, scaler, accumulation_steps: as in train_one_epoch. Skipped batches do not
+    count towards accumulation_steps
+    """
 
     # Episodic setup
     batch_size = dataloader.batch_size
@@ -460,6 +1150,10 @@ def train_one_epoch_episodic(
     # Set the model to training mode
     model.train()  
     train_loss, correct = 0, 0
+    autocast = autocast_context(precision, device)
+    if scaler is None:
+        scaler = make_grad_scaler(precision, device)
+    n_accumulated = 0
 
     progress_bar = tqdm(
         enumerate(dataloader), 
@@ -467,9 +1161,9 @@ def train_one_epoch_episodic(
         disable=not print_batch_stats
     )
 
+    optimizer.zero_grad()
     for batch_idx, (X, y, _) in progress_bar:
         X, y = X.to(device), y.to(device)
-        optimizer.zero_grad()
 
         # ===== Sample support/query set from batch =====
         try:
@@ -483,30 +1177,36 @@ def train_one_epoch_episodic(
                 print(f"Skipping batch {batch_idx} (not enough samples per class)")
             continue
         
-        # ===== Encode support and query sets =====
-        _ = model.support_encoder(support_x)
-        support_emb = model.support_encoder.get_embeddings()
-        # remove the singleton dimension
-        support_emb = support_emb.squeeze(-1)
+        with autocast:
+            # ===== Encode support and query sets =====
+            _ = model.support_encoder(support_x)
+            support_emb = model.support_encoder.get_embeddings()
+            # remove the singleton dimension
+            support_emb = support_emb.squeeze(-1)
 
-        _ = model.encoder(query_x)
+            _ = model.encoder(query_x)
 
-        task_emb = model.encoder.get_embeddings()
-        # remove the singleton dimension
-        task_emb = task_emb.squeeze(-1)
+            task_emb = model.encoder.get_embeddings()
+            # remove the singleton dimension
+            task_emb = task_emb.squeeze(-1)
 
-        task_emb_adapted = model.attention_transform_with_prototypes(
-            support_emb, support_y, task_emb, num_classes=num_classes
-        )
+            task_emb_adapted = model.attention_transform_with_prototypes(
+                support_emb, support_y, task_emb, num_classes=num_classes
+            )
 
-        # ===== Final classification head =====
-        # [batch_size_query, num_classes]
-        logits = model.classifier(task_emb_adapted).squeeze(-1).squeeze(-1)
+            # ===== Final classification head =====
+            # [batch_size_query, num_classes]
+            logits = model.classifier(task_emb_adapted).squeeze(-1).squeeze(-1)
 
-        # ===== Loss and optimization =====
-        loss = loss_fn(logits, query_y)
-        loss.backward()
-        optimizer.step()
+            # ===== Loss and optimization =====
+            loss = loss_fn(logits, query_y)
+        scaler.scale(loss / accumulation_steps).backward()
+        n_accumulated += 1
+        if n_accumulated == accumulation_steps:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+            n_accumulated = 0
 
         train_loss += loss.item()
         correct += (logits.argmax(1) == query_y).sum().item()
@@ -518,6 +1218,13 @@ def train_one_epoch_episodic(
                 f"Loss: {loss.item():.6f}"
             )
 
+    # Step on the gradients left from an incomplete accumulation, averaged over its own size
+    if n_accumulated:
+        rescale_grads(optimizer, accumulation_steps / n_accumulated)
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+
     # Update the learning rate
     scheduler.step()
 
@@ -611,11 +1318,22 @@ def train_one_epoch_meta_subject(
     scheduler: LRScheduler,
     device="cuda",
     num_classes=4,
-    print_batch_stats=False
+    print_batch_stats=False,
+    precision='fp32',
+    scaler=None,
+    accumulation_steps=1
 ):
-    
+    """
+    precision, scaler, accumulation_steps: as in train_one_epoch. Skipped episodes do not
+    count towards accumulation_steps
+    """
     model.train()
     total_loss, correct, total_query = 0.0, 0.0, 0
+    autocast = autocast_context(precision, device)
+    if scaler is None:
+        scaler = make_grad_scaler(precision, device)
+    n_accumulated = 0
+    optimizer.zero_grad()
 
     # batch_size = subject_loaders[0].batch_size
     # n_support = batch_size // (2 * num_classes)
@@ -647,35 +1365,48 @@ def train_one_epoch_meta_subject(
         print(f'Shape of support_x is {support_x.shape}')
         print(f'Shape of query_x is {query_x.shape}')
 
-        # ===== Encode support and query sets =====
-        _ = model.support_encoder(support_x)
-        support_emb = model.support_encoder.get_embeddings()
-        # remove the singleton dimension
-        support_emb = support_emb.squeeze(-1)
+        with autocast:
+            # ===== Encode support and query sets =====
+            _ = model.support_encoder(support_x)
+            support_emb = model.support_encoder.get_embeddings()
+            # remove the singleton dimension
+            support_emb = support_emb.squeeze(-1)
 
-        _ = model.encoder(query_x)
+            _ = model.encoder(query_x)
 
-        task_emb = model.encoder.get_embeddings()
-        # remove the singleton dimension
-        task_emb = task_emb.squeeze(-1)
+            task_emb = model.encoder.get_embeddings()
+            # remove the singleton dimension
+            task_emb = task_emb.squeeze(-1)
 
-        task_emb_adapted = model.attention_transform_with_prototypes(
-            support_emb, support_y, task_emb, num_classes=num_classes
-        )
+            task_emb_adapted = model.attention_transform_with_prototypes(
+                support_emb, support_y, task_emb, num_classes=num_classes
+            )
 
-        # ===== Final classification head =====
-        # [batch_size_query, num_classes]
-        logits = model.classifier(task_emb_adapted).squeeze(-1).squeeze(-1)
+            # ===== Final classification head =====
+            # [batch_size_query, num_classes]
+            logits = model.classifier(task_emb_adapted).squeeze(-1).squeeze(-1)
 
-        # ===== Loss and optimization =====
-        loss = loss_fn(logits, query_y)
-        loss.backward()
-        optimizer.step()
+            # ===== Loss and optimization =====
+            loss = loss_fn(logits, query_y)
+        scaler.scale(loss / accumulation_steps).backward()
+        n_accumulated += 1
+        if n_accumulated == accumulation_steps:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+            n_accumulated = 0
 
         total_loss += loss.item()
         correct += (logits.argmax(1) == query_y).sum().item()
         total_query += query_y.size(0)
 
+    # Step on the gradients left from an incomplete accumulation, averaged over its own size
+    if n_accumulated:
+        rescale_grads(optimizer, accumulation_steps / n_accumulated)
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+
     scheduler.step()
     avg_loss = total_loss / len(subject_loaders)
     accuracy = correct / total_query if total_query > 0 else 0.0
@@ -0,0 +1,160 @@
+'''
+Per-recording ingestion of SleepPhysionet into an on-disk window store. Each night is
+loaded, filtered, scaled and windowed on its own, in parallel workers, and saved in
+braindecode's BaseConcatDataset.save layout; training then loads the store lazily with
+load_concat_dataset(preload=False), so only the recordings in use are read into memory.
+
+    windows_dataset = ingest_sleep_physionet('data/SleepPhysionet_windows', subject_ids=range(79), n_jobs=4)
+
+A night is moved into the store only once it is completely written, so an interrupted
+ingestion restarts with the nights that are missing. The preprocessing parameters are
+saved with the store; ingesting into an existing store with different ones is an error.
+'''
+import os
+import json
+import shutil
+
+import numpy as np
+from joblib import Parallel, delayed
+from mne.datasets.sleep_physionet.age import fetch_data
+from sklearn.preprocessing import scale as standard_scale
+
+from braindecode.datasets import SleepPhysionet
+from braindecode.datautil import load_concat_dataset
+from braindecode.preprocessing import preprocess, Preprocessor, create_windows_from_events
+
+# We merge stages 3 and 4 following AASM standards.
+SLEEP_STAGE_MAPPING = {
+    'Sleep stage W': 0,
+    'Sleep stage 1': 1,
+    'Sleep stage 2': 2,
+    'Sleep stage 3': 3,
+    'Sleep stage 4': 3,
+    'Sleep stage R': 4
+}
+INGEST_KWARGS_FILE = 'ingest_kwargs.json'
+TMP_DIR = '.tmp'
+
+
+def recording_store_id(subject_id: int, recording_id: int) -> int:
+    """Stable id (= sub directory name) of a night in the store"""
+    return 2 * subject_id + recording_id - 1
+
+
+def _ingest_recording(store_dir, subject_id, recording_id, crop_wake_mins, high_cut_hz, factor, window_size_s):
+    """
+    Preprocess, window and save one night. Runs in a worker, holds only this night in memory.
+
+    return
+    ---------------------------------------
+    True if the night was written, False if it is not part of the corpus
+    """
+    # subjects 39, 68, 69, 78 and one night of subjects 13, 36, 52 do not exist
+    if not fetch_data([subject_id], recording=[recording_id], on_missing='ignore'):
+        return False
+
+    dataset = SleepPhysionet(subject_ids=[subject_id], recording_ids=[recording_id], crop_wake_mins=crop_wake_mins)
+    preprocessors = [
+        # Convert from V to uV
+        Preprocessor(lambda data: np.multiply(data, factor), apply_on_array=True),
+        # filtering
+        Preprocessor('filter', l_freq=None, h_freq=high_cut_hz)
+    ]
+    preprocess(dataset, preprocessors, n_jobs=1)
+
+    sfreq = dataset.datasets[0].raw.info['sfreq']
+    window_size_samples = int(window_size_s * sfreq)
+    windows_dataset = create_windows_from_events(
+        dataset,
+        trial_start_offset_samples=0,
+        trial_stop_offset_samples=0,
+        window_size_samples=window_size_samples,
+        window_stride_samples=window_size_samples,
+        preload=True,
+        mapping=SLEEP_STAGE_MAPPING
+    )
+    # scales each channel over the whole night
+    preprocess(windows_dataset, [Preprocessor(standard_scale, channel_wise=True)], n_jobs=1)
+
+    # write next to the store, then move in: a night in the store is always complete
+    store_id = recording_store_id(subject_id, recording_id)
+    tmp_dir = os.path.join(store_dir, TMP_DIR, str(store_id))
+    windows_dataset.save(path=tmp_dir, overwrite=True, offset=store_id)
+    os.replace(os.path.join(tmp_dir, str(store_id)), os.path.join(store_dir, str(store_id)))
+    return True
+
+
+def _check_ingest_kwargs(store_dir, ingest_kwargs) -> None:
+    path = os.path.join(store_dir, INGEST_KWARGS_FILE)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            stored_kwargs = json.load(f)
+        if stored_kwargs != ingest_kwargs:
+            raise ValueError(f'Window store {store_dir} was built with {stored_kwargs}, not {ingest_kwargs}.')
+    else:
+        with open(path, 'w') as f:
+            json.dump(ingest_kwargs, f, indent=4)
+
+
+def ingest_sleep_physionet(
+        store_dir,
+        subject_ids=range(79),
+        recording_ids=(1, 2),
+        crop_wake_mins=30,
+        high_cut_hz=30,
+        factor=1e6,
+        window_size_s=30,
+        n_jobs=4,
+        picks=None
+    ):
+    """
+    Ingest the nights of subject_ids that are not in the store yet, then load the requested
+    nights from the store
+
+    Parameters
+    ---------------------------------------
+    n_jobs: int, nights processed in parallel; peak memory is about n_jobs nights
+    picks: channels to keep when loading (e.g. 'Fpz-Cz'), all EEG channels are stored
+
+    return
+    ---------------------------------------
+    BaseConcatDataset of EEGWindowsDataset, one per night, reading from disk on access
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    _check_ingest_kwargs(store_dir, {
+        'crop_wake_mins': crop_wake_mins,
+        'high_cut_hz': high_cut_hz,
+        'factor': factor,
+        'window_size_s': window_size_s
+    })
+
+    recordings = [(subject_id, recording_id) for subject_id in subject_ids for recording_id in recording_ids]
+    to_ingest = [
+        (subject_id, recording_id) for subject_id, recording_id in recordings
+        if not os.path.exists(os.path.join(store_dir, str(recording_store_id(subject_id, recording_id))))
+    ]
+    if to_ingest:
+        print(f'Ingesting {len(to_ingest)} of {len(recordings)} recordings into {store_dir}')
+        Parallel(n_jobs=n_jobs)(
+            delayed(_ingest_recording)(
+                store_dir, subject_id, recording_id, crop_wake_mins, high_cut_hz, factor, window_size_s
+            ) for subject_id, recording_id in to_ingest
+        )
+        shutil.rmtree(os.path.join(store_dir, TMP_DIR), ignore_errors=True)
+
+    return load_window_store(store_dir, subject_ids, recording_ids, picks=picks)
+
+
+def load_window_store(store_dir, subject_ids=range(79), recording_ids=(1, 2), preload=False, picks=None):
+    """Load the stored nights of subject_ids, without reading the signals unless preload"""
+    ids_to_load = [
+        recording_store_id(subject_id, recording_id)
+        for subject_id in subject_ids for recording_id in recording_ids
+        if os.path.exists(os.path.join(store_dir, str(recording_store_id(subject_id, recording_id))))
+    ]
+    assert ids_to_load, f'No requested recording found in {store_dir}'
+    windows_dataset = load_concat_dataset(path=store_dir, preload=preload, ids_to_load=ids_to_load)
+    if picks is not None:
+        for ds in windows_dataset.datasets:
+            ds.raw.pick(picks)
+    return windows_dataset